@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Telegrab Accounts
+Несколько Telegram-аккаунтов в одном процессе: распределение чатов,
+собственный rate limiter у каждого аккаунта и переключение при FloodWait
+или потере авторизации
+"""
+
+import time
+import logging
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Окно для расчёта пропускной способности аккаунта (секунды)
+THROUGHPUT_WINDOW = 60
+
+# Аккаунт и чат, для которых выполняется текущая задача воркера
+# (retry_on_error берёт из него rate limiter аккаунта)
+current_lease: ContextVar = ContextVar('telegrab_account_lease', default=None)
+
+
+class AccountUnavailableError(Exception):
+    """Аккаунт временно недоступен, задачу нужно выполнить другим аккаунтом"""
+
+    def __init__(self, account: str, reason: str, seconds: int = 0):
+        super().__init__(f"Аккаунт {account} недоступен ({reason})")
+        self.account = account
+        self.reason = reason
+        self.seconds = seconds
+
+
+def chat_key(chat_id) -> str:
+    """Ключ назначения чата (как ключ single-flight очереди задач)"""
+    return str(chat_id).strip().lstrip('@').lower()
+
+
+class Account:
+    """Сессия Telegram со своим rate limiter и счётчиками"""
+
+    def __init__(self, name: str, client, limiter, primary: bool = False):
+        """
+        Args:
+            name: Имя аккаунта (номер телефона сессии)
+            client: Telethon клиент аккаунта
+            limiter: RateLimiter аккаунта
+            primary: Основной аккаунт (живые обновления, вступление в чаты, takeout)
+        """
+        self.name = name
+        self.client = client
+        self.limiter = limiter
+        self.primary = primary
+        self.status = 'active'
+        self.blocked_until = 0.0
+        self.chats = set()
+        self.assigned = 0
+        self._window = deque()
+        self.stats = {'requests': 0, 'messages': 0, 'tasks': 0, 'floods': 0, 'failovers': 0}
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """Можно ли отдавать аккаунту задачи"""
+        if self.status == 'unauthorized':
+            return False
+        return (now or time.monotonic()) >= self.blocked_until
+
+    def can_access(self, chat_id) -> bool:
+        """Видит ли аккаунт чат (основной — любой, остальные — по своим диалогам)"""
+        if self.primary:
+            return True
+        key = chat_key(chat_id)
+        if not key.lstrip('-').isdigit():
+            return False
+        value = int(key)
+        return value in self.chats or (value > 0 and int(f"-100{value}") in self.chats)
+
+    def record(self, result):
+        """Успешный запрос: учесть в пропускной способности"""
+        messages = len(result) if isinstance(result, list) else 0
+        now = time.monotonic()
+        self.stats['requests'] += 1
+        self.stats['messages'] += messages
+        self._window.append((now, messages))
+        while self._window and now - self._window[0][0] > THROUGHPUT_WINDOW:
+            self._window.popleft()
+
+    def throughput(self) -> Dict:
+        """Запросов и сообщений в минуту за последнее окно"""
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] > THROUGHPUT_WINDOW:
+            self._window.popleft()
+        scale = 60 / THROUGHPUT_WINDOW
+        return {
+            'requests_per_minute': round(len(self._window) * scale, 1),
+            'messages_per_minute': round(sum(count for _, count in self._window) * scale, 1)
+        }
+
+
+class AccountPool:
+    """
+    Аккаунты процесса и назначение чатов
+
+    Каждый аккаунт делает запросы через свой RateLimiter, поэтому суммарная
+    скорость растёт с числом аккаунтов. Чат закрепляется за аккаунтом при
+    первой задаче (таблица chat_accounts): выбирается доступный аккаунт,
+    который видит чат, с наименьшим числом закреплённых чатов.
+
+    Дополнительные аккаунты видят только чаты из своих диалогов: access_hash
+    у каждого аккаунта свой, поэтому чат, которого нет в их диалогах,
+    загружается основным аккаунтом.
+
+    Долгий FloodWait (не меньше failover_seconds) или потеря авторизации
+    снимают аккаунт с задач: текущая задача возвращается в очередь с
+    контрольной точкой и закрепляется за другим аккаунтом. После окончания
+    FloodWait аккаунт снова получает новые чаты.
+    """
+
+    def __init__(self, store=None, failover_seconds: int = 60):
+        """
+        Args:
+            store: База данных с методами get_chat_accounts / save_chat_account
+            failover_seconds: FloodWait, начиная с которого задача уходит другому аккаунту
+        """
+        self.store = store
+        self.failover_seconds = max(int(failover_seconds), 0)
+        self.accounts: Dict[str, Account] = {}
+        self.assignments: Dict[str, str] = {}
+        self._loaded = False
+
+    @property
+    def primary(self) -> Optional[Account]:
+        """Основной аккаунт"""
+        return next((account for account in self.accounts.values() if account.primary), None)
+
+    def add(self, name: str, client, limiter, primary: bool = False,
+            chats: Iterable[int] = ()) -> Account:
+        """Зарегистрировать аккаунт (повторная регистрация заменяет клиента)"""
+        account = self.accounts.get(name)
+        if account is None:
+            account = Account(name, client, limiter, primary=primary)
+            self.accounts[name] = account
+        else:
+            account.client, account.limiter = client, limiter
+            account.status, account.blocked_until = 'active', 0.0
+        account.chats = set(chats)
+        self._count_assigned()
+        return account
+
+    def _load(self):
+        """Прочитать закрепления чатов из БД (один раз)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if self.store:
+            try:
+                self.assignments = self.store.get_chat_accounts()
+            except Exception as e:
+                logger.error(f"Ошибка чтения закреплений чатов: {e}")
+        self._count_assigned()
+
+    def _count_assigned(self):
+        """Пересчитать число закреплённых чатов у аккаунтов"""
+        for account in self.accounts.values():
+            account.assigned = 0
+        for name in self.assignments.values():
+            if name in self.accounts:
+                self.accounts[name].assigned += 1
+
+    def assign(self, chat_id) -> Optional[Account]:
+        """
+        Аккаунт для задачи чата
+
+        Returns:
+            Закреплённый аккаунт, если он доступен; иначе наименее загруженный
+            доступный аккаунт, который видит чат. Если все такие аккаунты
+            недоступны — тот, чья пауза закончится раньше. None — аккаунтов нет.
+        """
+        if not self.accounts:
+            return None
+        if chat_id is None:
+            return self.primary
+        self._load()
+
+        key = chat_key(chat_id)
+        now = time.monotonic()
+        eligible = [account for account in self.accounts.values()
+                    if account.status != 'unauthorized' and account.can_access(chat_id)]
+        if not eligible:
+            return self.primary
+
+        current = self.accounts.get(self.assignments.get(key))
+        if current in eligible and current.available(now):
+            return current
+
+        ready = [account for account in eligible if account.available(now)]
+        if not ready:
+            return min(eligible, key=lambda account: account.blocked_until)
+        # Наименее загруженный; при равенстве — основной (он уже видит чат)
+        chosen = min(ready, key=lambda account: (account.assigned, not account.primary))
+        if current is not None:
+            current.assigned -= 1
+            logger.info(f"Чат {chat_id}: аккаунт {current.name} → {chosen.name}")
+        chosen.assigned += 1
+        self.assignments[key] = chosen.name
+        if self.store:
+            try:
+                self.store.save_chat_account(key, chosen.name)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения закрепления чата {chat_id}: {e}")
+        return chosen
+
+    def can_failover(self, account: Account, chat_id) -> bool:
+        """Есть ли другой доступный аккаунт, который видит чат"""
+        now = time.monotonic()
+        return any(other is not account and other.available(now) and other.can_access(chat_id)
+                   for other in self.accounts.values())
+
+    def on_flood(self, account: Account, chat_id, seconds: int) -> bool:
+        """
+        FloodWait аккаунта
+
+        Returns:
+            True — задачу нужно передать другому аккаунту
+        """
+        account.stats['floods'] += 1
+        if len(self.accounts) < 2 or seconds < self.failover_seconds:
+            return False
+        account.blocked_until = max(account.blocked_until, time.monotonic() + seconds)
+        if not self.can_failover(account, chat_id):
+            return False
+        account.stats['failovers'] += 1
+        print(f"🔀 Аккаунт {account.name}: FloodWait {seconds} сек, задачи переходят к другим аккаунтам")
+        return True
+
+    def on_unauthorized(self, account: Account, chat_id) -> bool:
+        """
+        Аккаунт потерял авторизацию (сессия отозвана или удалена)
+
+        Returns:
+            True — задачу нужно передать другому аккаунту
+        """
+        if len(self.accounts) < 2:
+            return False
+        account.status = 'unauthorized'
+        account.stats['failovers'] += 1
+        logger.critical(f"Аккаунт {account.name} не авторизован, снят с задач")
+        return self.can_failover(account, chat_id)
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        self._load()
+        now = time.monotonic()
+        result = {}
+        for account in self.accounts.values():
+            limiter = account.limiter.get_stats()
+            blocked_for = max(account.blocked_until - now, 0)
+            status = account.status
+            if status == 'active' and blocked_for:
+                status = 'flood'
+            result[account.name] = {
+                **account.stats,
+                **account.throughput(),
+                'primary': account.primary,
+                'status': status,
+                'blocked_for_seconds': round(blocked_for),
+                'visible_chats': None if account.primary else len(account.chats),
+                'assigned_chats': account.assigned,
+                'rate': limiter['rate'],
+                'total_wait_seconds': limiter['total_wait_seconds']
+            }
+        return {'accounts': result, 'failover_seconds': self.failover_seconds,
+                'generated_at': datetime.now().isoformat()}
+
+
+def lease_account() -> Optional[Account]:
+    """Аккаунт текущей задачи (None — вне задачи или один аккаунт)"""
+    lease = current_lease.get()
+    return lease[0] if lease else None
+
+
+def lease_is_primary() -> bool:
+    """Текущая задача выполняется основным аккаунтом (или аккаунт не выбран)"""
+    account = lease_account()
+    return account is None or account.primary
+
@@ -6,11 +6,13 @@ Telegrab API - FastAPI сервер с WebSocket и аутентификацие
 
 import os
 import json
+import base64
 import asyncio
 import uuid
 import time
 import logging
 import sqlite3
+import urllib.parse
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 from contextlib import asynccontextmanager
@@ -43,14 +45,19 @@ from telethon.errors import (
     AuthKeyUnregisteredError,
     AuthKeyDuplicatedError,
     AccessTokenExpiredError,
+    TakeoutInvalidError,
     BadRequestError,
     UnauthorizedError,
+    ServerError,
+    TimedOutError,
     RPCError
 )
+from telethon import utils
 
 
 # ==================== RETRY ЛОГИКА ====================
-async def retry_on_error(func, *args, max_retries=3, base_delay=1.0, exceptions=(FloodWaitError,), **kwargs):
+async def retry_on_error(func, *args, max_retries=3, base_delay=1.0, exceptions=(FloodWaitError,),
+                         method=None, **kwargs):
     """
     Повторный вызов функции при временных ошибках.
     
@@ -60,6 +67,7 @@ async def retry_on_error(func, *args, max_retries=3, base_delay=1.0, exceptions=
         max_retries: Максимальное количество попыток
         base_delay: Базовая задержка между попытками (секунды)
         exceptions: Кортеж исключений для обработки
+        method: Класс метода для rate limiter (history, resolve, join, download)
         **kwargs: Именованные аргументы для функции
     
     Returns:
@@ -69,17 +77,39 @@ async def retry_on_error(func, *args, max_retries=3, base_delay=1.0, exceptions=
         Последнее исключение если все попытки исчерпаны
     """
     last_exception = None
+    # Внутри задачи воркера запросы идут через rate limiter её аккаунта
+    lease = current_lease.get()
+    limiter = lease[0].limiter if lease else rate_limiter
     
     for attempt in range(max_retries):
+        if method:
+            await limiter.acquire(method)
         try:
-            return await func(*args, **kwargs)
+            result = await func(*args, **kwargs)
+            if method:
+                limiter.on_success(method)
+            if lease:
+                lease[0].record(result)
+            return result
         except FloodWaitError as e:
             # FloodWait обрабатывается всегда - ждём указанное время
             wait_time = e.seconds
             logger.warning(f"FloodWait (попытка {attempt + 1}/{max_retries}): ожидание {wait_time} секунд")
-            await asyncio.sleep(wait_time)
+            if method:
+                # Rate limiter снижает скорость класса и держит паузу в acquire()
+                limiter.on_flood(method, wait_time)
+            # Долгий FloodWait — задача переходит к другому аккаунту
+            if lease and account_pool.on_flood(lease[0], lease[1], wait_time):
+                raise AccountUnavailableError(lease[0].name, 'flood', wait_time) from e
+            if not method:
+                await asyncio.sleep(wait_time)
             last_exception = e
             continue
+        except (AuthKeyUnregisteredError, AuthKeyDuplicatedError, UnauthorizedError) as e:
+            # Сессия аккаунта отозвана — задача переходит к другому аккаунту
+            if lease and account_pool.on_unauthorized(lease[0], lease[1]):
+                raise AccountUnavailableError(lease[0].name, 'unauthorized') from e
+            raise
         except exceptions as e:
             # Другие временные ошибки с экспоненциальной задержкой
             if attempt < max_retries - 1:
@@ -98,11 +128,11 @@ async def retry_on_error(func, *args, max_retries=3, base_delay=1.0, exceptions=
         raise last_exception
 
 
-from fastapi import FastAPI, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect, Security
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, WebSocket, WebSocketDisconnect, Security
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 import uvicorn
 
 # ==================== КОНФИГУРАЦИЯ ====================
@@ -121,9 +151,33 @@ def load_config():
         'HISTORY_LIMIT_PER_CHAT': 200,
         'MAX_CHATS_TO_LOAD': 20,
         'REQUESTS_PER_SECOND': 1,
+        'MAX_REQUESTS_PER_SECOND': 5,
+        'ADAPTIVE_RATE': True,
         'MESSAGES_PER_REQUEST': 100,
         'JOIN_CHAT_TIMEOUT': 10,
         'MISSED_DAYS_LIMIT': 7,
+        'TASK_WORKERS': 3,
+        'TASK_AGING_SECONDS': 300,
+        'TASK_HISTORY_LIMIT': 1000,
+        'TASK_HISTORY_DAYS': 7,
+        'LIVE_BATCH_SIZE': 100,
+        'LIVE_BATCH_DELAY_MS': 20,
+        'ENTITY_CACHE_SIZE': 10000,
+        'UPDATES_CATCH_UP': True,
+        'UPDATES_STATE_INTERVAL': 60,
+        'SYNC_SCHEDULER': True,
+        'SYNC_MIN_INTERVAL': 300,
+        'SYNC_MAX_INTERVAL': 86400,
+        'SYNC_BUDGET_PERCENT': 20,
+        'TAKEOUT_BACKFILL': False,
+        'EXTRA_ACCOUNTS': '',
+        'ACCOUNT_FAILOVER_SECONDS': 60,
+        'API_WORKERS': 1,
+        'CHANGES_RETENTION_DAYS': 7,
+        'REPLICA_OF': '',
+        'REPLICA_API_KEY': '',
+        'REPLICA_POLL_SECONDS': 5,
+        'EXPORT_RETENTION_HOURS': 24,
     }
 
     try:
@@ -137,11 +191,23 @@ def load_config():
 
                     if key in config:
                         if key in ['API_ID', 'API_PORT', 'HISTORY_LIMIT_PER_CHAT',
-                                  'MAX_CHATS_TO_LOAD', 'REQUESTS_PER_SECOND',
+                                  'MAX_CHATS_TO_LOAD',
                                   'MESSAGES_PER_REQUEST', 'JOIN_CHAT_TIMEOUT',
-                                  'MISSED_LIMIT_PER_CHAT', 'MISSED_DAYS_LIMIT']:
+                                  'MISSED_LIMIT_PER_CHAT', 'MISSED_DAYS_LIMIT', 'TASK_WORKERS',
+                                  'TASK_AGING_SECONDS', 'TASK_HISTORY_LIMIT', 'TASK_HISTORY_DAYS',
+                                  'LIVE_BATCH_SIZE', 'LIVE_BATCH_DELAY_MS', 'ENTITY_CACHE_SIZE',
+                                  'UPDATES_STATE_INTERVAL', 'SYNC_MIN_INTERVAL', 'SYNC_MAX_INTERVAL',
+                                  'SYNC_BUDGET_PERCENT', 'ACCOUNT_FAILOVER_SECONDS',
+                                  'API_WORKERS', 'CHANGES_RETENTION_DAYS',
+                                  'REPLICA_POLL_SECONDS', 'EXPORT_RETENTION_HOURS']:
                             config[key] = int(value) if value.isdigit() else config[key]
-                        elif key in ['AUTO_LOAD_HISTORY', 'AUTO_LOAD_MISSED']:
+                        elif key in ['REQUESTS_PER_SECOND', 'MAX_REQUESTS_PER_SECOND']:
+                            try:
+                                config[key] = max(float(value), 0.01)
+                            except ValueError:
+                                pass
+                        elif key in ['AUTO_LOAD_HISTORY', 'AUTO_LOAD_MISSED', 'ADAPTIVE_RATE', 'UPDATES_CATCH_UP',
+                                     'SYNC_SCHEDULER', 'TAKEOUT_BACKFILL']:
                             config[key] = value.lower() in ['true', 'yes', '1', 'on']
                         else:
                             config[key] = value
@@ -180,6 +246,11 @@ def save_api_key(api_key: str):
 
 CONFIG = load_config()
 
+# Роль процесса: single — всё в одном процессе; ingest — Telethon и очередь задач
+# (раздельный режим, API_WORKERS > 1); api — HTTP воркер раздельного режима;
+# replica — реплика для чтения без Telegram (REPLICA_OF)
+PROCESS_ROLE = os.environ.get('TELEGRAB_ROLE') or ('replica' if CONFIG['REPLICA_OF'] else 'single')
+
 # ==================== АУТЕНТИФИКАЦИЯ ====================
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
@@ -201,12 +272,51 @@ from database_v6 import DatabaseV6
 # Глобальный экземпляр БД v6
 db = DatabaseV6("data/telegrab_v6.db")
 
+# ==================== RATE LIMITER ====================
+from rate_limiter import RateLimiter
+
+def create_rate_limiter(account=None):
+    """Token bucket аккаунта с выученными скоростями из БД
+
+    Скорости дополнительного аккаунта хранятся под ключами '<аккаунт>/<класс>'.
+    """
+    adaptive = CONFIG['ADAPTIVE_RATE']
+    saved = db.get_rate_limits()
+    if account:
+        prefix = f"{account}/"
+        state = {method[len(prefix):]: row for method, row in saved.items() if method.startswith(prefix)}
+        persist = lambda method, row: db.save_rate_limit(prefix + method, row)
+    else:
+        state = {method: row for method, row in saved.items() if '/' not in method}
+        persist = db.save_rate_limit
+    return RateLimiter(
+        rate=max(CONFIG['MAX_REQUESTS_PER_SECOND'], CONFIG['REQUESTS_PER_SECOND']) if adaptive else CONFIG['REQUESTS_PER_SECOND'],
+        class_rate=CONFIG['REQUESTS_PER_SECOND'],
+        adaptive=adaptive,
+        state=state,
+        persist=persist
+    )
+
+# Единый token bucket для всех запросов к Telegram API аккаунта
+rate_limiter = create_rate_limiter()
+
+# ==================== АККАУНТЫ ====================
+from accounts import AccountPool, AccountUnavailableError, current_lease, lease_is_primary
+
+# Основной аккаунт (PHONE) и дополнительные (EXTRA_ACCOUNTS) со своими rate limiter
+account_pool = AccountPool(db, failover_seconds=CONFIG['ACCOUNT_FAILOVER_SECONDS'])
+
+# Задачи, которые распределяются по аккаунтам (вступление в чат — только основной)
+SHARDED_TASK_TYPES = ('load_history', 'load_range', 'load_missed')
+
 # ==================== МЕНЕДЖЕР WEBSOCKET ====================
 class ConnectionManager:
     """Менеджер WebSocket подключений"""
 
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        # Пересылка событий HTTP воркерам (ingest-процесс в раздельном режиме)
+        self.relay = None
 
     async def connect(self, websocket: WebSocket):
         """Подключение клиента"""
@@ -222,6 +332,8 @@ class ConnectionManager:
 
     async def broadcast(self, message: dict):
         """Отправка сообщения всем подключённым клиентам"""
+        if self.relay:
+            self.relay(message)
         disconnected = []
         for connection in self.active_connections:
             try:
@@ -241,112 +353,612 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# ==================== КЭШ СУЩНОСТЕЙ ====================
+from entity_cache import EntityCache, peer_bare_id
+
+# Имена отправителей и чатов без запросов get_sender()/get_chat()
+entity_cache = EntityCache(db, capacity=CONFIG['ENTITY_CACHE_SIZE'])
+
+
+def remember_message_entities(messages):
+    """Запомнить отправителей и чаты, пришедшие вместе со страницей сообщений"""
+    entities = {}
+    for message in messages:
+        for entity in (getattr(message, 'sender', None), getattr(message, 'chat', None)):
+            if entity is not None:
+                entities[id(entity)] = entity
+    # Дополнительный аккаунт не затирает access_hash основного
+    entity_cache.remember_many(entities.values(), foreign=not lease_is_primary())
+    # Отправители без сущности в ответе (например, «минимальные») — одним запросом к БД
+    entity_cache.preload(getattr(message, 'sender_id', None) for message in messages)
+
+# ==================== СОСТОЯНИЕ ОБНОВЛЕНИЙ ====================
+from catchup import UpdatesTracker
+from telethon.tl.types import PeerChannel
+
+# pts/qts/date и pts каналов для догрузки через getDifference
+updates_tracker = UpdatesTracker(db)
+
+
+def input_channel_for(channel_id):
+    """InputChannel из кэша сущностей без запросов к Telegram (None если неизвестен)"""
+    row = entity_cache.get(utils.get_peer_id(PeerChannel(channel_id)))
+    peer = entity_cache.input_peer(row) if row else None
+    return utils.get_input_channel(peer) if peer is not None else None
+
+
+def input_peer_for(chat_id):
+    """InputPeer чата из кэша сущностей без запросов к Telegram (None если неизвестен)"""
+    row = entity_cache.get(chat_id)
+    return entity_cache.input_peer(row) if row else None
+
+# ==================== ПЛАНИРОВЩИК СИНХРОНИЗАЦИИ ====================
+from sync_planner import SyncPlanner
+
+# «Есть ли новое?» по top_message диалогов — один проход iter_dialogs вместо запроса истории на чат
+sync_planner = SyncPlanner(db, entity_cache=entity_cache, updates_tracker=updates_tracker)
+
+# ==================== TAKEOUT ====================
+from takeout import TakeoutManager
+
+# Общая takeout-сессия для первичной выгрузки больших чатов (TAKEOUT_BACKFILL)
+takeout_manager = TakeoutManager()
+
+# ==================== РАЗМЕР СТРАНИЦЫ ИСТОРИИ ====================
+from page_size import PageSizer
+
+# Размер страницы по чатам: по задержке ответа и доле служебных сообщений (до MESSAGES_PER_REQUEST)
+page_sizer = PageSizer(db, ceiling=CONFIG['MESSAGES_PER_REQUEST'])
+
+# Ошибки, при которых уменьшается страница (таймауты и сбои сервера, не FloodWait)
+PAGE_ERRORS = (asyncio.TimeoutError, ConnectionError, ServerError, TimedOutError)
+
+# ==================== ПАКЕТНАЯ ЗАПИСЬ ЖИВЫХ СООБЩЕНИЙ ====================
+from ingest import IngestPipeline
+
+ingest = IngestPipeline(
+    db, manager.broadcast,
+    max_batch=CONFIG['LIVE_BATCH_SIZE'],
+    max_delay=CONFIG['LIVE_BATCH_DELAY_MS'] / 1000
+)
+
+# pts обновлений подтверждаются только после записи пачки с их сообщениями
+updates_tracker.ingest = ingest
+
 # ==================== ОЧЕРЕДЬ ЗАДАЧ ====================
+# Классы приоритета задач (меньше — раньше)
+TASK_PRIORITIES = {
+    'live': 0,      # Догрузка после переподключения
+    'missed': 1,    # Догрузка пропущенных
+    'history': 2,   # Глубокая загрузка истории
+}
+
+# Приоритет по умолчанию для типа задачи
+TASK_TYPE_PRIORITY = {
+    'load_missed': 'missed',
+    'load_history': 'history',
+    'join_and_load': 'history',
+    'load_range': 'history',
+    'export_messages': 'history',
+}
+
+
+def parse_priority(priority):
+    """Преобразовать имя класса или число в класс приоритета (None если неверно)"""
+    if isinstance(priority, str) and priority in TASK_PRIORITIES:
+        return priority
+    if str(priority).isdigit():
+        for name, value in TASK_PRIORITIES.items():
+            if value == int(priority):
+                return name
+    return None
+
+
 class TaskQueue:
-    """Очередь задач для дозированной загрузки"""
+    """
+    Очередь задач для дозированной загрузки
+
+    Задачи выполняет пул из TASK_WORKERS воркеров. Все они делят общий
+    rate limiter аккаунта, поэтому параллельность не увеличивает нагрузку
+    на Telegram, а лишь распределяет её между чатами. Длинная загрузка
+    истории уступает воркер после каждой страницы, если в очереди ждут
+    другие задачи: задача возвращается в конец очереди с контрольной
+    точкой и продолжает с того же места (round-robin по страницам).
+
+    Ожидающие задачи выбираются по классу приоритета (live → missed →
+    history), внутри класса — в порядке постановки. Каждые
+    TASK_AGING_SECONDS ожидания повышают задачу на один класс, поэтому
+    глубокая загрузка истории не голодает.
+
+    Для пары (тип задачи, чат) одновременно существует не больше одной
+    активной задачи: повторный запрос присоединяется к ней (single-flight),
+    объединяя limit и повышая приоритет при необходимости.
+
+    Задачи, их статус и контрольные точки (после каждой страницы)
+    сохраняются в таблицу tasks, поэтому после перезапуска незавершённые
+    задачи продолжают с места остановки. В памяти хранятся только активные
+    задачи; завершённые читаются из БД и удаляются сверх
+    TASK_HISTORY_LIMIT или старше TASK_HISTORY_DAYS.
+    """
 
-    def __init__(self):
-        self.queue = asyncio.Queue()
-        self.results = {}
+    EVICT_EVERY = 50  # Завершённых задач между очистками истории
+
+    def __init__(self, workers=1, aging_seconds=300, store=None, history_limit=1000, history_days=7):
+        self.pending = []
+        self.results = {}  # task_id -> активная задача (pending / processing)
         self.processing = False
-        self.last_request_time = 0
-        self.request_interval = 1.0 / max(CONFIG['REQUESTS_PER_SECOND'], 0.1)
+        self.workers = max(int(workers), 1)
+        self.idle_workers = 0
+        self.aging_seconds = max(aging_seconds, 1)
+        self.checkpoints = {}  # task_id -> контрольная точка загрузки (offset_id, entity, ...)
+        self._enqueued = {}  # task_id -> (monotonic время постановки, порядковый номер)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self.inflight = {}  # (тип задачи, чат) -> task_id активной задачи
+        self.store = store
+        self.history_limit = history_limit
+        self.history_days = history_days
+        self._finished_since_evict = 0
+
+    def save(self, task):
+        """Сохранить задачу в БД (вместе с контрольной точкой)"""
+        if not self.store:
+            return
+        checkpoint = self.checkpoints.get(task['id'])
+        chat_key = None
+        if task['data'].get('chat_id') is not None:
+            chat_key = self.inflight_key(task['type'], task['data']['chat_id'], task['data'].get('range_start'))[1]
+        try:
+            self.store.save_task(task, chat_key=chat_key, checkpoint=self.checkpoint_state(checkpoint))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения задачи {task['id']}: {e}")
+
+    @staticmethod
+    def checkpoint_state(checkpoint):
+        """Сериализуемая часть контрольной точки (без объекта entity)"""
+        if not checkpoint:
+            return None
+        return {k: v for k, v in checkpoint.items() if k != 'entity'}
+
+    def on_page(self, task, checkpoint):
+        """Страница загружена: сохранить контрольную точку и решить, уступать ли воркер"""
+        task['progress'] = {'offset_id': checkpoint.get('offset_id'), 'loaded': checkpoint.get('loaded', 0)}
+        if self.store:
+            try:
+                self.store.save_task_checkpoint(task['id'], self.checkpoint_state(checkpoint))
+            except Exception as e:
+                logger.error(f"Ошибка сохранения контрольной точки {task['id']}: {e}")
+        return self.should_yield()
+
+    def restore(self):
+        """Восстановить незавершённые задачи из БД после перезапуска"""
+        if not self.store:
+            return 0
+        try:
+            tasks = self.store.get_active_tasks()
+        except Exception as e:
+            logger.error(f"Ошибка восстановления задач: {e}")
+            return 0
+
+        for task in tasks:
+            chat_key = task.pop('chat_key', None)
+            checkpoint = task.pop('checkpoint', None)
+            if task['priority'] not in TASK_PRIORITIES:
+                task['priority'] = TASK_TYPE_PRIORITY.get(task['type'], 'history')
+            task['status'] = 'pending'
+            if checkpoint:
+                self.checkpoints[task['id']] = checkpoint
+                task['progress'] = {'offset_id': checkpoint.get('offset_id'), 'loaded': checkpoint.get('loaded', 0)}
+            self.results[task['id']] = task
+            if chat_key is not None:
+                self.inflight[(task['type'], chat_key)] = task['id']
+            self.put(task)
+            self.save(task)
+
+        if tasks:
+            print(f"♻️ Восстановлено задач из БД: {len(tasks)}")
+        self.evict()
+        return len(tasks)
+
+    def evict(self):
+        """Удалить из БД старые завершённые задачи"""
+        self._finished_since_evict = 0
+        if not self.store:
+            return
+        try:
+            deleted = self.store.evict_tasks(keep=self.history_limit, max_age_days=self.history_days)
+            if deleted:
+                logger.info(f"Удалено завершённых задач из истории: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки истории задач: {e}")
+
+    def finish(self, task):
+        """Задача завершена: сохранить результат и убрать из памяти"""
+        self.checkpoints.pop(task['id'], None)
+        self.release(task)
+        self.save(task)
+        if self.store:
+            self.results.pop(task['id'], None)
+        self._finished_since_evict += 1
+        if self._finished_since_evict >= self.EVICT_EVERY:
+            self.evict()
+
+    @staticmethod
+    def inflight_key(task_type, chat_id, range_start=None):
+        """Ключ single-flight: тип задачи и нормализованный идентификатор чата (и диапазон ID)"""
+        key = str(chat_id).strip().lstrip('@').lower()
+        if range_start is not None:
+            key = f"{key}:{range_start}"
+        return (task_type, key)
+
+    def merge_into(self, task, priority_class, limit):
+        """Присоединить повторный запрос к активной задаче"""
+        # limit: 0/None — без ограничения, он поглощает любой конечный лимит
+        current = task['data'].get('limit', 0)
+        if current and limit and limit > current:
+            task['data']['limit'] = limit
+        elif current and not limit:
+            task['data'].pop('limit', None)
+
+        if TASK_PRIORITIES[priority_class] < TASK_PRIORITIES[task['priority']]:
+            task['priority'] = priority_class
+        task['attached'] = task.get('attached', 0) + 1
+        self.save(task)
+
+    async def add_task(self, task_id, task_type, priority=None, **kwargs):
+        """Добавить задачу в очередь
+
+        Returns:
+            ID задачи: новой, либо уже активной для того же чата и типа
+        """
+        priority_class = parse_priority(priority) or TASK_TYPE_PRIORITY.get(task_type, 'history')
+
+        key = None
+        if kwargs.get('chat_id') is not None:
+            key = self.inflight_key(task_type, kwargs['chat_id'], kwargs.get('range_start'))
+            existing = self.results.get(self.inflight.get(key))
+            if existing and existing['status'] in ('pending', 'processing'):
+                self.merge_into(existing, priority_class, kwargs.get('limit', 0))
+                logger.info(f"Задача {task_type} для {kwargs['chat_id']} уже активна: {existing['id']}")
+                return existing['id']
 
-    async def add_task(self, task_id, task_type, **kwargs):
-        """Добавить задачу в очередь"""
         task = {
             'id': task_id,
             'type': task_type,
             'data': kwargs,
             'status': 'pending',
+            'priority': priority_class,
             'created_at': datetime.now().isoformat()
         }
-        await self.queue.put(task)
         self.results[task_id] = task
+        if key:
+            self.inflight[key] = task_id
+        self.put(task)
+        self.save(task)
         return task_id
 
+    def release(self, task):
+        """Снять single-flight отметку завершённой задачи"""
+        if task['data'].get('chat_id') is None:
+            return
+        key = self.inflight_key(task['type'], task['data']['chat_id'], task['data'].get('range_start'))
+        if self.inflight.get(key) == task['id']:
+            del self.inflight[key]
+
+    def put(self, task):
+        """Поставить задачу в ожидание (в конец своего класса приоритета)"""
+        self._seq += 1
+        self._enqueued[task['id']] = (time.monotonic(), self._seq)
+        self.pending.append(task)
+        self._wakeup.set()
+
+    def effective_priority(self, task, now=None):
+        """Приоритет с учётом старения: класс минус число периодов ожидания"""
+        now = now or time.monotonic()
+        queued_at, seq = self._enqueued[task['id']]
+        waited = now - queued_at
+        return (TASK_PRIORITIES[task['priority']] - waited / self.aging_seconds, seq)
+
+    def ordered_pending(self):
+        """Ожидающие задачи в порядке выполнения"""
+        now = time.monotonic()
+        return sorted(self.pending, key=lambda t: self.effective_priority(t, now))
+
+    async def get(self):
+        """Взять следующую задачу с наивысшим приоритетом"""
+        while not self.pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        task = self.ordered_pending()[0]
+        self.pending.remove(task)
+        self._enqueued.pop(task['id'], None)
+        return task
+
+    def qsize(self):
+        """Число ожидающих задач"""
+        return len(self.pending)
+
+    def processing_count(self):
+        """Число выполняемых задач"""
+        return len(self.results) - len(self.pending)
+
+    def queue_position(self, task_id):
+        """Позиция задачи в очереди (1 — следующая), None если не ожидает"""
+        for position, task in enumerate(self.ordered_pending(), 1):
+            if task['id'] == task_id:
+                return position
+        return None
+
     def get_task_status(self, task_id):
         """Получить статус задачи"""
-        return self.results.get(task_id, {'error': 'Task not found'})
+        task = self.results.get(task_id)
+        if not task and self.store:
+            task = self.store.get_task(task_id)
+        if not task:
+            return {'error': 'Task not found'}
+        if task['status'] == 'pending':
+            return {**task, 'queue_position': self.queue_position(task_id)}
+        return task
+
+    def list_tasks(self, finished_limit=100):
+        """Задачи: выполняемые, затем ожидающие в порядке очереди, затем последние завершённые"""
+        processing = [t for t in self.results.values() if t['status'] == 'processing']
+        pending = [{**t, 'queue_position': position}
+                   for position, t in enumerate(self.ordered_pending(), 1)]
+        if self.store:
+            finished = self.store.get_finished_tasks(finished_limit)
+        else:
+            finished = sorted(
+                (t for t in self.results.values() if t['status'] not in ('pending', 'processing')),
+                key=lambda t: t.get('completed_at') or '', reverse=True
+            )[:finished_limit]
+        return processing + pending + finished
+
+    def pending_order(self):
+        """Краткий порядок ожидающих задач для /queue"""
+        now = time.monotonic()
+        return [{
+            'task_id': t['id'],
+            'type': t['type'],
+            'chat_id': t['data'].get('chat_id'),
+            'priority': t['priority'],
+            'effective_priority': round(self.effective_priority(t, now)[0], 2),
+            'waiting_seconds': round(now - self._enqueued[t['id']][0], 1)
+        } for t in self.ordered_pending()]
+
+    def should_yield(self):
+        """Нужно ли уступить воркер: другие задачи ждут, а свободных воркеров нет"""
+        return self.qsize() > 0 and self.idle_workers == 0
 
     async def process_tasks(self, client):
-        """Обработчик задач из очереди"""
+        """Запуск пула обработчиков задач"""
+        if self.processing:
+            return
         self.processing = True
-        print("🔄 Обработчик задач запущен")
+        print(f"🔄 Обработчик задач запущен (воркеров: {self.workers})")
+
+        await asyncio.gather(*(self.worker(client, n) for n in range(self.workers)))
 
+    async def worker(self, client, worker_id):
+        """Воркер: берёт задачи из очереди, пока очередь не остановлена"""
         while self.processing:
+            self.idle_workers += 1
             try:
-                task = await asyncio.wait_for(self.queue.get(), timeout=1.0)
-                print(f"📦 Получена задача {task['id']}: {task['type']}")
+                task = await asyncio.wait_for(self.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                self.idle_workers -= 1
 
-                current_time = time.time()
-                time_since_last = current_time - self.last_request_time
-                if time_since_last < self.request_interval:
-                    await asyncio.sleep(self.request_interval - time_since_last)
+            try:
+                print(f"📦 Воркер {worker_id}: задача {task['id']}: {task['type']}")
 
                 task['status'] = 'processing'
-                task['started_at'] = datetime.now().isoformat()
-                print(f"▶️  Начато выполнение задачи {task['id']}")
+                task.setdefault('started_at', datetime.now().isoformat())
+                self.save(task)
+
+                # Аккаунт, за которым закреплён чат задачи (без аккаунтов — клиент воркера)
+                chat_id = task['data'].get('chat_id')
+                account = account_pool.assign(chat_id) if task['type'] in SHARDED_TASK_TYPES else account_pool.primary
+                task_client = account.client if account is not None else client
+                if account is not None:
+                    task['account'] = account.name
+                lease = current_lease.set((account, chat_id) if account is not None else None)
 
                 try:
-                    if task['type'] == 'load_history':
+                    finished = True
+                    if task['type'] == 'load_history' and task['data'].get('ranges', 0) > 1:
+                        print(f"🧩 Разбиение истории {task['data'].get('chat_id')} на диапазоны...")
+                        await self.process_split_history(task_client, task)
+                    elif task['type'] == 'load_history':
                         print(f"📚 Загрузка истории для {task['data'].get('chat_id')}...")
-                        await self.process_load_history(client, task)
+                        finished = await self.process_load_history(task_client, task)
+                    elif task['type'] == 'load_range':
+                        finished = await self.process_load_range(task_client, task)
                     elif task['type'] == 'join_and_load':
                         print(f"📥 Вступление и загрузка для {task['data'].get('chat_id')}...")
-                        await self.process_join_and_load(client, task)
+                        finished = await self.process_join_and_load(task_client, task)
                     elif task['type'] == 'load_missed':
                         print(f"🔍 Догрузка пропущенных для {task['data'].get('chat_id')}...")
-                        await self.process_load_missed(client, task)
-
-                    task['status'] = 'completed'
-                    task['completed_at'] = datetime.now().isoformat()
-                    print(f"✅ Задача {task['id']} завершена")
-
-                    await manager.broadcast({
-                        'type': 'task_completed',
-                        'task': task
-                    })
+                        await self.process_load_missed(task_client, task)
+                    elif task['type'] == 'export_messages':
+                        print(f"💾 Экспорт сообщений ({task['data']['format']})...")
+                        await self.process_export(task)
+
+                    if not finished:
+                        # Уступаем очередь: продолжим с контрольной точки
+                        task['status'] = 'pending'
+                        self.put(task)
+                        self.save(task)
+                    else:
+                        task['status'] = 'completed'
+                        task['completed_at'] = datetime.now().isoformat()
+                        if account is not None:
+                            account.stats['tasks'] += 1
+                        self.finish(task)
+                        print(f"✅ Задача {task['id']} завершена")
+
+                        await manager.broadcast({
+                            'type': 'task_completed',
+                            'task': task
+                        })
+                except AccountUnavailableError as e:
+                    # Аккаунт снят с задач: продолжим с контрольной точки другим аккаунтом
+                    # (сущность чата с access_hash прежнего аккаунта не переносится)
+                    self.checkpoints.get(task['id'], {}).pop('entity', None)
+                    task['status'] = 'pending'
+                    self.put(task)
+                    self.save(task)
+                    print(f"🔀 Задача {task['id']} передана другому аккаунту: {e}")
                 except Exception as e:
                     task['status'] = 'failed'
                     task['error'] = str(e)
                     task['completed_at'] = datetime.now().isoformat()
+                    self.finish(task)
                     print(f"❌ Ошибка выполнения задачи {task['id']}: {e}")
+                finally:
+                    current_lease.reset(lease)
 
-                self.last_request_time = time.time()
-                self.queue.task_done()
-
-            except asyncio.TimeoutError:
-                continue
             except Exception as e:
                 print(f"❌ Ошибка обработчика задач: {e}")
 
+    async def process_export(self, task):
+        """Фоновый экспорт в файл data/exports (прогресс — через WebSocket)"""
+        data = task['data']
+        filters = {
+            'chat_id': data.get('filter_chat_id'),
+            'date_from': data.get('date_from'),
+            'date_to': data.get('date_to')
+        }
+        limit = data.get('limit', 0)
+        total = await asyncio.to_thread(db.count_export_rows, **filters)
+        if limit:
+            total = min(total, limit)
+
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+        if data['format'] == PARQUET_FORMAT:
+            name = f"{task['id']}_{parquet_filename(filters['chat_id'])}"
+        else:
+            name = f"{task['id']}_{export_filename(data['format'], filters['chat_id'], data.get('gzip', False))}"
+        loop = asyncio.get_running_loop()
+
+        def report(rows, size):
+            task['progress'] = {'rows': rows, 'total': total, 'bytes': size,
+                                'percent': round(rows * 100 / total, 1) if total else 100.0}
+            return {'type': 'export_progress', 'task_id': task['id'], **task['progress']}
+
+        def progress(rows, size):
+            asyncio.run_coroutine_threadsafe(manager.broadcast(report(rows, size)), loop)
+
+        if data['format'] == PARQUET_FORMAT:
+            result = await asyncio.to_thread(
+                write_parquet_archive, db, os.path.join(EXPORTS_DIR, name),
+                progress=progress, limit=limit, **filters
+            )
+        else:
+            result = await asyncio.to_thread(
+                write_export, db, os.path.join(EXPORTS_DIR, name), data['format'],
+                compress=data.get('gzip', False), progress=progress, limit=limit, **filters
+            )
+        await manager.broadcast({**report(result['rows'], result['size']), 'file': name})
+        task['result'] = {**result, 'file': name, 'url': f"/exports/{name}"}
+        print(f"💾 Экспорт {name}: {result['rows']} сообщений, {result['size']} байт")
+        cleanup_old_exports()
+
+    @staticmethod
+    async def open_takeout(client, task):
+        """Takeout-клиент для задачи с флагом takeout (None — обычный путь)
+
+        Takeout-сессия открывается только у основного аккаунта.
+        """
+        if not task['data'].get('takeout') or not lease_is_primary():
+            return None
+        return await takeout_manager.open(client)
+
     async def process_load_history(self, client, task):
-        """Обработка задачи загрузки истории"""
+        """Обработка задачи загрузки истории (False — задача уступила очередь)"""
         chat_id = task['data']['chat_id']
         limit = task['data'].get('limit', 0)
+        checkpoint = self.checkpoints.setdefault(task['id'], {})
 
-        result = await load_chat_history_with_rate_limit(
-            client, chat_id, limit=limit, task_id=task['id']
-        )
+        takeout = await self.open_takeout(client, task)
+        try:
+            result = await load_chat_history_with_rate_limit(
+                client, chat_id, limit=limit, task_id=task['id'],
+                checkpoint=checkpoint, should_yield=lambda: self.on_page(task, checkpoint),
+                takeout=takeout
+            )
+        finally:
+            takeout_manager.release(takeout)
+        if result.get('yielded'):
+            return False
         task['result'] = result
+        return True
+
+    async def process_split_history(self, client, task):
+        """Разбить историю чата на диапазоны ID и поставить задачу на каждый"""
+        chat_id = task['data']['chat_id']
+        ranges = await split_history_ranges(client, chat_id, task['data']['ranges'])
+
+        task_ids = []
+        extra = {'takeout': True} if task['data'].get('takeout') else {}
+        for item in ranges:
+            task_ids.append(await self.add_task(
+                task_id=str(uuid.uuid4())[:8], task_type='load_range', priority=task['priority'],
+                chat_id=chat_id, range_start=item['range_start'], range_end=item['range_end'], **extra
+            ))
+        task['result'] = {'chat_id': chat_id, 'ranges': len(ranges), 'task_ids': task_ids}
+
+    async def process_load_range(self, client, task):
+        """Обработка задачи загрузки диапазона ID (False — задача уступила очередь)"""
+        checkpoint = self.checkpoints.setdefault(task['id'], {})
+
+        takeout = await self.open_takeout(client, task)
+        try:
+            result = await load_chat_range(
+                client, task['data']['chat_id'], task['data']['range_start'], task['data']['range_end'],
+                checkpoint=checkpoint, should_yield=lambda: self.on_page(task, checkpoint),
+                takeout=takeout
+            )
+        finally:
+            takeout_manager.release(takeout)
+        if result.get('yielded'):
+            return False
+        task['result'] = result
+        if result.get('error'):
+            task['error'] = result['error']
+        return True
 
     async def process_join_and_load(self, client, task):
-        """Обработка задачи вступления и загрузки"""
-        chat_identifier = task['data']['chat_id']
-        chat = await join_chat(client, chat_identifier)
+        """Обработка задачи вступления и загрузки (False — задача уступила очередь)"""
+        checkpoint = self.checkpoints.setdefault(task['id'], {})
+
+        chat = checkpoint.get('entity')
+        if chat is None:
+            chat_identifier = task['data']['chat_id']
+            chat = await join_chat(client, chat_identifier)
 
         if chat:
+            checkpoint['entity'] = chat
             limit = task['data'].get('limit', 0)
-            result = await load_chat_history_with_rate_limit(
-                client, chat.id, limit=limit, task_id=task['id']
-            )
+            takeout = await self.open_takeout(client, task)
+            try:
+                result = await load_chat_history_with_rate_limit(
+                    client, peer_bare_id(chat), limit=limit, task_id=task['id'],
+                    checkpoint=checkpoint, should_yield=lambda: self.on_page(task, checkpoint),
+                    takeout=takeout
+                )
+            finally:
+                takeout_manager.release(takeout)
+            if result.get('yielded'):
+                return False
             task['result'] = {
-                'chat': {'id': chat.id, 'title': getattr(chat, 'title', '')},
+                'chat': {'id': peer_bare_id(chat), 'title': result.get('chat_title', '')},
                 'history': result
             }
         else:
             task['error'] = 'Failed to join chat'
+        return True
 
     async def process_load_missed(self, client, task):
         """Обработка задачи догрузки пропущенных"""
@@ -357,25 +969,170 @@ class TaskQueue:
             client, chat_id, since_date=since_date,
             limit=CONFIG['MISSED_LIMIT_PER_CHAT'], task_id=task['id']
         )
+        # Задача из плана синхронизации: чат догружен до top_message диалога
+        if result.get('complete'):
+            sync_planner.mark_synced(chat_id, task['data'].get('top_message'))
         task['result'] = result
 
     def stop(self):
         """Остановка обработчика задач"""
         self.processing = False
 
-task_queue = TaskQueue()
+task_queue = TaskQueue(
+    workers=CONFIG['TASK_WORKERS'],
+    aging_seconds=CONFIG['TASK_AGING_SECONDS'],
+    store=db,
+    history_limit=CONFIG['TASK_HISTORY_LIMIT'],
+    history_days=CONFIG['TASK_HISTORY_DAYS']
+)
+# HTTP воркеры не выполняют задачи — их восстанавливает ingest-процесс;
+# у реплики бывают только фоновые экспорты
+if PROCESS_ROLE != 'api':
+    task_queue.restore()
+
+
+async def enqueue_sync_plan(plan, missed=True, history=False, kinds=None, priority=None):
+    """Поставить задачи по плану синхронизации
+
+    Args:
+        plan: Результат sync_planner.plan()
+        missed: Ставить load_missed для чатов с новыми сообщениями
+        history: Ставить load_history для незагруженных чатов
+        kinds: Типы чатов ('user', 'group', 'channel'), None — все
+        priority: Класс приоритета задач
+
+    Returns:
+        (ID задач, сколько присоединилось к уже активным)
+    """
+    task_ids = []
+    attached = 0
+    for chat in plan['chats']:
+        if kinds and chat['kind'] not in kinds:
+            continue
+        jobs = []
+        if missed and 'missed' in chat['actions']:
+            jobs.append(('load_missed', {'top_message': chat['top_message']}))
+        if history and 'history' in chat['actions']:
+            extra = {'takeout': True} if CONFIG['TAKEOUT_BACKFILL'] else {}
+            jobs.append(('load_history', {'limit': CONFIG['HISTORY_LIMIT_PER_CHAT'], **extra}))
+        for task_type, extra in jobs:
+            task_id = str(uuid.uuid4())[:8]
+            queued_id = await task_queue.add_task(
+                task_id=task_id, task_type=task_type, priority=priority,
+                chat_id=chat['chat_id'], **extra
+            )
+            if queued_id != task_id:
+                attached += 1
+            task_ids.append(queued_id)
+    return task_ids, attached
+
+
+async def enqueue_scheduled_sync(chat_id, top_message=None):
+    """Задача догрузки чата по расписанию синхронизации"""
+    extra = {'top_message': top_message} if top_message else {}
+    return await task_queue.add_task(
+        task_id=str(uuid.uuid4())[:8], task_type='load_missed', chat_id=chat_id, **extra
+    )
+
+# ==================== РАСПИСАНИЕ СИНХРОНИЗАЦИИ ====================
+from sync_scheduler import SyncScheduler
+
+# Отслеживаемые чаты проверяются с интервалом по их активности
+sync_scheduler = SyncScheduler(
+    db, sync_planner,
+    min_interval=CONFIG['SYNC_MIN_INTERVAL'],
+    max_interval=CONFIG['SYNC_MAX_INTERVAL'],
+    budget_share=CONFIG['SYNC_BUDGET_PERCENT'] / 100,
+    rate=CONFIG['REQUESTS_PER_SECOND']
+)
 
 # ==================== FASTAPI ПРИЛОЖЕНИЕ ====================
 from telethon.tl.functions.channels import JoinChannelRequest
 from telethon.tl.functions.messages import ImportChatInviteRequest
 
+# ==================== РАЗДЕЛЕНИЕ ПРОЦЕССОВ ====================
+from ipc import (EventHub, IngestLink, IngestPayloadTooLargeError, IngestReplyTooLargeError,
+                 IngestUnavailableError, asgi_request)
+from starlette.background import BackgroundTask
+from replica import Replicator
+
+# Запросы, которым нужны Telegram клиент или очередь задач: HTTP воркер
+# пересылает их ingest-процессу, остальные читают БД сам (WAL)
+INGEST_PATH_PREFIXES = (
+    '/load', '/task/', '/tasks', '/queue', '/chat_status/', '/sync/', '/dialogs',
+    '/start_worker', '/media/', '/config', '/restart', '/telegram_status', '/qr_login',
+    '/auth/', '/clear_database', '/clear_chat/', '/export/jobs'
+)
+
+# Запросы реплики, которые не меняют архив (фоновый экспорт)
+REPLICA_ALLOWED_PREFIXES = ('/export/jobs',)
+
+# Запись в архив в обход журнала изменений источника: на реплике запрещена
+# (импортированные сообщения не дошли бы до источника и расходились бы с ним)
+REPLICA_DENIED_PREFIXES = ('/import',)
+
+# IPC канал: сервер в ingest-процессе, клиент в каждом HTTP воркере
+event_hub = EventHub() if PROCESS_ROLE == 'ingest' else None
+ingest_link = IngestLink(on_event=manager.broadcast) if PROCESS_ROLE == 'api' else None
+
+
+# Реплика для чтения: архив повторяет журнал изменений источника
+replicator = Replicator(
+    db, CONFIG['REPLICA_OF'], api_key=CONFIG['REPLICA_API_KEY'],
+    interval=CONFIG['REPLICA_POLL_SECONDS']
+) if PROCESS_ROLE == 'replica' else None
+
+
+def forwarded_to_ingest(path: str, query: str = '') -> bool:
+    """Запрос выполняется ingest-процессом (только для HTTP воркера)"""
+    if ingest_link is None:
+        return False
+    if path == '/export':
+        # Фоновый экспорт ставится в очередь ingest-процесса, потоковый — здесь
+        background = urllib.parse.parse_qs(query).get('background', [''])[-1]
+        return background.lower() in ('1', 'true', 'yes', 'on')
+    return path == '/' or path.startswith(INGEST_PATH_PREFIXES)
+
+
+async def start_event_hub():
+    """Ingest-процесс: IPC канал для HTTP воркеров"""
+    event_hub.register('http', lambda args: asgi_request(app, **args))
+    manager.relay = event_hub.publish
+    await event_hub.start()
+
+
+async def shutdown_ingest():
+    """Остановка обработчика задач и запись буфера живых сообщений
+
+    Общая для lifespan обычного режима и ingest-процесса раздельного режима
+    (telegrab.py), где lifespan приложения не выполняется.
+    """
+    task_queue.stop()
+    await ingest.stop()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
     print("🚀 Запуск Telegrab API...")
+    if ingest_link:
+        ingest_link.start()
+    else:
+        cleanup_old_exports()
+    if replicator:
+        replicator.start()
+        # Telegram клиента нет: обработчик задач выполняет только экспорты
+        asyncio.create_task(task_queue.process_tasks(None))
     yield
     print("🛑 Остановка Telegrab API...")
-    task_queue.stop()
+    if ingest_link:
+        await ingest_link.stop()
+        return
+    if replicator:
+        replicator.stop()
+        task_queue.stop()
+        return
+    await shutdown_ingest()
 
 app = FastAPI(
     title="Telegrab API",
@@ -392,6 +1149,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def forward_to_ingest(request, call_next):
+    """HTTP воркер: запросы к Telegram и очереди задач выполняет ingest-процесс"""
+    if (replicator and request.method not in ('GET', 'HEAD')
+            and request.url.path.startswith(INGEST_PATH_PREFIXES + REPLICA_DENIED_PREFIXES)
+            and not request.url.path.startswith(REPLICA_ALLOWED_PREFIXES)):
+        return JSONResponse({'detail': 'Реплика только для чтения: задачи, настройки и импорт — на основном узле'},
+                            status_code=403)
+    if not forwarded_to_ingest(request.url.path, request.url.query):
+        return await call_next(request)
+    try:
+        reply = await ingest_link.call('http', {
+            'method': request.method,
+            'path': request.url.path,
+            'query_string': request.url.query,
+            'headers': [[name, value] for name, value in request.headers.items()],
+            'body': base64.b64encode(await request.body()).decode('ascii')
+        })
+    except IngestUnavailableError as e:
+        return JSONResponse({'detail': str(e)}, status_code=503)
+    except IngestReplyTooLargeError as e:
+        return JSONResponse({'detail': f"Ответ ingest-процесса слишком велик: {e}"}, status_code=502)
+    except IngestPayloadTooLargeError as e:
+        return JSONResponse({'detail': f"Запрос слишком велик: {e}"}, status_code=413)
+    headers = {name: value for name, value in reply['headers'] if name.lower() != 'content-length'}
+    if 'file' in reply:
+        # Большое тело ingest-процесс записал в файл: отдаём и удаляем
+        return FileResponse(reply['file'], status_code=reply['status'], headers=headers,
+                            background=BackgroundTask(os.remove, reply['file']))
+    return Response(content=base64.b64decode(reply['body']), status_code=reply['status'], headers=headers)
+
 # ==================== СТАТИЧЕСКИЕ ФАЙЛЫ ====================
 # Монтируем директорию static для веб-интерфейса
 import os
@@ -412,7 +1200,7 @@ async def root():
         'status': 'ok',
         'service': 'Telegrab API v4.0',
         'timestamp': datetime.now().isoformat(),
-        'queue_size': task_queue.queue.qsize(),
+        'queue_size': task_queue.qsize(),
         'websocket_endpoint': '/ws',
         'docs': '/docs'
     }
@@ -420,10 +1208,17 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Проверка работоспособности"""
-    return {
+    health = {
         'status': 'healthy',
+        'role': PROCESS_ROLE,
+        'pid': os.getpid(),
         'timestamp': datetime.now().isoformat()
     }
+    if ingest_link:
+        health['ingest_connected'] = ingest_link.connected
+    if replicator:
+        health['replication'] = replicator.lag()
+    return health
 
 @app.get("/stats")
 async def get_stats(api_key: str = Depends(get_api_key)):
@@ -506,7 +1301,14 @@ async def get_dialogs(api_key: str = Depends(get_api_key), limit: int = 100, inc
         # Используем asyncio.wait_for для таймаута
         try:
             async with asyncio.timeout(30):  # 30 секунд таймаут
+                await rate_limiter.acquire('dialogs')
+                index = 0
                 async for dialog in tg_client.client.iter_dialogs(limit=limit):
+                    # Каждые 100 диалогов Telethon запрашивает следующую страницу
+                    index += 1
+                    if index % 100 == 0:
+                        await rate_limiter.acquire('dialogs')
+
                     # Фильтруем по типу если нужно
                     if include_private:
                         # Все диалоги включая личные
@@ -585,6 +1387,33 @@ async def get_messages(
     total = db.get_messages_count(chat_id=chat_id, search=search)
     return {'count': total, 'messages': messages}
 
+@app.get("/changes")
+async def get_changes(
+    since: int = 0,
+    limit: int = 500,
+    full: bool = False,
+    api_key: str = Depends(get_api_key)
+):
+    """Изменения сообщений после курсора since (delta-синхронизация)
+
+    Клиент хранит next и передаёт его в следующем запросе. reset=true —
+    журнал после курсора уже очищен (CHANGES_RETENTION_DAYS) или БД
+    пересоздана: нужна полная перезагрузка данных.
+    full: полные записи сообщений (raw_data, meta, files) — для реплик
+    """
+    if since < 0:
+        raise HTTPException(status_code=400, detail="since должен быть неотрицательным")
+    return db.get_changes(since=since, limit=min(max(limit, 1), 5000), full=full)
+
+@app.get("/replica/snapshot")
+async def get_replica_snapshot(
+    after: int = 0,
+    limit: int = 500,
+    api_key: str = Depends(get_api_key)
+):
+    """Страница полного снимка сообщений для начальной загрузки реплики"""
+    return db.get_snapshot(after=max(after, 0), limit=min(max(limit, 1), 5000))
+
 @app.get("/search")
 async def search_messages(
     q: str,
@@ -599,10 +1428,21 @@ async def search_messages(
     return {'query': q, 'count': len(messages), 'results': messages}
 
 @app.post("/load")
-async def load_chat(api_key: str = Depends(get_api_key), chat_id: str = None, limit: int = 0, join: bool = False, missed: bool = False):
-    """Загрузить историю чата"""
+async def load_chat(api_key: str = Depends(get_api_key), chat_id: str = None, limit: int = 0, join: bool = False,
+                    missed: bool = False, priority: Optional[str] = None, ranges: int = 0,
+                    takeout: Optional[bool] = None):
+    """Загрузить историю чата
+
+    priority: класс приоритета (live, missed, history или 0-2),
+    по умолчанию определяется типом задачи
+    ranges: разбить историю на N диапазонов ID, загружаемых параллельно
+    (только полная загрузка истории, без limit)
+    takeout: загружать через takeout-сессию (по умолчанию TAKEOUT_BACKFILL)
+    """
     if not chat_id:
         raise HTTPException(status_code=400, detail="Не указан chat_id")
+    if priority is not None and not parse_priority(priority):
+        raise HTTPException(status_code=400, detail=f"Неверный priority. Допустимо: {', '.join(TASK_PRIORITIES)}")
     
     task_id = str(uuid.uuid4())[:8]
 
@@ -616,14 +1456,32 @@ async def load_chat(api_key: str = Depends(get_api_key), chat_id: str = None, li
     task_data = {'chat_id': chat_id}
     if limit > 0:
         task_data['limit'] = limit
+    elif ranges > 1 and task_type == 'load_history':
+        task_data['ranges'] = ranges
+    if task_type != 'load_missed' and (CONFIG['TAKEOUT_BACKFILL'] if takeout is None else takeout):
+        task_data['takeout'] = True
 
-    await task_queue.add_task(task_id=task_id, task_type=task_type, **task_data)
+    queued_id = await task_queue.add_task(task_id=task_id, task_type=task_type, priority=priority, **task_data)
+
+    if queued_id != task_id:
+        # Такая задача уже выполняется или ждёт — присоединяемся к ней
+        task = task_queue.results[queued_id]
+        return {
+            'task_id': queued_id,
+            'status': 'attached',
+            'task_status': task['status'],
+            'message': 'Задача для этого чата уже в очереди',
+            'priority': task['priority'],
+            'limit': task['data'].get('limit', 0),
+            'queue_position': task_queue.queue_position(queued_id)
+        }
 
     return {
         'task_id': task_id,
         'status': 'queued',
         'message': 'Задача добавлена в очередь',
-        'queue_position': task_queue.queue.qsize()
+        'priority': task_queue.results[task_id]['priority'],
+        'queue_position': task_queue.queue_position(task_id)
     }
 
 @app.get("/task/{task_id}")
@@ -634,9 +1492,9 @@ async def get_task_status(task_id: str, api_key: str = Depends(get_api_key)):
 @app.get("/queue")
 async def get_queue_status(api_key: str = Depends(get_api_key)):
     """Статус очереди"""
-    # Считаем все активные задачи (ожидающие + обрабатываемые)
-    pending_count = sum(1 for t in task_queue.results.values() if t.get('status') == 'pending')
-    processing_count = sum(1 for t in task_queue.results.values() if t.get('status') == 'processing')
+    # Активные задачи (ожидающие + обрабатываемые)
+    pending_count = task_queue.qsize()
+    processing_count = task_queue.processing_count()
     total_active = pending_count + processing_count
 
     return {
@@ -644,7 +1502,20 @@ async def get_queue_status(api_key: str = Depends(get_api_key)):
         'is_processing': task_queue.processing,
         'requests_per_second': CONFIG['REQUESTS_PER_SECOND'],
         'pending': pending_count,
-        'processing_count': processing_count
+        'processing_count': processing_count,
+        'order': task_queue.pending_order(),
+        'history': db.count_tasks_by_status(),
+        'ingest': ingest.get_stats(),
+        'entity_cache': entity_cache.get_stats(),
+        'updates': updates_tracker.get_stats(),
+        'sync': sync_planner.get_stats(),
+        'scheduler': sync_scheduler.get_stats(),
+        'takeout': takeout_manager.get_stats(),
+        'pages': page_sizer.get_stats(),
+        'accounts': account_pool.get_stats(),
+        'ipc': event_hub.get_stats() if event_hub else None,
+        'replica': replicator.get_stats() if replicator else None,
+        'rate_limiter': rate_limiter.get_stats()
     }
 
 @app.get("/chat_status/{chat_id}")
@@ -654,41 +1525,70 @@ async def get_chat_status(chat_id: int, api_key: str = Depends(get_api_key)):
     last_date = db.get_last_message_date_in_chat(chat_id)
     if last_date:
         status['last_saved_message_date'] = last_date.isoformat()
+    ranges = db.get_loading_ranges(chat_id)
+    if ranges:
+        status['ranges'] = ranges
     return status
 
+async def build_sync_plan(limit=None, continue_history=False):
+    """План синхронизации для endpoint'ов (нужен подключённый клиент)"""
+    if not tg_client.client or not tg_client.client.is_connected():
+        raise HTTPException(status_code=503, detail="Telegram клиент не подключён")
+    try:
+        return await sync_planner.plan(
+            tg_client.client, rate_limiter.acquire,
+            limit=limit or None, continue_history=continue_history
+        )
+    except FloodWaitError as e:
+        raise HTTPException(status_code=429, detail=f"Слишком много запросов. Повторите через {e.seconds} секунд")
+    except RPCError as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка Telegram API: {str(e)}")
+
+@app.get("/sync/plan")
+async def get_sync_plan(api_key: str = Depends(get_api_key), limit: int = 0,
+                        continue_history: bool = False, only_actions: bool = True):
+    """План синхронизации без постановки задач (dry-run)
+
+    limit: максимум диалогов (0 — все)
+    continue_history: планировать догрузку истории для не полностью загруженных чатов
+    only_actions: показывать только чаты, для которых нужны задачи
+    """
+    plan = await build_sync_plan(limit=limit, continue_history=continue_history)
+    if only_actions:
+        plan['chats'] = [chat for chat in plan['chats'] if chat['actions']]
+    return plan
+
+@app.get("/sync/schedule")
+async def get_sync_schedule(api_key: str = Depends(get_api_key)):
+    """Расписание синхронизации отслеживаемых чатов"""
+    schedule = sorted(sync_scheduler.schedule(), key=lambda row: row['next_run_at'])
+    return {'count': len(schedule), 'schedule': schedule, 'stats': sync_scheduler.get_stats()}
+
 @app.post("/load_missed_all")
 async def load_missed_all(api_key: str = Depends(get_api_key)):
-    """Догрузить пропущенные для всех чатов"""
-    chats = db.get_chats_with_messages()
-    task_ids = []
-
-    for chat in chats[:10]:
-        task_id = str(uuid.uuid4())[:8]
-        await task_queue.add_task(task_id=task_id, task_type='load_missed', chat_id=chat['chat_id'])
-        task_ids.append(task_id)
+    """Догрузить пропущенные для всех чатов, в которых есть новые сообщения"""
+    plan = await build_sync_plan()
+    task_ids, attached = await enqueue_sync_plan(plan, missed=True)
 
     return {
         'task_ids': task_ids,
-        'message': f'Задачи созданы для {len(task_ids)} чатов',
-        'total_chats': len(chats)
+        'message': f'Задачи созданы для {len(task_ids) - attached} чатов, уже в очереди: {attached}',
+        'attached': attached,
+        'total_chats': plan['summary']['dialogs'],
+        'plan': plan['summary']
     }
 
 @app.get("/tasks")
 async def get_tasks(api_key: str = Depends(get_api_key)):
     """Получить список всех задач"""
     return {
-        'tasks': list(task_queue.results.values())
+        'tasks': task_queue.list_tasks()
     }
 
 @app.post("/export")
-async def export_messages(api_key: str = Depends(get_api_key), limit: int = 10000):
-    """Экспорт сообщений в JSON"""
-    messages = db.get_messages(limit=limit)
-    return {
-        'exported_at': datetime.now().isoformat(),
-        'count': len(messages),
-        'messages': messages
-    }
+async def export_messages(api_key: str = Depends(get_api_key), limit: int = 0):
+    """Экспорт сообщений в JSON (потоково, limit=0 — все сообщения)"""
+    return export_response('json', limit=limit)
 
 @app.post("/clear_database")
 async def clear_database(api_key: str = Depends(get_api_key)):
@@ -704,146 +1604,195 @@ async def clear_database(api_key: str = Depends(get_api_key)):
 # ENDPOINTS ДЛЯ УПРАВЛЕНИЯ БД (ИМПОРТ/ЭКСПОРТ/ОПТИМИЗАЦИЯ)
 # ============================================================
 
+from export_stream import (EXPORT_FORMATS, EXPORTS_DIR, cleanup_exports, export_filename, list_exports,
+                           normalize_format, stream_export, write_export)
+from export_parquet import PARQUET_AVAILABLE, PARQUET_FORMAT, parquet_filename, write_parquet_archive
+from import_stream import StreamImporter
+
+
+def parse_export_dates(date_from: Optional[str], date_to: Optional[str]) -> tuple:
+    """Границы дат экспорта: date_to без времени включает весь день"""
+    try:
+        if date_from:
+            date_from = datetime.fromisoformat(date_from).isoformat()
+        if date_to:
+            end = datetime.fromisoformat(date_to)
+            if len(date_to) == 10:
+                end += timedelta(days=1)
+            date_to = end.isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Даты в формате ISO: 2024-01-31 или 2024-01-31T12:00:00")
+    return date_from, date_to
+
+
+def export_response(format: str, chat_id: int = None, date_from: str = None, date_to: str = None,
+                    limit: int = 0, compress: bool = False) -> StreamingResponse:
+    """Потоковый ответ экспорта (генератор читает курсор БД в пуле потоков)"""
+    media_type = 'application/gzip' if compress else EXPORT_FORMATS[format][1]
+    filename = export_filename(format, chat_id, compress)
+    return StreamingResponse(
+        stream_export(db, format, compress=compress, chat_id=chat_id,
+                      date_from=date_from, date_to=date_to, limit=max(limit, 0)),
+        media_type=media_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+def cleanup_old_exports():
+    """Удалить файлы экспорта старше EXPORT_RETENTION_HOURS"""
+    removed = cleanup_exports(CONFIG['EXPORT_RETENTION_HOURS'])
+    if removed:
+        logger.info(f"Удалено старых экспортов: {removed}")
+
+
+async def start_export_job(format: str, chat_id: int = None, date_from: str = None,
+                           date_to: str = None, limit: int = 0, compress: bool = False) -> Dict:
+    """Поставить фоновый экспорт в очередь задач"""
+    task_id = str(uuid.uuid4())[:8]
+    # Чат фильтра — не chat_id задачи: экспорты одного чата не объединяются
+    task_data = {'format': format, 'gzip': compress, 'limit': max(limit, 0)}
+    for key, value in (('filter_chat_id', chat_id), ('date_from', date_from), ('date_to', date_to)):
+        if value:
+            task_data[key] = value
+    await task_queue.add_task(task_id=task_id, task_type='export_messages', **task_data)
+    return {
+        'task_id': task_id,
+        'status': 'queued',
+        'message': 'Экспорт поставлен в очередь; прогресс — WebSocket export_progress, файл — /exports/{file}'
+    }
+
+
 @app.get("/export")
 async def export_messages(
-    format: str = "json",
+    format: str = "ndjson",
     chat_id: int = None,
-    limit: int = 10000,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 0,
+    gzip: bool = False,
+    background: bool = False,
     api_key: str = Depends(get_api_key)
 ):
-    """Экспорт сообщений в различных форматах"""
-    try:
-        messages = db.get_messages(chat_id=chat_id, limit=limit)
-        
-        if format == "raw":
-            # RAW экспорт - полные данные из messages_raw
-            raw_messages = []
-            for msg in messages:
-                raw_data = db.get_message_raw(msg.get('chat_id'), msg.get('message_id'))
-                if raw_data:
-                    raw_messages.append(raw_data)
-            return {
-                'exported_at': datetime.now().isoformat(),
-                'count': len(raw_messages),
-                'format': 'raw',
-                'messages': raw_messages
-            }
-        elif format == "csv":
-            # CSV экспорт (возвращаем как JSON для конвертации на клиенте)
-            csv_data = []
-            for msg in messages:
-                csv_data.append({
-                    'chat_id': msg.get('chat_id'),
-                    'chat_title': msg.get('chat_title'),
-                    'message_id': msg.get('message_id'),
-                    'date': msg.get('message_date'),
-                    'sender': msg.get('sender_name'),
-                    'text': msg.get('text_preview'),
-                    'has_media': msg.get('has_media'),
-                    'media_type': msg.get('media_type'),
-                    'views': msg.get('views')
-                })
-            return {
-                'exported_at': datetime.now().isoformat(),
-                'count': len(csv_data),
-                'format': 'csv',
-                'messages': csv_data
-            }
-        elif format == "html":
-            # HTML экспорт (возвращаем как JSON для генерации на клиенте)
-            return {
-                'exported_at': datetime.now().isoformat(),
-                'count': len(messages),
-                'format': 'html',
-                'messages': messages
-            }
-        else:
-            # JSON экспорт по умолчанию
-            return {
-                'exported_at': datetime.now().isoformat(),
-                'count': len(messages),
-                'format': 'json',
-                'messages': messages
-            }
-    except Exception as e:
-        logger.error(f"Ошибка экспорта: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    """Потоковый экспорт сообщений
+
+    format: ndjson (запись на строку), csv, jsonl (RAW дампы, прежний raw),
+    json (документ {'messages': [...], 'count'}), html;
+    parquet — только фоновый: zip с набором Parquet по чату и месяцу
+    date_from / date_to: ISO даты, date_to включительно
+    limit: 0 — без ограничения
+    gzip: сжатый файл (.gz)
+    background: фоновая задача с файлом в data/exports вместо ответа потоком
+    """
+    if (format or '').lower() == PARQUET_FORMAT:
+        if not PARQUET_AVAILABLE:
+            raise HTTPException(status_code=501, detail="Экспорт Parquet недоступен: установите pyarrow")
+        if not background:
+            raise HTTPException(status_code=400,
+                                detail="Parquet — только фоновый экспорт: background=true или POST /export/jobs")
+        export_format = PARQUET_FORMAT
+    else:
+        export_format = normalize_format(format)
+    if not export_format:
+        raise HTTPException(status_code=400,
+                            detail=f"Неверный format. Допустимо: {', '.join(EXPORT_FORMATS)}, raw, {PARQUET_FORMAT}")
+    date_from, date_to = parse_export_dates(date_from, date_to)
+    if background:
+        return await start_export_job(export_format, chat_id=chat_id, date_from=date_from,
+                                      date_to=date_to, limit=limit, compress=gzip)
+    return export_response(export_format, chat_id=chat_id, date_from=date_from, date_to=date_to,
+                           limit=limit, compress=gzip)
+
+@app.post("/export/jobs")
+async def create_export_job(
+    format: str = "ndjson",
+    chat_id: int = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 0,
+    gzip: bool = False,
+    api_key: str = Depends(get_api_key)
+):
+    """Фоновый экспорт (параметры как у GET /export)"""
+    return await export_messages(format=format, chat_id=chat_id, date_from=date_from, date_to=date_to,
+                                 limit=limit, gzip=gzip, background=True, api_key=api_key)
+
+@app.get("/export/jobs")
+async def get_export_jobs(api_key: str = Depends(get_api_key)):
+    """Фоновые экспорты: задачи очереди и готовые файлы"""
+    jobs = [task for task in task_queue.list_tasks() if task['type'] == 'export_messages']
+    return {'jobs': jobs, 'files': list_exports()}
+
+def export_file_path(name: str) -> str:
+    """Путь готового файла экспорта (404 — нет такого файла)"""
+    path = os.path.join(EXPORTS_DIR, name)
+    if os.path.basename(name) != name or name.endswith('.part') or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Файл экспорта не найден")
+    return path
+
+@app.get("/exports")
+async def get_exports(api_key: str = Depends(get_api_key)):
+    """Готовые файлы фоновых экспортов"""
+    return {'files': list_exports(), 'retention_hours': CONFIG['EXPORT_RETENTION_HOURS']}
+
+@app.get("/exports/{name}")
+async def download_export(name: str, request: Request, api_key: str = Depends(get_api_key)):
+    """Скачать файл экспорта
+
+    Поддерживаются Range (докачка: curl -C -) и If-Range, ETag и
+    If-None-Match (304, если файл не изменился).
+    """
+    path = export_file_path(name)
+    stat = os.stat(path)
+    etag = f'"{name}-{stat.st_size}-{int(stat.st_mtime)}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    return FileResponse(path, filename=name, headers={'ETag': etag})
+
+@app.delete("/exports/{name}")
+async def delete_export(name: str, api_key: str = Depends(get_api_key)):
+    """Удалить файл экспорта"""
+    os.remove(export_file_path(name))
+    return {'status': 'ok', 'file': name}
 
 @app.post("/import")
 async def import_messages(
-    data: dict,
+    request: Request,
+    skip_duplicates: bool = True,
+    update_edits: bool = False,
     api_key: str = Depends(get_api_key)
 ):
-    """Импорт сообщений из JSON"""
+    """Потоковый импорт сообщений
+
+    Тело — файл экспорта как есть: NDJSON, JSON Lines RAW, JSON документ
+    ({"messages": [...]}, прежний {"data": {"messages": [...]}}), можно gzip.
+    Разбирается по мере загрузки и пишется пачками по IMPORT_BATCH;
+    прогресс — WebSocket import_progress.
+
+    skip_duplicates: уже сохранённые сообщения пропускаются (иначе перезаписываются)
+    update_edits: для дубликатов с другим текстом записывается редактирование
+    """
+    importer = StreamImporter(db, skip_duplicates=skip_duplicates, update_edits=update_edits)
     try:
-        skip_duplicates = data.get('skip_duplicates', True)
-        update_edits = data.get('update_edits', False)
-        messages = data.get('data', {}).get('messages', [])
-        
-        if not messages:
-            # Пробуем альтернативный формат
-            messages = data.get('messages', [])
-        
-        imported_count = 0
-        skipped_count = 0
-        
-        for msg in messages:
-            try:
-                chat_id = msg.get('chat_id')
-                message_id = msg.get('message_id')
-                
-                if not chat_id or not message_id:
-                    continue
-                
-                # Проверяем дубликаты
-                if skip_duplicates:
-                    existing = db.get_message_raw(chat_id, message_id)
-                    if existing:
-                        skipped_count += 1
-                        continue
-                
-                # Формируем RAW данные
-                raw_data = {
-                    'id': message_id,
-                    'chat_id': chat_id,
-                    'text': msg.get('text', ''),
-                    'sender_name': msg.get('sender', ''),
-                    'date': msg.get('date'),
-                    'media_type': msg.get('media_type'),
-                    'files': []
-                }
-                
-                # Формируем метаданные
-                meta = {
-                    'sender_id': None,
-                    'sender_name': msg.get('sender', ''),
-                    'message_date': msg.get('date'),
-                    'has_media': msg.get('has_media', False),
-                    'media_type': msg.get('media_type'),
-                    'text_preview': msg.get('text', '')[:500],
-                    'has_forward': False,
-                    'has_reply': False,
-                    'views': msg.get('views', 0)
-                }
-                
-                # Сохраняем сообщение
-                if db.save_message_raw(chat_id, message_id, raw_data, meta):
-                    imported_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Ошибка импорта сообщения: {e}")
-                continue
-        
-        return {
-            'status': 'ok',
-            'imported': imported_count,
-            'skipped': skipped_count,
-            'message': f'Импортировано {imported_count} сообщений, пропущено {skipped_count}'
-        }
+        # Разбор и транзакции пачек — в потоке, event loop не блокируется
+        async for chunk in request.stream():
+            if await asyncio.to_thread(importer.feed, chunk):
+                await manager.broadcast({'type': 'import_progress', **importer.progress()})
+        result = await asyncio.to_thread(importer.finish)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e} (импортировано {importer.stats['imported']})")
     except Exception as e:
         logger.error(f"Ошибка импорта: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    print(f"📥 Импорт: {result['imported']} сообщений, пропущено {result['skipped']} "
+          f"({result['per_second']} сообщ./сек)")
+    await manager.broadcast({'type': 'import_progress', **result, 'done': True})
+    return {
+        'status': 'ok',
+        **result,
+        'message': f"Импортировано {result['imported']} сообщений, пропущено {result['skipped']}"
+    }
+
 @app.post("/optimize_database")
 async def optimize_database(api_key: str = Depends(get_api_key)):
     """Оптимизация базы данных (VACUUM, ANALYZE)"""
@@ -873,7 +1822,6 @@ async def optimize_database(api_key: str = Depends(get_api_key)):
 async def backup_database(api_key: str = Depends(get_api_key)):
     """Создание бэкапа базы данных"""
     try:
-        import shutil
         from datetime import datetime
         
         # Создаём директорию для бэкапов
@@ -884,8 +1832,15 @@ async def backup_database(api_key: str = Depends(get_api_key)):
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_path = f"{backup_dir}/telegrab_backup_{timestamp}.db"
         
-        # Копируем БД
-        shutil.copy2(db.db_path, backup_path)
+        # Копируем БД через backup API SQLite: в режиме WAL часть данных
+        # может быть ещё в файле -wal, и копия файла была бы неполной
+        source = sqlite3.connect(db.db_path)
+        target = sqlite3.connect(backup_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
         
         # Удаляем старые бэкапы (храним последние 10)
         import glob
@@ -1013,8 +1968,8 @@ async def get_media_file(chat_id: int, message_id: int, api_key: str = None):
             raise HTTPException(status_code=503, detail="Telegram не подключён")
 
         # Получаем сообщение
-        chat = await tg_client.client.get_entity(chat_id)
-        message = await tg_client.client.get_messages(chat, ids=message_id)
+        chat = await retry_on_error(tg_client.client.get_entity, chat_id, method='resolve')
+        message = await retry_on_error(tg_client.client.get_messages, chat, ids=message_id, method='history')
         
         if not message:
             raise HTTPException(status_code=404, detail="Сообщение не найдено")
@@ -1023,7 +1978,7 @@ async def get_media_file(chat_id: int, message_id: int, api_key: str = None):
         from io import BytesIO
         from fastapi.responses import StreamingResponse
         
-        file_path = await tg_client.client.download_media(message)
+        file_path = await retry_on_error(tg_client.client.download_media, message, method='download')
         
         if not file_path:
             raise HTTPException(status_code=404, detail="Файл не найден")
@@ -1088,6 +2043,21 @@ async def update_config(config_data: dict, api_key: str = Depends(get_api_key)):
             else:
                 CONFIG[key] = value
     
+    if 'REQUESTS_PER_SECOND' in config_data:
+        try:
+            CONFIG['REQUESTS_PER_SECOND'] = max(float(CONFIG['REQUESTS_PER_SECOND']), 0.01)
+        except (TypeError, ValueError):
+            CONFIG['REQUESTS_PER_SECOND'] = 1
+        # Лимит задаётся на аккаунт — применяем ко всем аккаунтам
+        limiters = [rate_limiter] + [a.limiter for a in account_pool.accounts.values() if a.limiter is not rate_limiter]
+        for limiter in limiters:
+            if not CONFIG['ADAPTIVE_RATE']:
+                limiter.set_rate(CONFIG['REQUESTS_PER_SECOND'])
+            limiter.default_class_rate = min(CONFIG['REQUESTS_PER_SECOND'], limiter.rate)
+
+    if 'MESSAGES_PER_REQUEST' in config_data and isinstance(CONFIG['MESSAGES_PER_REQUEST'], int):
+        page_sizer.set_ceiling(CONFIG['MESSAGES_PER_REQUEST'])
+
     # Проверяем изменились ли критические параметры (требующие переподключения)
     critical_changed = (old_api_id != CONFIG.get('API_ID') or 
                        old_api_hash != CONFIG.get('API_HASH') or 
@@ -1421,98 +2391,249 @@ async def setup_telethon():
         return False
 
 async def join_chat(client, chat_identifier):
-    """Вступить в чат по ID, username или ссылке"""
+    """Вступить в чат по ID, username или ссылке
+
+    Разрешённые ранее идентификаторы (в том числе ссылки-приглашения)
+    берутся из резолвера без запросов к Telegram.
+    """
+    chat = entity_cache.resolve_offline(chat_identifier)
+    if chat is not None:
+        logger.debug(f"Чат {chat_identifier} найден в резолвере")
+        try:
+            await retry_on_error(client.get_participants, chat, limit=1, method='resolve')
+            return chat
+        except Exception:
+            # Не участник или устаревший access_hash — разрешаем заново
+            entity_cache.forget(chat_identifier)
+
+    chat = await join_chat_online(client, chat_identifier)
+    if chat is not None:
+        entity_cache.bind(chat_identifier, chat)
+    return chat
+
+async def join_chat_online(client, chat_identifier):
+    """Разрешить идентификатор через Telegram и вступить в чат при необходимости"""
     try:
         if isinstance(chat_identifier, int) or (isinstance(chat_identifier, str) and chat_identifier.lstrip('-').isdigit()):
             chat_id = int(chat_identifier)
-            chat = await client.get_entity(chat_id)
+            chat = await retry_on_error(client.get_entity, chat_id, method='resolve')
         elif isinstance(chat_identifier, str) and chat_identifier.startswith('@'):
-            chat = await client.get_entity(chat_identifier)
+            chat = await retry_on_error(client.get_entity, chat_identifier, method='resolve')
         elif isinstance(chat_identifier, str) and 't.me/' in chat_identifier:
-            username = chat_identifier.split('t.me/')[-1].split('/')[0].replace('+', '')
-            if username.startswith('joinchat/'):
-                hash = username.split('joinchat/')[-1]
-                result = await client(ImportChatInviteRequest(hash))
+            path = chat_identifier.split('t.me/')[-1].strip('/')
+            username = path.split('/')[0]
+            if path.startswith('joinchat/') or path.startswith('+'):
+                hash = path.split('joinchat/')[-1].lstrip('+')
+                result = await retry_on_error(client, ImportChatInviteRequest(hash), method='join')
                 chat = result.chats[0]
             else:
-                chat = await client.get_entity(f'@{username}')
+                chat = await retry_on_error(client.get_entity, f'@{username}', method='resolve')
         else:
-            chat = await client.get_entity(chat_identifier)
+            chat = await retry_on_error(client.get_entity, chat_identifier, method='resolve')
     except Exception as e:
         print(f"❌ Не удалось получить чат: {e}")
         return None
 
     try:
-        await client.get_participants(chat, limit=1)
+        await retry_on_error(client.get_participants, chat, limit=1, method='resolve')
         return chat
     except:
         pass
 
     try:
         if hasattr(chat, 'username') and chat.username:
-            result = await client(JoinChannelRequest(chat))
+            result = await retry_on_error(client, JoinChannelRequest(chat), method='join')
             return result.chats[0]
     except Exception as e:
         print(f"❌ Ошибка вступления в чат: {e}")
     
     return None
 
-async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=None):
+def chat_display_title(chat, chat_id):
+    """Название чата из сущности или (для InputPeer) из кэша сущностей"""
+    title = getattr(chat, 'title', None) or getattr(chat, 'username', None)
+    if not title:
+        try:
+            title = entity_cache.display_name(utils.get_peer_id(chat), None)
+        except Exception:
+            title = None
+    return title or f"chat_{chat_id}"
+
+async def resolve_chat_entity(client, chat_id):
+    """Получить сущность чата по ID или username, перебирая возможные форматы
+
+    Уже разрешённые идентификаторы берутся из резолвера (таблица
+    chat_resolver) как InputPeer без запросов к Telegram.
+    """
+    if not lease_is_primary():
+        # access_hash в резолвере принадлежит основному аккаунту — у дополнительного
+        # сущность берётся из его собственной сессии
+        return await resolve_chat_entity_online(client, chat_id)
+
+    peer = entity_cache.resolve_offline(chat_id)
+    if peer is not None:
+        logger.debug(f"Чат {chat_id} найден в резолвере")
+        return peer
+
+    chat = await resolve_chat_entity_online(client, chat_id)
+    entity_cache.bind(chat_id, chat)
+    return chat
+
+async def resolve_chat_entity_online(client, chat_id):
+    """Перебор форматов идентификатора через get_entity"""
+    # Пробуем получить чат разными способами
+    chat = None
+    chat_id_str = str(chat_id)
+    print(f"🔍 Поиск чата: {chat_id_str}")
+
+    # Если это username (начинается с @)
+    if chat_id_str.startswith('@'):
+        logger.debug(f"Получение по username: @{chat_id_str[1:]}")
+        chat = await retry_on_error(client.get_entity, chat_id_str, max_retries=3, method='resolve')
+    else:
+        # Пробуем получить по ID
+        try:
+            # Для супергрупп и каналов ID может быть с -100
+            if chat_id_str.startswith('-100'):
+                logger.debug(f"Получение по ID (канал): {chat_id_str}")
+                chat = await retry_on_error(client.get_entity, int(chat_id_str), max_retries=3, method='resolve')
+            else:
+                # Пробуем оба формата: с -100 и без
+                try:
+                    logger.debug(f"Получение по ID (бот/группа): {chat_id_str}")
+                    chat = await retry_on_error(client.get_entity, int(chat_id_str), max_retries=3, method='resolve')
+                except Exception as e1:
+                    # Пробуем с -100
+                    logger.debug(f"Не удалось получить как бот/группа, пробуем как канал: -100{chat_id_str}")
+                    chat = await retry_on_error(client.get_entity, int(f'-100{chat_id_str}'), max_retries=3, method='resolve')
+        except (ValueError, TypeError, Exception) as e:
+            logger.warning(f"Ошибка получения чата {chat_id}: {e}")
+            # Если не числовой ID — пробуем как строку (username)
+            try:
+                logger.debug(f"Получение по строке: {chat_id_str}")
+                chat = await retry_on_error(client.get_entity, chat_id_str, max_retries=3, method='resolve')
+            except Exception as e2:
+                logger.warning(f"Не удалось получить чат по строке: {e2}")
+                # Пробуем как бота по username
+                try:
+                    logger.debug(f"Получение как бот: @{chat_id_str}")
+                    chat = await retry_on_error(client.get_entity, f'@{chat_id_str}', max_retries=3, method='resolve')
+                except Exception as e3:
+                    logger.warning(f"Не удалось получить как бот: {e3}")
+                    raise Exception(f"Чат не найден: {chat_id}")
+
+    if not chat:
+        raise Exception(f"Чат не найден: {chat_id}")
+
+    return chat
+
+def message_media_info(message):
+    """Тип медиа и информация о файле: (media_type, file_id, file_name, file_size)"""
+    media_type = None
+    file_id = None
+    file_name = None
+    file_size = None
+
+    # Проверяем наличие медиа
+    if message.photo:
+        media_type = 'photo'
+        if message.photo and hasattr(message.photo, 'id'):
+            file_id = str(message.photo.id)
+    elif message.video:
+        media_type = 'video'
+        file_id = str(message.video.id) if hasattr(message.video, 'id') else None
+        file_size = message.video.size if hasattr(message.video, 'size') else None
+        file_name = f"video_{message.id}.mp4"
+    elif message.document:
+        media_type = 'document'
+        file_id = str(message.document.id) if hasattr(message.document, 'id') else None
+        file_size = message.document.size if hasattr(message.document, 'size') else None
+        file_name = message.document.file_name if hasattr(message.document, 'file_name') else None
+    elif message.audio:
+        media_type = 'audio'
+        file_id = str(message.audio.id) if hasattr(message.audio, 'id') else None
+        file_size = message.audio.size if hasattr(message.audio, 'size') else None
+    elif message.voice:
+        media_type = 'voice'
+        file_id = str(message.voice.id) if hasattr(message.voice, 'id') else None
+    elif message.sticker:
+        media_type = 'sticker'
+        file_id = str(message.sticker.id) if hasattr(message.sticker, 'id') else None
+    elif message.gif:
+        media_type = 'gif'
+        file_id = str(message.gif.id) if hasattr(message.gif, 'id') else None
+
+    return media_type, file_id, file_name, file_size
+
+def save_history_message(message, chat_id, chat_title):
+    """Сохранить сообщение из истории
+
+    Returns:
+        True — сохранено, False — уже в БД, None — пропущено (служебное без текста и медиа)
+    """
+    # Определяем тип медиа и информацию о файле
+    media_type, file_id, file_name, file_size = message_media_info(message)
+
+    # Пропускаем только системные сообщения без текста и медиа
+    if not message.text and not media_type:
+        logger.debug(f"Пропущено сообщение {message.id} без текста и медиа (type={type(message).__name__})")
+        return None
+
+    # Получаем текст или создаём описание медиа
+    text = message.text or ""
+    if media_type and not text:
+        text = f"[{media_type}]"
+
+    saved = db.save_message(
+        message_id=message.id,
+        chat_id=chat_id,
+        chat_title=chat_title,
+        text=text,
+        # Отправитель из кэша сущностей
+        sender_name=entity_cache.display_name(message.sender_id),
+        message_date=message.date.isoformat() if hasattr(message.date, 'isoformat') else str(message.date),
+        media_type=media_type,
+        file_id=file_id,
+        file_name=file_name,
+        file_size=file_size,
+        sender_id=message.sender_id
+    )
+    if saved:
+        media_log = f" с медиа: {media_type}" if media_type else ""
+        logger.debug(f"Сохранено сообщение {message.id}{media_log}")
+    return saved
+
+async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=None,
+                                            checkpoint=None, should_yield=None, takeout=None):
     """Загрузка истории с дозированием запросов
 
     ВАЖНО: Используем min_id вместо offset_id!
     - offset_id: возвращает сообщения с ID < X (старые) ❌
     - min_id: возвращает сообщения с ID > X (новые) ✅
+
+    Args:
+        checkpoint: Контрольная точка задачи (offset_id, loaded, entity),
+            обновляется после каждой страницы
+        should_yield: Функция, возвращающая True, если пора уступить воркер
+            другим чатам; тогда загрузка прерывается с 'yielded': True
+        takeout: Takeout-клиент для страниц истории (None — обычный клиент)
     """
     try:
         print(f"📚 Загрузка истории для chat_id={chat_id}, limit={limit}")
+        source, method = (takeout, 'takeout') if takeout is not None else (client, 'history')
         
-        # Пробуем получить чат разными способами
-        chat = None
-        chat_id_str = str(chat_id)
-        print(f"🔍 Поиск чата: {chat_id_str}")
-
-        # Если это username (начинается с @)
-        if chat_id_str.startswith('@'):
-            logger.debug(f"Получение по username: @{chat_id_str[1:]}")
-            chat = await retry_on_error(client.get_entity, chat_id_str, max_retries=3)
-        else:
-            # Пробуем получить по ID
-            try:
-                # Для супергрупп и каналов ID может быть с -100
-                if chat_id_str.startswith('-100'):
-                    logger.debug(f"Получение по ID (канал): {chat_id_str}")
-                    chat = await retry_on_error(client.get_entity, int(chat_id_str), max_retries=3)
-                else:
-                    # Пробуем оба формата: с -100 и без
-                    try:
-                        logger.debug(f"Получение по ID (бот/группа): {chat_id_str}")
-                        chat = await retry_on_error(client.get_entity, int(chat_id_str), max_retries=3)
-                    except Exception as e1:
-                        # Пробуем с -100
-                        logger.debug(f"Не удалось получить как бот/группа, пробуем как канал: -100{chat_id_str}")
-                        chat = await retry_on_error(client.get_entity, int(f'-100{chat_id_str}'), max_retries=3)
-            except (ValueError, TypeError, Exception) as e:
-                logger.warning(f"Ошибка получения чата {chat_id}: {e}")
-                # Если не числовой ID — пробуем как строку (username)
-                try:
-                    logger.debug(f"Получение по строке: {chat_id_str}")
-                    chat = await retry_on_error(client.get_entity, chat_id_str, max_retries=3)
-                except Exception as e2:
-                    logger.warning(f"Не удалось получить чат по строке: {e2}")
-                    # Пробуем как бота по username
-                    try:
-                        logger.debug(f"Получение как бот: @{chat_id_str}")
-                        chat = await retry_on_error(client.get_entity, f'@{chat_id_str}', max_retries=3)
-                    except Exception as e3:
-                        logger.warning(f"Не удалось получить как бот: {e3}")
-                        raise Exception(f"Чат не найден: {chat_id}")
-
-        if not chat:
-            raise Exception(f"Чат не найден: {chat_id}")
-
-        chat_title = getattr(chat, 'title', None) or getattr(chat, 'username', None) or f"chat_{chat_id}"
+        checkpoint = checkpoint if checkpoint is not None else {}
+
+        # Сущность чата сохраняется в контрольной точке, чтобы продолжение
+        # задачи не требовало повторного запроса к Telegram
+        chat = checkpoint.get('entity')
+        if chat is None:
+            chat = await resolve_chat_entity(client, chat_id)
+            checkpoint['entity'] = chat
+
+        chat_title = chat_display_title(chat, chat_id)
         logger.info(f"Чат получен: {chat_title} (ID: {chat_id}, type: {type(chat).__name__})")
+        entity_cache.remember(chat, foreign=not lease_is_primary())
 
         status = db.get_loading_status(chat_id)
         last_loaded_id = status.get('last_loaded_id', 0)
@@ -1539,17 +2660,22 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
             logger.info(f"Чат {chat_id} уже полностью загружен")
             return {'chat_id': chat_id, 'chat_title': chat_title, 'already_loaded': True}
 
-        message_count = 0
+        # Продолжение задачи, уступившей очередь
+        if checkpoint.get('offset_id'):
+            last_loaded_id = checkpoint['offset_id']
+            logger.debug(f"Продолжение с контрольной точки: offset_id={last_loaded_id}")
+
+        message_count = checkpoint.get('loaded', 0)
         last_message_date = None
         has_more_messages = True
         consecutive_duplicates = 0  # Счётчик последовательных дубликатов
 
         while has_more_messages:
-            await asyncio.sleep(1.0 / CONFIG['REQUESTS_PER_SECOND'])
-
-            request_limit = CONFIG['MESSAGES_PER_REQUEST']
+            # Размер страницы подбирается по чату (page_sizer), не больше MESSAGES_PER_REQUEST
+            request_limit = page_sizer.get(chat_id)
             if limit > 0 and message_count + request_limit > limit:
                 request_limit = limit - message_count
+            probe = {}
 
             try:
                 # Используем offset_id для загрузки истории (сообщения ДО этого ID)
@@ -1557,24 +2683,33 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
                 # min_id: возвращает сообщения с ID > X (новые) ✅ для новых сообщений
                 logger.info(f"Загрузка сообщений: chat={chat_id}, offset_id={last_loaded_id}, limit={request_limit}")
                 messages = await retry_on_error(
-                    client.get_messages,
+                    page_sizer.timed(source.get_messages, probe),
                     chat,
                     limit=request_limit,
                     offset_id=last_loaded_id,
                     max_retries=3,
-                    base_delay=1.0
+                    base_delay=1.0,
+                    method=method
                 )
                 logger.info(f"Получено сообщений: {len(messages)}")
                 if messages:
                     logger.debug(f"Диапазон ID: {messages[-1].id if messages else 'N/A'} - {messages[0].id if messages else 'N/A'}")
             except FloodWaitError as e:
-                # Telegram требует ожидания при превышении лимита запросов
-                wait_time = e.seconds
-                logger.warning(f"FloodWait: ожидание {wait_time} секунд...")
-                await asyncio.sleep(wait_time)
+                # Telegram требует ожидания при превышении лимита запросов.
+                # Пауза уже учтена rate limiter'ом — следующий acquire() дождётся её
+                logger.warning(f"FloodWait: ожидание {e.seconds} секунд...")
+                continue
+            except TakeoutInvalidError as e:
+                # Takeout-сессия отозвана — продолжаем обычным путём с той же страницы
+                logger.warning(f"Takeout-сессия недействительна, обычная загрузка: {e}")
+                takeout_manager.invalidate()
+                source, method = client, 'history'
                 continue
             except (ChannelPrivateError, ChannelInvalidError) as e:
                 logger.error(f"Чат недоступен (приватный/неверный): {e}")
+                # Сохранённый access_hash мог устареть — в следующий раз разрешаем заново
+                if lease_is_primary():
+                    entity_cache.forget(chat_id)
                 break
             except ChatAdminRequiredError as e:
                 logger.error(f"Требуются права администратора: {e}")
@@ -1591,84 +2726,38 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
             except (BadRequestError, UnauthorizedError) as e:
                 logger.error(f"Ошибка авторизации: {e}")
                 break
+            except AccountUnavailableError:
+                # Аккаунт снят с задач — воркер передаст задачу другому аккаунту
+                raise
+            except PAGE_ERRORS as e:
+                # Таймаут или сбой сервера — следующая попытка чата начнётся с меньшей страницы
+                logger.error(f"Сбой запроса страницы (limit={request_limit}): {e}")
+                page_sizer.record_error(chat_id)
+                break
             except RPCError as e:
                 logger.error(f"RPC ошибка Telegram: {e}")
                 break
             except Exception as e:
                 logger.error(f"Неизвестная ошибка загрузки: {e}")
+                page_sizer.record_error(chat_id)
                 break
 
             if not messages:
+                has_more_messages = False
                 break
 
+            # Отправители страницы пришли вместе с ней — без get_sender() на сообщение
+            remember_message_entities(messages)
+
+            kept = 0
             for message in messages:
-                # Определяем тип медиа и информацию о файле
-                media_type = None
-                file_id = None
-                file_name = None
-                file_size = None
-                
-                # Проверяем наличие медиа
-                if message.photo:
-                    media_type = 'photo'
-                    if message.photo and hasattr(message.photo, 'id'):
-                        file_id = str(message.photo.id)
-                elif message.video:
-                    media_type = 'video'
-                    file_id = str(message.video.id) if hasattr(message.video, 'id') else None
-                    file_size = message.video.size if hasattr(message.video, 'size') else None
-                    file_name = f"video_{message.id}.mp4"
-                elif message.document:
-                    media_type = 'document'
-                    file_id = str(message.document.id) if hasattr(message.document, 'id') else None
-                    file_size = message.document.size if hasattr(message.document, 'size') else None
-                    file_name = message.document.file_name if hasattr(message.document, 'file_name') else None
-                elif message.audio:
-                    media_type = 'audio'
-                    file_id = str(message.audio.id) if hasattr(message.audio, 'id') else None
-                    file_size = message.audio.size if hasattr(message.audio, 'size') else None
-                elif message.voice:
-                    media_type = 'voice'
-                    file_id = str(message.voice.id) if hasattr(message.voice, 'id') else None
-                elif message.sticker:
-                    media_type = 'sticker'
-                    file_id = str(message.sticker.id) if hasattr(message.sticker, 'id') else None
-                elif message.gif:
-                    media_type = 'gif'
-                    file_id = str(message.gif.id) if hasattr(message.gif, 'id') else None
-                
-                # Пропускаем только системные сообщения без текста и медиа
-                if not message.text and not media_type:
-                    logger.debug(f"Пропущено сообщение {message.id} без текста и медиа (type={type(message).__name__})")
+                saved = save_history_message(message, chat_id, chat_title)
+                if saved is None:
                     continue
-
-                # Получаем текст или создаём описание медиа
-                text = message.text or ""
-                if media_type and not text:
-                    text = f"[{media_type}]"
-                
-                # Получаем отправителя
-                sender = await message.get_sender()
-                sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', 'Unknown')
-
-                # Сохраняем сообщение
-                saved = db.save_message(
-                    message_id=message.id,
-                    chat_id=chat_id,
-                    chat_title=chat_title,
-                    text=text,
-                    sender_name=sender_name,
-                    message_date=message.date.isoformat() if hasattr(message.date, 'isoformat') else str(message.date),
-                    media_type=media_type,
-                    file_id=file_id,
-                    file_name=file_name,
-                    file_size=file_size
-                )
+                kept += 1
 
                 # Увеличиваем счётчики только если сообщение сохранено
                 if saved:
-                    media_log = f" с медиа: {media_type}" if media_type else ""
-                    logger.debug(f"Сохранено сообщение {message.id}{media_log}")
                     message_count += 1
                     total_loaded += 1
                     last_message_date = message.date
@@ -1686,6 +2775,7 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
             # Обновляем статус после каждой итерации (не только каждые 100)
             # Это обеспечивает корректное продолжение загрузки при сбоях
             db.update_loading_status(chat_id, last_loaded_id, last_message_date, total_loaded)
+            page_sizer.record(chat_id, request_limit, len(messages), kept, probe.get('latency_ms', 0))
 
             # Проверяем есть ли ещё сообщения
             if len(messages) < request_limit:
@@ -1700,6 +2790,14 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
             if limit > 0 and message_count >= limit:
                 break
 
+            checkpoint['offset_id'] = last_loaded_id
+            checkpoint['loaded'] = message_count
+
+            # Другие чаты ждут воркер — уступаем после страницы (round-robin)
+            if has_more_messages and should_yield and should_yield():
+                logger.info(f"Чат {chat_id}: уступаем очередь на offset_id={last_loaded_id}")
+                return {'chat_id': chat_id, 'chat_title': chat_title, 'new_messages': message_count, 'yielded': True}
+
         # Определяем полностью ли загружен чат
         fully_loaded = (limit == 0 and not has_more_messages)
         db.update_loading_status(chat_id, last_loaded_id, last_message_date, total_loaded, fully_loaded)
@@ -1728,15 +2826,175 @@ async def load_chat_history_with_rate_limit(client, chat_id, limit=0, task_id=No
     except RPCError as e:
         logger.error(f"RPC ошибка при загрузке истории: {e}")
         raise
+    except AccountUnavailableError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка загрузки истории: {e}")
         raise
 
+async def split_history_ranges(client, chat_id, parts):
+    """
+    Разбить ещё не загруженную часть истории чата на непересекающиеся диапазоны ID
+
+    Загружается всё, что ниже самого старого сохранённого сообщения (или ниже
+    последнего сообщения чата, если архив пуст). Повторный вызов возвращает
+    незавершённые диапазоны прежнего разбиения.
+
+    Returns:
+        Незавершённые диапазоны [{'range_start', 'range_end', ...}]
+    """
+    if db.get_loading_status(chat_id).get('fully_loaded'):
+        return []
+    existing = db.get_loading_ranges(chat_id)
+    if existing:
+        return [item for item in existing if not item['done']]
+
+    min_id, _ = db.get_message_id_bounds(chat_id)
+    if min_id:
+        upper = min_id - 1
+    else:
+        chat = await resolve_chat_entity(client, chat_id)
+        top = await retry_on_error(client.get_messages, chat, limit=1, method='history')
+        upper = top[0].id if top else 0
+    if upper < 1:
+        db.update_loading_status(chat_id, 0, None, 0, fully_loaded=True)
+        return []
+
+    # Не дробим мельче одной страницы на диапазон
+    parts = max(1, min(int(parts), upper // CONFIG['MESSAGES_PER_REQUEST']))
+    step = -(-upper // parts)
+    db.save_loading_ranges(chat_id, [(start, min(start + step - 1, upper)) for start in range(1, upper + 1, step)])
+    logger.info(f"Чат {chat_id}: история 1..{upper} разбита на {parts} диапазонов")
+    return db.get_loading_ranges(chat_id)
+
+async def load_chat_range(client, chat_id, range_start, range_end, checkpoint=None, should_yield=None,
+                          takeout=None):
+    """Загрузка диапазона ID range_start..range_end от новых к старым
+
+    Контрольная точка диапазона (offset_id) сохраняется после каждой страницы
+    в chat_loading_ranges; когда завершён последний диапазон, чат отмечается
+    fully_loaded.
+    """
+    checkpoint = checkpoint if checkpoint is not None else {}
+
+    chat = checkpoint.get('entity')
+    if chat is None:
+        chat = await resolve_chat_entity(client, chat_id)
+        checkpoint['entity'] = chat
+    chat_title = chat_display_title(chat, chat_id)
+
+    offset_id = checkpoint.get('offset_id')
+    if not offset_id:
+        stored = next((item for item in db.get_loading_ranges(chat_id) if item['range_start'] == range_start), None)
+        offset_id = stored['offset_id'] if stored else range_end + 1
+    loaded = checkpoint.get('loaded', 0)
+    source, method = (takeout, 'takeout') if takeout is not None else (client, 'history')
+    all_done = False
+    error = None
+
+    while True:
+        request_limit = page_sizer.get(chat_id)
+        probe = {}
+        # min_id/offset_id не включаются: сообщения range_start <= id < offset_id
+        # Ошибки — как в load_chat_history_with_rate_limit: FloodWait переждать,
+        # недоступный чат / сбой — остановить диапазон на контрольной точке
+        # (chat_loading_ranges), не роняя задачу
+        try:
+            messages = await retry_on_error(
+                page_sizer.timed(source.get_messages, probe), chat, limit=request_limit,
+                offset_id=offset_id, min_id=range_start - 1, method=method
+            )
+        except FloodWaitError as e:
+            # Пауза уже учтена rate limiter'ом — следующий acquire() дождётся её
+            logger.warning(f"FloodWait: ожидание {e.seconds} секунд...")
+            continue
+        except TakeoutInvalidError as e:
+            logger.warning(f"Takeout-сессия недействительна, обычная загрузка: {e}")
+            takeout_manager.invalidate()
+            source, method = client, 'history'
+            continue
+        except (ChannelPrivateError, ChannelInvalidError) as e:
+            logger.error(f"Чат недоступен (приватный/неверный): {e}")
+            if lease_is_primary():
+                entity_cache.forget(chat_id)
+            error = str(e)
+            break
+        except ChatAdminRequiredError as e:
+            logger.error(f"Требуются права администратора: {e}")
+            error = str(e)
+            break
+        except UserNotParticipantError as e:
+            logger.error(f"Бот не является участником чата: {e}")
+            error = str(e)
+            break
+        except (AuthKeyUnregisteredError, AuthKeyDuplicatedError) as e:
+            logger.critical(f"Сессия недействительна: {e}")
+            raise
+        except (BadRequestError, UnauthorizedError) as e:
+            logger.error(f"Ошибка авторизации: {e}")
+            error = str(e)
+            break
+        except AccountUnavailableError:
+            # Аккаунт снят с задач — воркер передаст задачу другому аккаунту
+            raise
+        except PAGE_ERRORS as e:
+            # Следующая попытка диапазона начнётся с меньшей страницы
+            logger.error(f"Сбой запроса страницы (limit={request_limit}): {e}")
+            page_sizer.record_error(chat_id)
+            error = str(e)
+            break
+        except RPCError as e:
+            logger.error(f"RPC ошибка Telegram: {e}")
+            error = str(e)
+            break
+        remember_message_entities(messages)
+
+        added = 0
+        kept = 0
+        for message in messages:
+            saved = save_history_message(message, chat_id, chat_title)
+            if saved is not None:
+                kept += 1
+            if saved:
+                added += 1
+            offset_id = min(offset_id, message.id)
+        loaded += added
+        page_sizer.record(chat_id, request_limit, len(messages), kept, probe.get('latency_ms', 0))
+
+        done = len(messages) < request_limit
+        all_done = db.update_loading_range(chat_id, range_start, offset_id, loaded, added=added, done=done)
+        checkpoint['offset_id'] = offset_id
+        checkpoint['loaded'] = loaded
+
+        if done:
+            break
+        # Другие задачи ждут воркер — уступаем после страницы
+        if should_yield and should_yield():
+            return {'chat_id': chat_id, 'range': [range_start, range_end], 'new_messages': loaded, 'yielded': True}
+
+    if error is not None:
+        logger.warning(f"Диапазон {range_start}..{range_end} чата {chat_id} остановлен на offset_id={offset_id}")
+        return {'chat_id': chat_id, 'chat_title': chat_title, 'range': [range_start, range_end],
+                'new_messages': loaded, 'fully_loaded': False, 'error': error}
+
+    logger.info(f"Диапазон {range_start}..{range_end} чата {chat_id} загружен: {loaded} сообщений")
+    if all_done:
+        await manager.broadcast({
+            'type': 'chat_loaded',
+            'chat_id': chat_id,
+            'chat_title': chat_title,
+            'new_messages': loaded,
+            'fully_loaded': True
+        })
+    return {'chat_id': chat_id, 'chat_title': chat_title, 'range': [range_start, range_end],
+            'new_messages': loaded, 'fully_loaded': all_done}
+
 async def load_missed_messages_for_chat(client, chat_id, since_date=None, limit=500, task_id=None):
     """Догрузка пропущенных сообщений"""
     try:
-        chat = await client.get_entity(chat_id)
-        chat_title = getattr(chat, 'title', None) or getattr(chat, 'username', None) or f"chat_{chat_id}"
+        chat = await resolve_chat_entity(client, chat_id)
+        chat_title = chat_display_title(chat, chat_id)
+        entity_cache.remember(chat, foreign=not lease_is_primary())
 
         if since_date:
             since_dt = datetime.fromisoformat(since_date.replace('Z', '+00:00')) if isinstance(since_date, str) else since_date
@@ -1747,39 +3005,76 @@ async def load_missed_messages_for_chat(client, chat_id, since_date=None, limit=
 
         message_count = 0
         last_message_date = None
+        fetched = 0
+        last_id = 0
+        complete = False
+
+        # Постраничная загрузка от since_dt к новым сообщениям (reverse=True),
+        # каждая страница — один запрос через rate limiter
+        while fetched < limit:
+            request_limit = min(page_sizer.get(chat_id), limit - fetched)
+            probe = {}
+            try:
+                if last_id:
+                    messages = await retry_on_error(
+                        page_sizer.timed(client.get_messages, probe), chat, limit=request_limit,
+                        offset_id=last_id, reverse=True, method='history'
+                    )
+                else:
+                    messages = await retry_on_error(
+                        page_sizer.timed(client.get_messages, probe), chat, limit=request_limit,
+                        offset_date=since_dt, reverse=True, method='history'
+                    )
+            except PAGE_ERRORS:
+                page_sizer.record_error(chat_id)
+                raise
+            if not messages:
+                complete = True
+                break
+            fetched += len(messages)
+            remember_message_entities(messages)
 
-        async for message in client.iter_messages(chat, limit=limit, offset_date=since_dt):
-            # Пропускаем сообщения без текста
-            if not message.text:
-                continue
-            
-            # Сравниваем даты корректно
-            msg_date = message.date
-            if msg_date.tzinfo is None and since_dt.tzinfo is not None:
-                msg_date = msg_date.replace(tzinfo=since_dt.tzinfo)
-            elif msg_date.tzinfo is not None and since_dt.tzinfo is None:
-                since_dt = since_dt.replace(tzinfo=msg_date.tzinfo)
-            
-            if msg_date <= since_dt:
-                continue
+            kept = 0
+            for message in messages:
+                last_id = max(last_id, message.id)
 
-            sender = await message.get_sender()
-            sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', 'Unknown')
+                # Пропускаем только системные сообщения без текста и медиа
+                media_type, file_id, file_name, file_size = message_media_info(message)
+                if not message.text and not media_type:
+                    continue
+                kept += 1
 
-            db.save_message(
-                message_id=message.id,
-                chat_id=chat_id,
-                chat_title=chat_title,
-                text=message.text,
-                sender_name=sender_name,
-                message_date=message.date.isoformat() if hasattr(message.date, 'isoformat') else str(message.date)
-            )
+                # Сравниваем даты корректно
+                msg_date = message.date
+                if msg_date.tzinfo is None and since_dt.tzinfo is not None:
+                    msg_date = msg_date.replace(tzinfo=since_dt.tzinfo)
+                elif msg_date.tzinfo is not None and since_dt.tzinfo is None:
+                    since_dt = since_dt.replace(tzinfo=msg_date.tzinfo)
+
+                if msg_date <= since_dt:
+                    continue
+
+                db.save_message(
+                    message_id=message.id,
+                    chat_id=chat_id,
+                    chat_title=chat_title,
+                    text=message.text or f"[{media_type}]",
+                    sender_name=entity_cache.display_name(message.sender_id),
+                    message_date=message.date.isoformat() if hasattr(message.date, 'isoformat') else str(message.date),
+                    media_type=media_type,
+                    file_id=file_id,
+                    file_name=file_name,
+                    file_size=file_size,
+                    sender_id=message.sender_id
+                )
 
-            message_count += 1
-            last_message_date = message.date.isoformat()
+                message_count += 1
+                last_message_date = message.date.isoformat()
 
-            if message_count % CONFIG['MESSAGES_PER_REQUEST'] == 0:
-                await asyncio.sleep(1.0 / CONFIG['REQUESTS_PER_SECOND'])
+            page_sizer.record(chat_id, request_limit, len(messages), kept, probe.get('latency_ms', 0))
+            if len(messages) < request_limit:
+                complete = True
+                break
 
         if message_count > 0:
             status = db.get_loading_status(chat_id)
@@ -1793,7 +3088,7 @@ async def load_missed_messages_for_chat(client, chat_id, since_date=None, limit=
                 'count': message_count
             })
 
-        return {'chat_id': chat_id, 'chat_title': chat_title, 'missed_messages': message_count}
+        return {'chat_id': chat_id, 'chat_title': chat_title, 'missed_messages': message_count, 'complete': complete}
 
     except FloodWaitError as e:
         logger.warning(f"FloodWait при догрузке пропущенных: ожидание {e.seconds} секунд...")
@@ -1807,6 +3102,8 @@ async def load_missed_messages_for_chat(client, chat_id, since_date=None, limit=
     except RPCError as e:
         logger.error(f"RPC ошибка при догрузке: {e}")
         raise
+    except AccountUnavailableError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка догрузки пропущенных: {e}")
         raise
@@ -1851,6 +3148,12 @@ class TelegramClientWrapper:
         me = await self.client.get_me()
         print(f"✅ Авторизован как: {me.first_name} (@{me.username or 'no username'})")
 
+        # Аккаунты: основной и дополнительные (EXTRA_ACCOUNTS) — до запуска воркеров,
+        # воркеров по TASK_WORKERS на аккаунт
+        account_pool.add(CONFIG['PHONE'], self.client, rate_limiter, primary=True)
+        await self.connect_extra_accounts()
+        task_queue.workers = CONFIG['TASK_WORKERS'] * len(account_pool.accounts)
+
         # Запуск обработчика задач
         print("🔄 Запуск обработчика задач...")
         asyncio.create_task(task_queue.process_tasks(self.client))
@@ -1874,13 +3177,24 @@ class TelegramClientWrapper:
         async def delete_handler(event):
             await self.handle_message_delete(event)
 
+        # pts каналов для догрузки через getChannelDifference
+        @self.client.on(events.Raw)
+        async def raw_handler(update):
+            updates_tracker.observe(update)
+
         self.running = True
         print("✅ Обработчик задач и обработчики сообщений запущены")
 
-        # Автозагрузка если включена
-        if CONFIG['AUTO_LOAD_MISSED']:
-            print("🔍 Автодогрузка пропущенных...")
-            asyncio.create_task(self.auto_load_missed())
+        # Журнал изменений хранится CHANGES_RETENTION_DAYS дней
+        try:
+            pruned = db.prune_changes(CONFIG['CHANGES_RETENTION_DAYS'])
+            if pruned:
+                logger.info(f"Удалено записей журнала изменений: {pruned}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки журнала изменений: {e}")
+
+        # Догрузка пропущенного и сохранение состояния обновлений
+        asyncio.create_task(self.catch_up_updates())
         if CONFIG['AUTO_LOAD_HISTORY']:
             print("📚 Автозагрузка истории...")
             asyncio.create_task(self.auto_load_history())
@@ -1888,6 +3202,51 @@ class TelegramClientWrapper:
         print("✅ Telegram клиент полностью инициализирован")
         return True
 
+    async def connect_extra_accounts(self):
+        """Подключение дополнительных аккаунтов (EXTRA_ACCOUNTS)
+
+        Живые обновления обрабатывает только основной аккаунт; дополнительные
+        загружают историю и догружают чаты из своих диалогов. Сессия аккаунта
+        должна быть авторизована заранее (data/telegrab_<API_ID>_<номер>).
+        """
+        phones = [phone.strip() for phone in str(CONFIG['EXTRA_ACCOUNTS']).split(',') if phone.strip()]
+        for phone in phones:
+            if phone == CONFIG['PHONE']:
+                continue
+            session_name = f"telegrab_{CONFIG['API_ID']}_{phone.replace('+', '')}"
+            client = TelegramClient(
+                session=f"data/{session_name}",
+                api_id=CONFIG['API_ID'],
+                api_hash=CONFIG['API_HASH'],
+                device_model="Telegrab UserBot 5.0",
+                app_version="5.0.0",
+                system_version="Linux"
+            )
+            try:
+                await client.connect()
+                if not await client.is_user_authorized():
+                    print(f"⚠️  Аккаунт {phone} не авторизован — пропущен")
+                    await client.disconnect()
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка подключения аккаунта {phone}: {e}")
+                continue
+
+            # Диалоги аккаунта: какие чаты он видит (и их access_hash в его сессии)
+            limiter = create_rate_limiter(phone)
+            chats = set()
+            try:
+                await limiter.acquire('dialogs')
+                async for dialog in client.iter_dialogs():
+                    if chats and len(chats) % 100 == 0:
+                        await limiter.acquire('dialogs')
+                    chats.add(dialog.id)
+            except Exception as e:
+                logger.error(f"Ошибка получения диалогов аккаунта {phone}: {e}")
+
+            account_pool.add(phone, client, limiter, chats=chats)
+            print(f"✅ Дополнительный аккаунт {phone}: диалогов {len(chats)}")
+
     async def start(self):
         """Устаревший метод, используется connect_to_telegram()"""
         return await self.connect_to_telegram()
@@ -1937,53 +3296,39 @@ class TelegramClientWrapper:
 
     async def handle_new_message(self, event):
         """Обработка нового сообщения"""
+        self.ingest_message(event.message, event.chat_id)
+
+    def ingest_message(self, message, chat_id):
+        """Разбор нового сообщения (живого или из getDifference)
+
+        Сообщение только разбирается в запись и передаётся в пакетную
+        запись (ingest): сохранение и уведомление WebSocket выполняются
+        пачкой. Имена берутся из кэша сущностей, который пополняется
+        сущностями, пришедшими вместе с обновлением.
+        """
         try:
-            message = event.message
-            
             # Определяем тип медиа
-            media_type = None
-            file_id = None
-            file_name = None
-            file_size = None
-            
-            if message.photo:
-                media_type = 'photo'
-                file_id = str(message.photo.id) if hasattr(message.photo, 'id') else None
-            elif message.video:
-                media_type = 'video'
-                file_id = str(message.video.id) if hasattr(message.video, 'id') else None
-                file_size = message.video.size if hasattr(message.video, 'size') else None
-            elif message.document:
-                media_type = 'document'
-                file_id = str(message.document.id) if hasattr(message.document, 'id') else None
-                file_size = message.document.size if hasattr(message.document, 'size') else None
-                file_name = message.document.file_name if hasattr(message.document, 'file_name') else None
+            media_type, file_id, file_name, file_size = message_media_info(message)
             
             # Пропускаем только системные сообщения без текста и медиа
             if not message.text and not media_type:
                 logger.debug(f"Пропущено сообщение {message.id} без текста и медиа")
                 return
 
-            # Формируем текст для логирования
-            log_text = message.text[:50] if message.text else f"[{media_type}]"
-            logger.info(f"📩 Новое сообщение в чате {event.chat_id}: {log_text}...")
-
-            chat = await message.get_chat()
-            sender = await message.get_sender()
+            remember_message_entities([message])
 
-            chat_title = getattr(chat, 'title', None) or getattr(chat, 'username', None) or f"chat_{chat.id}"
-            sender_name = "Unknown"
-            if sender:
-                sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', '') or getattr(sender, 'title', 'Unknown')
+            chat_row = entity_cache.get(chat_id)
+            chat_title = (chat_row.get('name') or chat_row.get('username')) if chat_row else None
+            sender_name = entity_cache.display_name(message.sender_id)
 
             message_date = message.date.isoformat() if hasattr(message.date, 'isoformat') else str(message.date)
             
             # Получаем текст или описание медиа
             text = message.text or f"[{media_type}]"
 
-            saved = db.save_message(
+            record = db.build_message_record(
                 message_id=message.id,
-                chat_id=chat.id,
+                chat_id=chat_id,
                 chat_title=chat_title,
                 text=text,
                 sender_name=sender_name,
@@ -1991,92 +3336,69 @@ class TelegramClientWrapper:
                 media_type=media_type,
                 file_id=file_id,
                 file_name=file_name,
-                file_size=file_size
+                file_size=file_size,
+                sender_id=message.sender_id
             )
-            logger.info(f"{'✅' if saved else '⚠️'} Сообщение сохранено в БД: {message.id}")
-
-            await manager.broadcast({
-                'type': 'new_message',
-                'message': {
-                    'message_id': message.id,
-                    'chat_id': chat.id,
-                    'chat_title': chat_title,
-                    'text': message.text,
-                    'sender_name': sender_name,
-                    'message_date': message_date
-                }
+            ingest.submit(record, {
+                'message_id': message.id,
+                'chat_id': chat_id,
+                'chat_title': chat_title or f"chat_{chat_id}",
+                'text': message.text,
+                'sender_name': sender_name,
+                'message_date': message_date
             })
-            print("📡 Отправлено уведомление WebSocket")
+            logger.debug(f"📩 Новое сообщение в чате {chat_id}: {message.id}")
 
         except Exception as e:
             print(f"❌ Ошибка обработки сообщения: {e}")
 
     async def handle_message_edit(self, event):
-        """Обработка редактирования сообщения"""
+        """Обработка редактирования сообщения
+
+        Обновляются только текст и дата редактирования одной транзакцией,
+        без чтения полного RAW и без запросов к Telegram.
+        """
+        await self.apply_edit(event.message, event.chat_id)
+
+    async def apply_edit(self, message, chat_id):
+        """Применить редактирование (живое или из getDifference)"""
         try:
-            message = event.message
             edit_date = message.edit_date.isoformat() if hasattr(message.edit_date, 'isoformat') else str(message.edit_date)
 
-            # Получаем старое сообщение из БД
-            old_raw = db.get_message_raw_data(message.chat_id, message.id)
+            # Сообщение может ещё ждать пакетной записи
+            await ingest.drain()
+            result = db.apply_message_edit(chat_id, message.id, message.text or '', edit_date)
 
-            # Сохраняем историю редактирования
-            if old_raw:
-                db.save_message_edit(
-                    chat_id=message.chat_id,
-                    message_id=message.id,
-                    old_text=old_raw.get('text', ''),
-                    new_text=message.text or '',
-                    old_raw_data=old_raw
-                )
-                logger.info(f"✏️ Сообщение {message.id} отредактировано")
-
-            # Обновляем сообщение в БД
-            chat = await message.get_chat()
-            chat_title = getattr(chat, 'title', None) or f"chat_{message.chat_id}"
-            sender = await message.get_sender()
-            sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', 'Unknown')
+            if result is None:
+                # Сообщения ещё нет в архиве — сохраняем как новое
+                self.ingest_message(message, chat_id)
+                return
 
-            db.save_message(
-                message_id=message.id,
-                chat_id=message.chat_id,
-                chat_title=chat_title,
-                text=message.text or '',
-                sender_name=sender_name,
-                message_date=message.date.isoformat(),
-                edit_date=edit_date
-            )
+            if result['changed']:
+                logger.info(f"✏️ Сообщение {message.id} отредактировано")
 
-            await manager.broadcast({
-                'type': 'message_edited',
-                'message_id': message.id,
-                'chat_id': message.chat_id,
-                'edit_date': edit_date
-            })
+                await manager.broadcast({
+                    'type': 'message_edited',
+                    'message_id': message.id,
+                    'chat_id': chat_id,
+                    'edit_date': edit_date
+                })
 
         except Exception as e:
             print(f"❌ Ошибка обработки редактирования: {e}")
 
     async def handle_message_delete(self, event):
         """Обработка удаления сообщения"""
-        try:
-            chat_id = event.chat_id
-            deleted_ids = event.deleted_ids
+        await self.apply_delete(event.chat_id, event.deleted_ids)
 
-            for msg_id in deleted_ids:
-                # Отмечаем сообщение как удалённое
-                db.mark_message_deleted(chat_id, msg_id)
-
-                # Добавляем событие
-                cursor = sqlite3.connect(db.db_path).cursor()
-                cursor.execute('''
-                    INSERT INTO message_events (chat_id, message_id, event_type, event_date, event_data)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (chat_id, msg_id, 'deleted', datetime.now().isoformat(), None))
-                cursor.connection.commit()
-                cursor.connection.close()
-
-                logger.info(f"🗑️ Сообщение {msg_id} удалено в чате {chat_id}")
+    async def apply_delete(self, chat_id, deleted_ids):
+        """Отметить удалённые сообщения (живое событие или из getDifference)"""
+        try:
+            # Одна транзакция на всё событие: отметка и события удаления
+            # Удаление без чата — ID основного аккаунта (живые обновления и getDifference)
+            primary = account_pool.primary
+            marked = db.mark_messages_deleted(chat_id, deleted_ids, account=primary.name if primary else None)
+            logger.info(f"🗑️ Удалено сообщений: {len(deleted_ids)} (событий: {marked}), чат {chat_id}")
 
             await manager.broadcast({
                 'type': 'messages_deleted',
@@ -2087,34 +3409,106 @@ class TelegramClientWrapper:
         except Exception as e:
             print(f"❌ Ошибка обработки удаления: {e}")
 
+    async def call_request(self, request, method='updates'):
+        """Запрос к Telegram через rate limiter"""
+        return await retry_on_error(self.client, request, method=method)
+
+    async def catch_up_updates(self):
+        """Догрузка пропущенного после простоя
+
+        С сохранённым состоянием обновлений Telegram отдаёт только разницу
+        (getDifference / getChannelDifference). Без состояния, при слишком
+        большом разрыве или ошибке — прежняя догрузка по дате.
+        """
+        if CONFIG['AUTO_LOAD_MISSED']:
+            print("🔍 Автодогрузка пропущенных...")
+            result = None
+            if CONFIG['UPDATES_CATCH_UP']:
+                try:
+                    result = await updates_tracker.catch_up(
+                        self.client, self.call_request,
+                        on_message=self.catch_up_message,
+                        on_edit=self.catch_up_edit,
+                        on_delete=self.apply_delete,
+                        input_channel=input_channel_for
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка догрузки через getDifference: {e}")
+                    result = None
+
+            if result is None or result['too_long']:
+                try:
+                    await self.auto_load_missed()
+                except Exception as e:
+                    logger.error(f"Ошибка автодогрузки пропущенных: {e}")
+            if result is not None:
+                print(f"✅ getDifference: {result['messages']} сообщений, каналов: {result['channels']}, "
+                      f"запросов: {result['requests']}")
+                for chat_id in result['fallback_chats']:
+                    await task_queue.add_task(
+                        task_id=str(uuid.uuid4())[:8], task_type='load_missed',
+                        priority='live', chat_id=chat_id
+                    )
+                if result['messages']:
+                    await manager.broadcast({
+                        'type': 'missed_loaded',
+                        'count': result['messages']
+                    })
+
+        # Новая точка отсчёта и периодическое сохранение состояния
+        try:
+            await updates_tracker.save_state(self.call_request)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния обновлений: {e}")
+        asyncio.create_task(updates_tracker.run(self.call_request, CONFIG['UPDATES_STATE_INTERVAL']))
+
+        # Периодическая синхронизация отслеживаемых чатов
+        if CONFIG['SYNC_SCHEDULER']:
+            sync_scheduler.start(self.call_request, input_peer_for, enqueue_scheduled_sync)
+
+    async def catch_up_message(self, message):
+        """Новое сообщение из getDifference"""
+        self.ingest_message(message, message.chat_id)
+
+    async def catch_up_edit(self, message):
+        """Изменённое сообщение из getDifference"""
+        await self.apply_edit(message, message.chat_id)
+
     async def auto_load_missed(self):
-        """Автодогрузка пропущенных"""
-        print("\n🔍 Автодогрузка пропущенных сообщений...")
-        chats = db.get_chats_with_messages()
+        """Автодогрузка пропущенных после подключения (приоритет live)
 
-        for chat_info in chats[:10]:
-            result = await load_missed_messages_for_chat(
-                self.client, chat_info['chat_id'],
-                limit=CONFIG['MISSED_LIMIT_PER_CHAT']
-            )
-            await asyncio.sleep(2)
+        Догружаются только чаты, в которых top_message диалога новее сохранённого.
+        """
+        print("\n🔍 Автодогрузка пропущенных сообщений...")
+        plan = await sync_planner.plan(self.client, rate_limiter.acquire, continue_history=False)
+        task_ids, _ = await enqueue_sync_plan(plan, missed=True, priority='live')
+        print(f"✅ Чатов с новыми сообщениями: {plan['summary']['missed']}, задач: {len(task_ids)}")
 
     async def auto_load_history(self):
-        """Автозагрузка истории"""
+        """Автозагрузка истории групп и каналов по плану синхронизации
+
+        Задачи ставятся только для новых чатов (load_history) и чатов,
+        в которых top_message диалога новее сохранённого (load_missed).
+        """
         print("\n📥 Автозагрузка истории...")
-        async for dialog in self.client.iter_dialogs(limit=CONFIG['MAX_CHATS_TO_LOAD']):
-            if dialog.is_group or dialog.is_channel:
-                if dialog.id > 0:
-                    continue
-                await load_chat_history_with_rate_limit(
-                    self.client, dialog.id,
-                    limit=CONFIG['HISTORY_LIMIT_PER_CHAT']
-                )
-                await asyncio.sleep(2)
+        plan = await sync_planner.plan(
+            self.client, rate_limiter.acquire, limit=CONFIG['MAX_CHATS_TO_LOAD'],
+            continue_history=CONFIG['HISTORY_LIMIT_PER_CHAT'] == 0
+        )
+        task_ids, _ = await enqueue_sync_plan(plan, missed=True, history=True, kinds=('group', 'channel'))
+        summary = plan['summary']
+        print(f"✅ План: задач {len(task_ids)}, новые сообщения в {summary['missed']} чатах, "
+              f"актуальны {summary['up_to_date']} из {summary['dialogs']}")
 
     async def stop(self):
         """Остановка клиента"""
         self.running = False
+        sync_scheduler.stop()
+        await takeout_manager.finish()
+        await ingest.stop()
+        for account in account_pool.accounts.values():
+            if not account.primary:
+                await account.client.disconnect()
         if self.client:
             await self.client.disconnect()
 
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Telegrab Updates Catch-up
+Сохранение состояния обновлений (pts/qts/date/seq и pts каналов)
+и догрузка пропущенного через updates.getDifference / getChannelDifference
+"""
+
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from itertools import chain
+from typing import Awaitable, Callable, Dict, Optional
+
+from telethon import utils
+from telethon.tl import types
+from telethon.tl.functions.updates import (
+    GetChannelDifferenceRequest,
+    GetDifferenceRequest,
+    GetStateRequest
+)
+
+logger = logging.getLogger('telegrab')
+
+# Сообщений за один запрос getChannelDifference
+CHANNEL_DIFFERENCE_LIMIT = 100
+
+# Обновления с новыми / изменёнными / удалёнными сообщениями
+NEW_MESSAGE_UPDATES = (types.UpdateNewMessage, types.UpdateNewChannelMessage)
+EDIT_MESSAGE_UPDATES = (types.UpdateEditMessage, types.UpdateEditChannelMessage)
+
+
+def update_channel_id(update) -> Optional[int]:
+    """ID канала (без маркера), к последовательности pts которого относится обновление"""
+    channel_id = getattr(update, 'channel_id', None)
+    if channel_id is not None:
+        return channel_id
+    peer = getattr(getattr(update, 'message', None), 'peer_id', None)
+    if isinstance(update, (types.UpdateNewChannelMessage, types.UpdateEditChannelMessage)) \
+            and isinstance(peer, types.PeerChannel):
+        return peer.channel_id
+    return None
+
+
+class UpdatesTracker:
+    """
+    Состояние обновлений аккаунта для догрузки после простоя
+
+    Обработчик events.Raw передаёт каждое обновление в observe(). Новые
+    сообщения пишутся пачками (IngestPipeline), поэтому pts обновления
+    подтверждается, только когда записана пачка с его сообщением
+    (ingest.committed >= номера последней поданной записи на момент
+    observe). Общее состояние (qts, date, seq) периодически запрашивается
+    через updates.getState и сохраняется вместе с pts каналов в БД; pts
+    сохраняется не дальше подтверждённого, так что после сбоя
+    getDifference повторит всё, что не успело попасть в архив.
+
+    После переподключения catch_up() запрашивает у Telegram только
+    разницу с сохранённым состоянием: getDifference для личных чатов и
+    групп, getChannelDifference для каждого известного канала. Новые,
+    изменённые и удалённые сообщения передаются в обработчики. Если
+    состояния нет или разница слишком велика (TooLong), вызывающий код
+    догружает такие чаты прежним способом (по дате).
+    """
+
+    def __init__(self, store, ingest=None):
+        """
+        Args:
+            store: База данных с методами get/save_updates_state и get/save_channel_pts
+            ingest: Пакетная запись сообщений (submitted / committed / drain);
+                None — pts подтверждаются сразу
+        """
+        self.store = store
+        self.ingest = ingest
+        # Подтверждённый pts общей последовательности (None — ещё нет)
+        self.pts: Optional[int] = None
+        self.channel_pts: Dict[int, int] = {}
+        # (номер записи ingest, channel_id или None, pts) — ждут записи пачки
+        self._pending = deque()
+        self._dirty = set()
+        self.last_saved_at = None
+        self.stats = {'observed': 0, 'caught_up_messages': 0, 'caught_up_channels': 0, 'fallbacks': 0}
+
+    def observe(self, update):
+        """
+        Запомнить pts обработанного обновления
+
+        Обработчики сообщений вызываются раньше events.Raw, поэтому
+        сообщение обновления уже подано в ingest: pts подтверждается,
+        когда записаны все поданные к этому моменту записи.
+        """
+        pts = getattr(update, 'pts', None)
+        if pts is None:
+            return
+        self.stats['observed'] += 1
+        seq = self.ingest.submitted if self.ingest is not None else 0
+        self._pending.append((seq, update_channel_id(update), pts))
+        self._confirm()
+
+    def _confirm(self):
+        """Подтвердить pts обновлений, сообщения которых уже записаны"""
+        committed = self.ingest.committed if self.ingest is not None else None
+        while self._pending and (committed is None or self._pending[0][0] <= committed):
+            _, channel_id, pts = self._pending.popleft()
+            if channel_id is None:
+                if self.pts is None or pts > self.pts:
+                    self.pts = pts
+            elif pts > self.channel_pts.get(channel_id, 0):
+                self.channel_pts[channel_id] = pts
+                self._dirty.add(channel_id)
+
+    async def _drain(self) -> bool:
+        """Дождаться записи поданных сообщений (False — БД недоступна)"""
+        if self.ingest is not None and not await self.ingest.drain():
+            return False
+        self._confirm()
+        return True
+
+    def seed_channels(self, channels: Dict[int, int]):
+        """Начальные pts каналов (например, из dialog.pts), если своих ещё нет"""
+        stored = self.store.get_channel_pts() if channels else {}
+        for channel_id, pts in channels.items():
+            if channel_id in self.channel_pts or channel_id in stored:
+                continue
+            self.channel_pts[channel_id] = pts
+            self._dirty.add(channel_id)
+        self.flush_channels()
+
+    def flush_channels(self):
+        """Сохранить изменившиеся подтверждённые pts каналов"""
+        self._confirm()
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            self.store.save_channel_pts({cid: self.channel_pts[cid] for cid in dirty})
+        except Exception as e:
+            self._dirty |= dirty
+            logger.error(f"Ошибка сохранения pts каналов: {e}")
+
+    async def save_state(self, call: Callable[..., Awaitable]):
+        """
+        Запросить updates.getState и сохранить общее состояние и pts каналов
+
+        Сначала дожидается записи буфера ingest. pts берётся не дальше
+        подтверждённого: getState учитывает и обновления, которые ещё не
+        дошли до обработчиков. Серверный pts сохраняется как есть, только
+        пока подтверждённого нет (первое сохранение без catch_up).
+        """
+        if not await self._drain():
+            logger.warning("Состояние обновлений не сохранено: буфер сообщений не записан")
+            return
+        state = await call(GetStateRequest(), method='updates')
+        if self.pts is None:
+            self.pts = state.pts
+        self.store.save_updates_state({
+            'pts': min(state.pts, self.pts),
+            'qts': state.qts,
+            'date': int(state.date.timestamp()) if isinstance(state.date, datetime) else state.date,
+            'seq': state.seq
+        })
+        self.flush_channels()
+        self.last_saved_at = datetime.now().isoformat()
+
+    async def run(self, call: Callable[..., Awaitable], interval: float = 60):
+        """Периодическое сохранение состояния"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save_state(call)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения состояния обновлений: {e}")
+
+    async def catch_up(self, client, call: Callable[..., Awaitable],
+                       on_message: Callable, on_edit: Callable, on_delete: Callable,
+                       input_channel: Callable[[int], Optional[object]]) -> Optional[Dict]:
+        """
+        Догрузить пропущенное с момента сохранённого состояния
+
+        Args:
+            client: Telethon клиент (для инициализации сообщений)
+            call: Обёртка запроса (request, method=...) с rate limiter
+            on_message: Обработчик нового сообщения (message)
+            on_edit: Обработчик изменённого сообщения (message)
+            on_delete: Обработчик удаления (chat_id или None, [ids])
+            input_channel: InputChannel по ID канала (None если неизвестен)
+
+        Returns:
+            Статистика, либо None если сохранённого состояния нет
+            (нужна догрузка по дате). В 'fallback_chats' — чаты, которые
+            нужно догрузить по дате.
+        """
+        state = self.store.get_updates_state()
+        if not state:
+            return None
+
+        handlers = (on_message, on_edit, on_delete)
+        result = {'messages': 0, 'channels': 0, 'requests': 0, 'fallback_chats': [], 'too_long': False}
+        channels = dict(self.store.get_channel_pts())
+
+        # 1. Общая последовательность: личные чаты и обычные группы
+        pts, qts, date = state['pts'], state['qts'], state['date']
+        while True:
+            diff = await call(GetDifferenceRequest(pts=pts, date=date, qts=qts), method='updates')
+            result['requests'] += 1
+
+            if isinstance(diff, types.updates.DifferenceEmpty):
+                date = diff.date
+                break
+            if isinstance(diff, types.updates.DifferenceTooLong):
+                # Разрыв слишком велик — эти чаты догружаются по дате
+                result['too_long'] = True
+                pts = diff.pts
+                break
+
+            entities = self._entities(diff)
+            for message in diff.new_messages:
+                result['messages'] += await self._dispatch_message(client, message, entities, on_message)
+            for update in diff.other_updates:
+                if isinstance(update, types.UpdateChannelTooLong):
+                    # Канал с пропущенными обновлениями: догружаем его ниже
+                    if update.channel_id not in channels:
+                        channels[update.channel_id] = update.pts
+                    continue
+                result['messages'] += await self._dispatch_update(client, update, entities, *handlers)
+
+            new_state = diff.intermediate_state if isinstance(diff, types.updates.DifferenceSlice) else diff.state
+            pts, qts, date = new_state.pts, new_state.qts, new_state.date
+            if isinstance(diff, types.updates.Difference):
+                break
+
+        # 2. Каналы: каждый со своей последовательностью pts
+        for channel_id, channel_pts in channels.items():
+            if not channel_pts:
+                result['fallback_chats'].append(utils.get_peer_id(types.PeerChannel(channel_id)))
+                continue
+            channel = input_channel(channel_id)
+            if channel is None:
+                result['fallback_chats'].append(utils.get_peer_id(types.PeerChannel(channel_id)))
+                continue
+            try:
+                count, channel_pts = await self._catch_up_channel(client, call, channel, channel_pts, handlers, result)
+            except Exception as e:
+                logger.warning(f"getChannelDifference для {channel_id} не удался: {e}")
+                result['fallback_chats'].append(utils.get_peer_id(types.PeerChannel(channel_id)))
+                continue
+            result['messages'] += count
+            result['channels'] += 1
+            if channel_pts > self.channel_pts.get(channel_id, 0):
+                self.channel_pts[channel_id] = channel_pts
+                self._dirty.add(channel_id)
+
+        # Сообщения разницы поданы в ingest — состояние сохраняется после их записи
+        if await self._drain():
+            if self.pts is None or pts > self.pts:
+                self.pts = pts
+            self.store.save_updates_state({
+                'pts': pts,
+                'qts': qts,
+                'date': int(date.timestamp()) if isinstance(date, datetime) else date,
+                'seq': state.get('seq', 0)
+            })
+            self.flush_channels()
+        else:
+            logger.warning("Состояние обновлений не сохранено: буфер сообщений не записан")
+
+        self.stats['caught_up_messages'] += result['messages']
+        self.stats['caught_up_channels'] += result['channels']
+        self.stats['fallbacks'] += len(result['fallback_chats']) + (1 if result['too_long'] else 0)
+        return result
+
+    async def _catch_up_channel(self, client, call, channel, pts, handlers, result):
+        """getChannelDifference до final; возвращает (сообщений, новый pts)"""
+        count = 0
+        while True:
+            diff = await call(GetChannelDifferenceRequest(
+                channel=channel, filter=types.ChannelMessagesFilterEmpty(),
+                pts=pts, limit=CHANNEL_DIFFERENCE_LIMIT, force=True
+            ), method='updates')
+            result['requests'] += 1
+
+            if isinstance(diff, types.updates.ChannelDifferenceEmpty):
+                return count, diff.pts
+
+            entities = self._entities(diff)
+            if isinstance(diff, types.updates.ChannelDifferenceTooLong):
+                # Последние сообщения сохраняем, остальное — догрузка по дате
+                for message in diff.messages:
+                    count += await self._dispatch_message(client, message, entities, handlers[0])
+                result['fallback_chats'].append(utils.get_peer_id(channel))
+                return count, getattr(diff.dialog, 'pts', None) or pts
+
+            for message in diff.new_messages:
+                count += await self._dispatch_message(client, message, entities, handlers[0])
+            for update in diff.other_updates:
+                count += await self._dispatch_update(client, update, entities, *handlers)
+
+            pts = diff.pts
+            if diff.final:
+                return count, pts
+
+    @staticmethod
+    def _entities(diff) -> Dict:
+        """Сущности ответа по peer_id"""
+        return {utils.get_peer_id(x): x for x in chain(diff.users, diff.chats)}
+
+    @staticmethod
+    async def _dispatch_message(client, message, entities, handler) -> int:
+        """Инициализировать сырое сообщение и передать обработчику"""
+        if isinstance(message, types.MessageEmpty):
+            return 0
+        message._finish_init(client, entities, None)
+        await handler(message)
+        return 1
+
+    async def _dispatch_update(self, client, update, entities, on_message, on_edit, on_delete) -> int:
+        """Разобрать обновление из other_updates"""
+        if isinstance(update, NEW_MESSAGE_UPDATES):
+            return await self._dispatch_message(client, update.message, entities, on_message)
+        if isinstance(update, EDIT_MESSAGE_UPDATES):
+            if not isinstance(update.message, types.MessageEmpty):
+                update.message._finish_init(client, entities, None)
+                await on_edit(update.message)
+        elif isinstance(update, types.UpdateDeleteChannelMessages):
+            await on_delete(utils.get_peer_id(types.PeerChannel(update.channel_id)), update.messages)
+        elif isinstance(update, types.UpdateDeleteMessages):
+            await on_delete(None, update.messages)
+        return 0
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'pts': self.pts, 'pending': len(self._pending),
+                'channels_tracked': len(self.channel_pts), 'last_saved_at': self.last_saved_at}
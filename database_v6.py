@@ -8,7 +8,7 @@ import os
 import json
 import sqlite3
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 
 logger = logging.getLogger('telegrab')
@@ -38,6 +38,10 @@ class DatabaseV6:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        # WAL: читатели (HTTP воркеры в других процессах) не блокируют запись
+        # и не блокируются ею; режим сохраняется в файле БД
+        cursor.execute('PRAGMA journal_mode=WAL')
+
         # ============================================================
         # ТАБЛИЦА ЧАТОВ (справочник)
         # ============================================================
@@ -102,6 +106,7 @@ class DatabaseV6:
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_meta_date ON message_meta(message_date)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_meta_sender ON message_meta(sender_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_meta_deleted ON message_meta(is_deleted)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_meta_message ON message_meta(chat_id, message_id)')
         logger.debug("Таблица message_meta создана")
 
         # ============================================================
@@ -179,6 +184,94 @@ class DatabaseV6:
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_event_type ON message_events(event_type)')
         logger.debug("Таблица message_events создана")
 
+        # ============================================================
+        # ТАБЛИЦА СКОРОСТЕЙ ЗАПРОСОВ (адаптивный rate limiter)
+        # ============================================================
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                method              TEXT PRIMARY KEY,
+                rate                REAL NOT NULL,
+                flood_count         INTEGER DEFAULT 0,
+                last_flood_at       TIMESTAMP,
+                last_flood_seconds  INTEGER,
+                updated_at          TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        logger.debug("Таблица rate_limits создана")
+
+        # ============================================================
+        # ТАБЛИЦА СУЩНОСТЕЙ (кэш отправителей и чатов)
+        # ============================================================
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                peer_id         INTEGER PRIMARY KEY,
+                kind            TEXT,
+                name            TEXT,
+                username        TEXT,
+                access_hash     INTEGER,
+                updated_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        logger.debug("Таблица entities создана")
+
+        # Резолвер: идентификатор из /load (ID, username, ссылка) -> peer_id
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_resolver (
+                identifier      TEXT PRIMARY KEY,
+                peer_id         INTEGER NOT NULL,
+                resolved_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        logger.debug("Таблица chat_resolver создана")
+
+        # ============================================================
+        # СОСТОЯНИЕ ОБНОВЛЕНИЙ (догрузка через getDifference)
+        # ============================================================
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS updates_state (
+                id              INTEGER PRIMARY KEY CHECK (id = 1),
+                pts             INTEGER NOT NULL,
+                qts             INTEGER NOT NULL,
+                date            INTEGER NOT NULL,
+                seq             INTEGER DEFAULT 0,
+                updated_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS channel_pts (
+                channel_id      INTEGER PRIMARY KEY,
+                pts             INTEGER NOT NULL,
+                updated_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        logger.debug("Таблицы updates_state и channel_pts созданы")
+
+        # ============================================================
+        # ТАБЛИЦА ЗАДАЧ (персистентная очередь загрузки)
+        # ============================================================
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id         TEXT PRIMARY KEY,
+                task_type       TEXT NOT NULL,
+                chat_key        TEXT,
+                status          TEXT NOT NULL,
+                priority        TEXT,
+                data            TEXT,
+                checkpoint      TEXT,
+                result          TEXT,
+                error           TEXT,
+                attached        INTEGER DEFAULT 0,
+                created_at      TIMESTAMP,
+                started_at      TIMESTAMP,
+                completed_at    TIMESTAMP,
+                updated_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_chat ON tasks(task_type, chat_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_completed ON tasks(completed_at)')
+        logger.debug("Таблица tasks создана")
+
         # ============================================================
         # СТАРЫЕ ТАБЛИЦЫ (для обратной совместимости при миграции)
         # ============================================================
@@ -190,7 +283,87 @@ class DatabaseV6:
                 total_loaded INTEGER DEFAULT 0,
                 fully_loaded BOOLEAN DEFAULT 0,
                 last_loading_date TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                page_size INTEGER,
+                avg_latency_ms REAL
+            )
+        ''')
+
+        # Миграция: размер страницы и задержка ответа для адаптивной загрузки
+        cursor.execute('PRAGMA table_info(chat_loading_status)')
+        columns = {row[1] for row in cursor.fetchall()}
+        if 'page_size' not in columns:
+            cursor.execute('ALTER TABLE chat_loading_status ADD COLUMN page_size INTEGER')
+        if 'avg_latency_ms' not in columns:
+            cursor.execute('ALTER TABLE chat_loading_status ADD COLUMN avg_latency_ms REAL')
+
+        # Диапазоны ID параллельной загрузки истории чата
+        # (контрольная точка offset_id у каждого диапазона своя)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_loading_ranges (
+                chat_id         INTEGER,
+                range_start     INTEGER,
+                range_end       INTEGER,
+                offset_id       INTEGER,
+                loaded          INTEGER DEFAULT 0,
+                done            BOOLEAN DEFAULT 0,
+                updated_at      TEXT,
+                PRIMARY KEY (chat_id, range_start)
+            )
+        ''')
+
+        # Последний top_message диалога, до которого чат догружен
+        # (служебные сообщения в архив не попадают, поэтому MAX(message_id) может отставать)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_sync_state (
+                chat_id         INTEGER PRIMARY KEY,
+                synced_top_id   INTEGER DEFAULT 0,
+                synced_at       TEXT
+            )
+        ''')
+
+        # Расписание периодической синхронизации отслеживаемых чатов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_schedule (
+                chat_id             INTEGER PRIMARY KEY,
+                interval_seconds    INTEGER,
+                rate_per_hour       REAL DEFAULT 0,
+                observed_rate       REAL DEFAULT 0,
+                next_run_at         TEXT,
+                last_run_at         TEXT,
+                last_new_messages   INTEGER DEFAULT 0
+            )
+        ''')
+
+        # Закрепление чатов за аккаунтами (ключ — нормализованный идентификатор чата)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_accounts (
+                chat_key    TEXT PRIMARY KEY,
+                account     TEXT NOT NULL,
+                assigned_at TEXT
+            )
+        ''')
+
+        # Журнал изменений сообщений (CDC): seq монотонно растёт и не
+        # переиспользуется (AUTOINCREMENT), запись — в транзакции изменения
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS changes (
+                seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+                op         TEXT NOT NULL,
+                chat_id    INTEGER,
+                message_id INTEGER,
+                changed_at TEXT NOT NULL
+            )
+        ''')
+
+        # Состояние реплики: курсор журнала изменений источника и позиция
+        # начального снимка (snapshot_after NULL — снимок завершён)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS replication_state (
+                source         TEXT PRIMARY KEY,
+                cursor         INTEGER NOT NULL DEFAULT 0,
+                snapshot_after INTEGER,
+                updated_at     TEXT
             )
         ''')
 
@@ -292,76 +465,302 @@ class DatabaseV6:
         cursor = conn.cursor()
 
         try:
-            # 1. Сохраняем RAW данные
+            self._write_message(cursor, chat_id, message_id, raw_data, meta, files)
+            conn.commit()
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка сохранения сообщения: {e}")
+            conn.rollback()
+            return False
+
+        finally:
+            conn.close()
+
+    def _write_message(self, cursor, chat_id: int, message_id: int, raw_data: dict,
+                       meta: dict = None, files: list = None):
+        """Запись сообщения (RAW + Meta + файлы) в открытой транзакции"""
+        # 1. Сохраняем RAW данные
+        cursor.execute('''
+            INSERT OR REPLACE INTO messages_raw (chat_id, message_id, raw_data, saved_at)
+            VALUES (?, ?, ?, ?)
+        ''', (
+            chat_id,
+            message_id,
+            json.dumps(raw_data, ensure_ascii=False),
+            datetime.now().isoformat()
+        ))
+
+        # 2. Сохраняем метаданные (у message_meta нет уникального ключа —
+        # удаляем прежнюю строку, чтобы повторное сохранение не дублировало её)
+        if meta:
             cursor.execute('''
-                INSERT OR REPLACE INTO messages_raw (chat_id, message_id, raw_data, saved_at)
-                VALUES (?, ?, ?, ?)
+                DELETE FROM message_meta WHERE chat_id = ? AND message_id = ?
+            ''', (chat_id, message_id))
+            cursor.execute('''
+                INSERT OR REPLACE INTO message_meta
+                (chat_id, message_id, sender_id, sender_name, message_date,
+                 has_media, media_type, text_preview, has_forward, has_reply,
+                 edit_date, views, is_deleted)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 chat_id,
                 message_id,
-                json.dumps(raw_data, ensure_ascii=False),
-                datetime.now().isoformat()
+                meta.get('sender_id'),
+                meta.get('sender_name'),
+                meta.get('message_date'),
+                1 if meta.get('has_media') else 0,
+                meta.get('media_type'),
+                meta.get('text_preview', '')[:500],
+                1 if meta.get('has_forward') else 0,
+                1 if meta.get('has_reply') else 0,
+                meta.get('edit_date'),
+                meta.get('views'),
+                0
             ))
 
-            # 2. Сохраняем метаданные
-            if meta:
+        # 3. Сохраняем файлы (если есть)
+        if files:
+            for idx, file_info in enumerate(files):
+                # Сначала сохраняем файл в таблицу files
                 cursor.execute('''
-                    INSERT OR REPLACE INTO message_meta
-                    (chat_id, message_id, sender_id, sender_name, message_date,
-                     has_media, media_type, text_preview, has_forward, has_reply,
-                     edit_date, views, is_deleted)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    INSERT OR IGNORE INTO files
+                    (file_id, file_type, file_size, file_name, mime_type,
+                     thumb_file_id, width, height, duration)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
-                    chat_id,
-                    message_id,
-                    meta.get('sender_id'),
-                    meta.get('sender_name'),
-                    meta.get('message_date'),
-                    1 if meta.get('has_media') else 0,
-                    meta.get('media_type'),
-                    meta.get('text_preview', '')[:500],
-                    1 if meta.get('has_forward') else 0,
-                    1 if meta.get('has_reply') else 0,
-                    meta.get('edit_date'),
-                    meta.get('views'),
-                    0
+                    file_info.get('file_id'),
+                    file_info.get('file_type'),
+                    file_info.get('file_size'),
+                    file_info.get('file_name'),
+                    file_info.get('mime_type'),
+                    file_info.get('thumb_file_id'),
+                    file_info.get('width'),
+                    file_info.get('height'),
+                    file_info.get('duration')
                 ))
 
-            # 3. Сохраняем файлы (если есть)
-            if files:
-                for idx, file_info in enumerate(files):
-                    # Сначала сохраняем файл в таблицу files
+                # Затем связь с сообщением
+                cursor.execute('''
+                    INSERT OR IGNORE INTO message_files
+                    (chat_id, message_id, file_id, file_order)
+                    VALUES (?, ?, ?, ?)
+                ''', (chat_id, message_id, file_info.get('file_id'), idx))
+
+        self._log_changes(cursor, 'upsert', [(chat_id, message_id)])
+
+    @staticmethod
+    def _log_changes(cursor, op: str, pairs: List[tuple]):
+        """Запись в журнал изменений в открытой транзакции (op: upsert, edit, delete, clear)"""
+        now = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT INTO changes (op, chat_id, message_id, changed_at) VALUES (?, ?, ?, ?)
+        ''', [(op, chat_id, message_id, now) for chat_id, message_id in pairs])
+
+    def save_messages_batch(self, records: List[Dict]) -> int:
+        """
+        Сохранение пачки сообщений одной транзакцией
+
+        Args:
+            records: Записи из build_message_record() в порядке поступления
+
+        Returns:
+            Количество сохранённых сообщений
+
+        Raises:
+            Исключение SQLite после отката: вызывающий код повторяет пачку
+        """
+        if not records:
+            return 0
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        try:
+            # Чаты: известное название не затираем пустым
+            chats = {}
+            for record in records:
+                title = record['raw_data'].get('chat_title')
+                if title or record['chat_id'] not in chats:
+                    chats[record['chat_id']] = title
+            now = datetime.now().isoformat()
+            cursor.executemany('''
+                INSERT INTO chats (chat_id, title, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, chats.title),
+                    updated_at = excluded.updated_at
+            ''', [(chat_id, title, now) for chat_id, title in chats.items()])
+
+            for record in records:
+                self._write_message(cursor, record['chat_id'], record['message_id'],
+                                    record['raw_data'], record['meta'], record['files'])
+
+            conn.commit()
+            return len(records)
+
+        except Exception as e:
+            logger.error(f"Ошибка пакетного сохранения сообщений: {e}")
+            conn.rollback()
+            raise
+
+        finally:
+            conn.close()
+
+    def import_messages(self, rows: List[tuple], skip_duplicates: bool = True,
+                        update_edits: bool = False) -> Dict:
+        """
+        Импорт пачки сообщений через промежуточную таблицу одной транзакцией
+
+        Строки загружаются во временную таблицу import_stage, дубликаты
+        определяются одним соединением с messages_raw (по уникальному
+        индексу), остальное переносится INSERT ... SELECT без запросов на
+        каждое сообщение.
+
+        Args:
+            rows: Кортежи import_stream.import_row()
+            skip_duplicates: Уже сохранённые сообщения пропускаются (иначе перезаписываются)
+            update_edits: Для пропущенных дубликатов с другим текстом — записать
+                редактирование (message_edits, json_set текста)
+
+        Returns:
+            {'imported', 'skipped', 'updated'}
+        """
+        result = {'imported': 0, 'skipped': 0, 'updated': 0}
+        if not rows:
+            return result
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+
+        try:
+            cursor.execute('''
+                CREATE TEMP TABLE import_stage (
+                    chat_id         INTEGER NOT NULL,
+                    message_id      INTEGER NOT NULL,
+                    raw_data        TEXT NOT NULL,
+                    chat_title      TEXT,
+                    sender_id       INTEGER,
+                    sender_name     TEXT,
+                    message_date    TIMESTAMP,
+                    has_media       BOOLEAN,
+                    media_type      TEXT,
+                    text_preview    TEXT,
+                    views           INTEGER,
+                    edit_date       TIMESTAMP,
+                    text            TEXT,
+                    existing        BOOLEAN DEFAULT 0,
+                    edited          BOOLEAN DEFAULT 0,
+                    old_text        TEXT,
+                    old_edit_date   TIMESTAMP
+                )
+            ''')
+            cursor.executemany('''
+                INSERT INTO import_stage
+                (chat_id, message_id, raw_data, chat_title, sender_id, sender_name, message_date,
+                 has_media, media_type, text_preview, views, edit_date, text)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+            # Повтор сообщения внутри пачки — остаётся последняя запись
+            cursor.execute('''
+                DELETE FROM import_stage WHERE rowid NOT IN (
+                    SELECT MAX(rowid) FROM import_stage GROUP BY chat_id, message_id
+                )
+            ''')
+            result['skipped'] = cursor.rowcount
+
+            if skip_duplicates:
+                cursor.execute('''
+                    UPDATE import_stage
+                    SET existing = 1,
+                        old_text = json_extract(m.raw_data, '$.text'),
+                        old_edit_date = json_extract(m.raw_data, '$.edit_date')
+                    FROM messages_raw m
+                    WHERE m.chat_id = import_stage.chat_id AND m.message_id = import_stage.message_id
+                ''')
+                existing = cursor.rowcount
+
+                if update_edits:
+                    cursor.execute('''
+                        UPDATE import_stage SET edited = 1
+                        WHERE existing = 1 AND COALESCE(old_text, '') != COALESCE(text, '')
+                    ''')
+                    result['updated'] = cursor.rowcount
+                if result['updated']:
                     cursor.execute('''
-                        INSERT OR IGNORE INTO files
-                        (file_id, file_type, file_size, file_name, mime_type,
-                         thumb_file_id, width, height, duration)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        file_info.get('file_id'),
-                        file_info.get('file_type'),
-                        file_info.get('file_size'),
-                        file_info.get('file_name'),
-                        file_info.get('mime_type'),
-                        file_info.get('thumb_file_id'),
-                        file_info.get('width'),
-                        file_info.get('height'),
-                        file_info.get('duration')
-                    ))
-
-                    # Затем связь с сообщением
+                        INSERT INTO message_edits
+                        (chat_id, message_id, edit_date, old_text, new_text, old_raw_data)
+                        SELECT chat_id, message_id, COALESCE(edit_date, ?), old_text, text,
+                               json_object('text', old_text, 'edit_date', old_edit_date)
+                        FROM import_stage WHERE edited = 1
+                    ''', (now,))
                     cursor.execute('''
-                        INSERT OR IGNORE INTO message_files
-                        (chat_id, message_id, file_id, file_order)
-                        VALUES (?, ?, ?, ?)
-                    ''', (chat_id, message_id, file_info.get('file_id'), idx))
+                        UPDATE messages_raw
+                        SET raw_data = json_set(messages_raw.raw_data, '$.text', s.text,
+                                                '$.edit_date', COALESCE(s.edit_date, ?))
+                        FROM import_stage s
+                        WHERE s.edited = 1 AND s.chat_id = messages_raw.chat_id
+                          AND s.message_id = messages_raw.message_id
+                    ''', (now,))
+                    cursor.execute('''
+                        UPDATE message_meta
+                        SET text_preview = s.text_preview, edit_date = COALESCE(s.edit_date, ?)
+                        FROM import_stage s
+                        WHERE s.edited = 1 AND s.chat_id = message_meta.chat_id
+                          AND s.message_id = message_meta.message_id
+                    ''', (now,))
+                    cursor.execute('''
+                        INSERT INTO changes (op, chat_id, message_id, changed_at)
+                        SELECT 'edit', chat_id, message_id, ? FROM import_stage WHERE edited = 1
+                    ''', (now,))
+
+                result['skipped'] += existing - result['updated']
+                cursor.execute('DELETE FROM import_stage WHERE existing = 1')
+            else:
+                # Перезапись: прежние метаданные удаляются (у message_meta нет уникального ключа)
+                cursor.execute('''
+                    DELETE FROM message_meta
+                    WHERE (chat_id, message_id) IN (SELECT chat_id, message_id FROM import_stage)
+                ''')
+
+            # Чаты: известное название не затираем пустым
+            cursor.execute('''
+                INSERT INTO chats (chat_id, title, updated_at)
+                SELECT chat_id, MAX(chat_title), ? FROM import_stage WHERE true GROUP BY chat_id
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, chats.title),
+                    updated_at = excluded.updated_at
+            ''', (now,))
+            cursor.execute('''
+                INSERT OR REPLACE INTO messages_raw (chat_id, message_id, raw_data, saved_at)
+                SELECT chat_id, message_id, raw_data, ? FROM import_stage
+                ORDER BY chat_id, message_id
+            ''', (now,))
+            result['imported'] = cursor.rowcount
+            cursor.execute('''
+                INSERT INTO message_meta
+                (chat_id, message_id, sender_id, sender_name, message_date,
+                 has_media, media_type, text_preview, has_forward, has_reply,
+                 edit_date, views, is_deleted)
+                SELECT chat_id, message_id, sender_id, sender_name, message_date,
+                       has_media, media_type, text_preview, 0, 0, edit_date, views, 0
+                FROM import_stage
+                ORDER BY chat_id, message_id
+            ''')
+            cursor.execute('''
+                INSERT INTO changes (op, chat_id, message_id, changed_at)
+                SELECT 'upsert', chat_id, message_id, ? FROM import_stage
+                ORDER BY chat_id, message_id
+            ''', (now,))
 
             conn.commit()
-            return True
+            return result
 
         except Exception as e:
-            logger.error(f"Ошибка сохранения сообщения: {e}")
+            logger.error(f"Ошибка импорта пачки сообщений: {e}")
             conn.rollback()
-            return False
+            raise
 
         finally:
             conn.close()
@@ -476,30 +875,163 @@ class DatabaseV6:
             SET edit_date = ?
             WHERE chat_id = ? AND message_id = ?
         ''', (datetime.now().isoformat(), chat_id, message_id))
+        self._log_changes(cursor, 'edit', [(chat_id, message_id)])
 
         conn.commit()
         conn.close()
 
+    def apply_message_edit(self, chat_id: int, message_id: int, new_text: str,
+                           edit_date: str = None) -> Optional[Dict]:
+        """
+        Применение редактирования одной транзакцией без чтения полного RAW
+
+        Меняются только текст и дата редактирования (json_set в RAW,
+        text_preview и edit_date в метаданных). В историю записываются
+        старый и новый текст, а в old_raw_data — прежние значения
+        изменённых полей.
+
+        Returns:
+            {'changed': bool, 'old_text': ...} или None, если сообщения нет в архиве
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        edit_date = edit_date or datetime.now().isoformat()
+
+        try:
+            cursor.execute('''
+                SELECT json_extract(raw_data, '$.text'),
+                       json_extract(raw_data, '$.media_type'),
+                       json_extract(raw_data, '$.edit_date')
+                FROM messages_raw
+                WHERE chat_id = ? AND message_id = ?
+            ''', (chat_id, message_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+
+            old_text, media_type, old_edit_date = row
+            if not new_text and media_type:
+                new_text = f"[{media_type}]"
+
+            changed = (old_text or '') != (new_text or '')
+            if changed:
+                cursor.execute('''
+                    UPDATE messages_raw
+                    SET raw_data = json_set(raw_data, '$.text', ?, '$.edit_date', ?)
+                    WHERE chat_id = ? AND message_id = ?
+                ''', (new_text, edit_date, chat_id, message_id))
+
+                cursor.execute('''
+                    UPDATE message_meta
+                    SET text_preview = ?, edit_date = ?
+                    WHERE chat_id = ? AND message_id = ?
+                ''', ((new_text or '')[:500], edit_date, chat_id, message_id))
+
+                cursor.execute('''
+                    INSERT INTO message_edits
+                    (chat_id, message_id, edit_date, old_text, new_text, old_raw_data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (
+                    chat_id,
+                    message_id,
+                    edit_date,
+                    old_text,
+                    new_text,
+                    json.dumps({'text': old_text, 'edit_date': old_edit_date}, ensure_ascii=False)
+                ))
+            else:
+                # Текст не изменился (реакции, просмотры) — только дата редактирования
+                cursor.execute('''
+                    UPDATE message_meta
+                    SET edit_date = ?
+                    WHERE chat_id = ? AND message_id = ?
+                ''', (edit_date, chat_id, message_id))
+            self._log_changes(cursor, 'edit', [(chat_id, message_id)])
+
+            conn.commit()
+            return {'changed': changed, 'old_text': old_text, 'new_text': new_text}
+
+        except Exception as e:
+            logger.error(f"Ошибка применения редактирования: {e}")
+            conn.rollback()
+            return None
+
+        finally:
+            conn.close()
+
     def mark_message_deleted(self, chat_id: int, message_id: int):
         """Отметка сообщения как удалённого"""
+        self.mark_messages_deleted(chat_id, [message_id])
+
+    def mark_messages_deleted(self, chat_id: Optional[int], message_ids: List[int],
+                              account: Optional[str] = None) -> int:
+        """
+        Отметка пачки сообщений как удалённых одной транзакцией
+
+        Args:
+            chat_id: ID чата; None для личных чатов и обычных групп, где
+                Telegram не сообщает чат (ID сообщений там уникальны в аккаунте)
+            message_ids: ID удалённых сообщений
+            account: Аккаунт, приславший удаление без чата: учитываются только
+                чаты, не закреплённые за другими аккаунтами (chat_accounts).
+                ID, которые и так совпадают в нескольких чатах, пропускаются
+
+        Returns:
+            Количество записанных событий удаления
+        """
+        if not message_ids:
+            return 0
+
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        now = datetime.now().isoformat()
 
-        # Помечаем как удалённое в метаданных
-        cursor.execute('''
-            UPDATE message_meta
-            SET is_deleted = 1, deleted_at = ?
-            WHERE chat_id = ? AND message_id = ?
-        ''', (datetime.now().isoformat(), chat_id, message_id))
+        try:
+            if chat_id is not None:
+                pairs = [(chat_id, message_id) for message_id in message_ids]
+            else:
+                # Ищем чаты по ID сообщений среди не-каналов (ID каналов < -10^12).
+                # ID уникальны только в пределах аккаунта: чаты других аккаунтов
+                # и импортированные архивы могут содержать те же ID
+                found = {}
+                for i in range(0, len(message_ids), 500):
+                    chunk = list(message_ids[i:i + 500])
+                    cursor.execute(f'''
+                        SELECT m.chat_id, m.message_id FROM message_meta m
+                        LEFT JOIN chat_accounts a ON a.chat_key = CAST(m.chat_id AS TEXT)
+                        WHERE m.message_id IN ({','.join('?' * len(chunk))})
+                          AND m.chat_id > -1000000000000
+                          AND (? IS NULL OR a.account IS NULL OR a.account = ?)
+                    ''', chunk + [account, account])
+                    for c, m in cursor.fetchall():
+                        found.setdefault(m, []).append(c)
+                pairs = [(chats[0], m) for m, chats in found.items() if len(chats) == 1]
+                ambiguous = len(found) - len(pairs)
+                if ambiguous:
+                    logger.warning(f"Удаление без чата: пропущено {ambiguous} ID, найденных в нескольких чатах")
+
+            cursor.executemany('''
+                UPDATE message_meta
+                SET is_deleted = 1, deleted_at = ?
+                WHERE chat_id = ? AND message_id = ?
+            ''', [(now, c, m) for c, m in pairs])
 
-        # Добавляем событие
-        cursor.execute('''
-            INSERT INTO message_events (chat_id, message_id, event_type, event_date)
-            VALUES (?, ?, ?, ?)
-        ''', (chat_id, message_id, 'deleted', datetime.now().isoformat()))
+            cursor.executemany('''
+                INSERT INTO message_events (chat_id, message_id, event_type, event_date)
+                VALUES (?, ?, 'deleted', ?)
+            ''', [(c, m, now) for c, m in pairs])
+            self._log_changes(cursor, 'delete', pairs)
 
-        conn.commit()
-        conn.close()
+            conn.commit()
+            return len(pairs)
+
+        except Exception as e:
+            logger.error(f"Ошибка отметки удалённых сообщений: {e}")
+            conn.rollback()
+            return 0
+
+        finally:
+            conn.close()
 
     # ============================================================
     # МЕТОДЫ ДЛЯ СТАТИСТИКИ
@@ -579,6 +1111,95 @@ class DatabaseV6:
 
         return export_data
 
+    @staticmethod
+    def _export_filter(chat_id: int = None, date_from: str = None, date_to: str = None) -> tuple:
+        """Условие WHERE экспорта по message_meta (алиас meta) и его параметры"""
+        where, params = ['meta.is_deleted = 0'], []
+        if chat_id:
+            where.append('meta.chat_id = ?')
+            params.append(chat_id)
+        if date_from:
+            where.append('meta.message_date >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('meta.message_date < ?')
+            params.append(date_to)
+        return ' AND '.join(where), params
+
+    def count_export_rows(self, chat_id: int = None, date_from: str = None, date_to: str = None) -> int:
+        """Число сообщений экспорта с теми же фильтрами (для прогресса)"""
+        where, params = self._export_filter(chat_id, date_from, date_to)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute(f'SELECT COUNT(*) FROM message_meta meta WHERE {where}', params)
+        count = cursor.fetchone()[0]
+
+        conn.close()
+        return count
+
+    def iter_export_rows(self, chat_id: int = None, date_from: str = None, date_to: str = None,
+                         limit: int = 0, columns: str = 'meta', batch: int = 1000):
+        """
+        Потоковое чтение сообщений для экспорта (курсор, fetchmany по batch строк)
+
+        Порядок — (chat_id, message_id) по уникальному индексу messages_raw
+        (CROSS JOIN фиксирует messages_raw внешней таблицей), поэтому SQLite
+        не сортирует выборку и память не зависит от размера чата.
+
+        Args:
+            chat_id: Фильтр по чату
+            date_from: message_date >= date_from (ISO)
+            date_to: message_date < date_to (ISO, не включительно)
+            limit: Максимум строк (0 — без ограничения)
+            columns: meta — метаданные; raw — (chat_id, message_id, saved_at, raw_data
+                как строка JSON); analytics — метаданные и поля RAW для Parquet
+
+        Yields:
+            meta: (chat_id, message_id, chat_title, sender_id, sender_name, message_date,
+            text, has_media, media_type, views, edit_date);
+            analytics: (chat_id, message_id, chat_title, sender_id, sender_name, message_date,
+            edit_date, has_media, media_type, has_forward, has_reply, views, text,
+            file_name, file_size)
+        """
+        if columns == 'raw':
+            columns = 'm.chat_id, m.message_id, m.saved_at, m.raw_data'
+        elif columns == 'analytics':
+            columns = '''m.chat_id, m.message_id, c.title, meta.sender_id, meta.sender_name,
+                         meta.message_date, meta.edit_date, meta.has_media, meta.media_type,
+                         meta.has_forward, meta.has_reply, meta.views,
+                         COALESCE(json_extract(m.raw_data, '$.text'), meta.text_preview),
+                         json_extract(m.raw_data, '$.file_name'), json_extract(m.raw_data, '$.file_size')'''
+        else:
+            columns = '''m.chat_id, m.message_id, c.title, meta.sender_id, meta.sender_name,
+                         meta.message_date, COALESCE(json_extract(m.raw_data, '$.text'), meta.text_preview),
+                         meta.has_media, meta.media_type, meta.views, meta.edit_date'''
+        where, params = self._export_filter(chat_id, date_from, date_to)
+        query = f'''
+            SELECT {columns}
+            FROM messages_raw m
+            CROSS JOIN message_meta meta ON m.chat_id = meta.chat_id AND m.message_id = meta.message_id
+            LEFT JOIN chats c ON m.chat_id = c.chat_id
+            WHERE {where}
+            ORDER BY m.chat_id, m.message_id
+        '''
+        if limit and limit > 0:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        # Генератор читают по шагам из пула потоков (StreamingResponse),
+        # обращения последовательные — проверка потока отключена
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
     # ============================================================
     # МЕТОДЫ ДЛЯ СОВМЕСТИМОСТИ (API v4/v5)
     # ============================================================
@@ -604,6 +1225,18 @@ class DatabaseV6:
         # Сохраняем чат если не существует
         self.save_chat(chat_id, title=chat_title)
 
+        record = self.build_message_record(
+            message_id, chat_id, chat_title, text, sender_name, message_date,
+            media_type=media_type, file_id=file_id, file_name=file_name,
+            file_size=file_size, sender_id=sender_id
+        )
+        return self.save_message_raw(chat_id, message_id, record['raw_data'], record['meta'], record['files'])
+
+    @staticmethod
+    def build_message_record(message_id, chat_id, chat_title, text, sender_name, message_date,
+                             media_type=None, file_id=None, file_name=None, file_size=None,
+                             sender_id=None) -> Dict:
+        """Сформировать запись сообщения (RAW, Meta, файлы) без обращения к БД"""
         # Формируем RAW данные (упрощённая структура для совместимости)
         raw_data = {
             'id': message_id,
@@ -645,17 +1278,30 @@ class DatabaseV6:
             # Добавляем файлы в RAW данные
             raw_data['files'] = files
 
-        return self.save_message_raw(chat_id, message_id, raw_data, meta, files)
+        return {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'raw_data': raw_data,
+            'meta': meta,
+            'files': files
+        }
 
     def update_loading_status(self, chat_id, last_loaded_id, last_message_date, total_loaded, fully_loaded=False):
         """Обновление статуса загрузки чата (совместимость)"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        # UPSERT вместо INSERT OR REPLACE: не затираем page_size / avg_latency_ms и created_at
         cursor.execute('''
-            INSERT OR REPLACE INTO chat_loading_status
+            INSERT INTO chat_loading_status
             (chat_id, last_loaded_id, last_message_date, total_loaded, fully_loaded, last_loading_date)
             VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                last_loaded_id = excluded.last_loaded_id,
+                last_message_date = excluded.last_message_date,
+                total_loaded = excluded.total_loaded,
+                fully_loaded = excluded.fully_loaded,
+                last_loading_date = excluded.last_loading_date
         ''', (chat_id, last_loaded_id, last_message_date, total_loaded,
               1 if fully_loaded else 0, datetime.now().isoformat()))
 
@@ -676,48 +1322,161 @@ class DatabaseV6:
             return dict(result)
         return {'chat_id': chat_id, 'last_loaded_id': 0, 'total_loaded': 0, 'fully_loaded': 0}
 
-    def get_last_message_date_in_chat(self, chat_id):
-        """Получить дату последнего сообщения в чате (совместимость)"""
+    def get_page_tuning(self) -> Dict[int, Dict]:
+        """Сохранённые размер страницы и задержка ответа по чатам"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         cursor.execute('''
-            SELECT MAX(message_date) FROM message_meta
-            WHERE chat_id = ? AND is_deleted = 0
-        ''', (chat_id,))
-        result = cursor.fetchone()[0]
-        conn.close()
+            SELECT chat_id, page_size, avg_latency_ms FROM chat_loading_status
+            WHERE page_size IS NOT NULL
+        ''')
+        results = {row[0]: {'page_size': row[1], 'avg_latency_ms': row[2]} for row in cursor.fetchall()}
 
-        if result:
-            try:
-                date_str = str(result).replace('Z', '+00:00')
-                if '.' in date_str:
-                    date_str = date_str.split('.')[0] + date_str[-6:] if '+' in date_str else date_str.split('.')[0]
-                return datetime.fromisoformat(date_str)
-            except Exception:
-                return None
-        return None
+        conn.close()
+        return results
 
-    def get_chats_with_messages(self):
-        """Получить список чатов с сообщениями (совместимость)"""
+    def save_page_tuning(self, chat_id, page_size: int, avg_latency_ms: float):
+        """Сохранить размер страницы и задержку ответа чата"""
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
         cursor.execute('''
-            SELECT DISTINCT m.chat_id, c.title as chat_title, MAX(m.message_date) as last_message_date
-            FROM message_meta m
-            LEFT JOIN chats c ON m.chat_id = c.chat_id
-            WHERE m.is_deleted = 0
-            GROUP BY m.chat_id
-            ORDER BY last_message_date DESC
-        ''')
+            INSERT INTO chat_loading_status (chat_id, page_size, avg_latency_ms) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                page_size = excluded.page_size,
+                avg_latency_ms = excluded.avg_latency_ms
+        ''', (chat_id, page_size, avg_latency_ms))
 
-        results = []
-        for row in cursor.fetchall():
-            data = dict(row)
-            results.append({
-                'chat_id': data['chat_id'],
+        conn.commit()
+        conn.close()
+
+    def get_message_id_bounds(self, chat_id) -> tuple:
+        """(MIN, MAX) message_id чата в архиве, (None, None) если сообщений нет"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT MIN(message_id), MAX(message_id) FROM message_meta WHERE chat_id = ?', (chat_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0], result[1]
+
+    def save_loading_ranges(self, chat_id, ranges: List[tuple]):
+        """Создать диапазоны загрузки [(start, end), ...] (существующие не трогаются)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        now = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO chat_loading_ranges
+            (chat_id, range_start, range_end, offset_id, loaded, done, updated_at)
+            VALUES (?, ?, ?, ?, 0, 0, ?)
+        ''', [(chat_id, start, end, end + 1, now) for start, end in ranges])
+
+        conn.commit()
+        conn.close()
+
+    def get_loading_ranges(self, chat_id) -> List[Dict]:
+        """Диапазоны загрузки чата"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT range_start, range_end, offset_id, loaded, done, updated_at
+            FROM chat_loading_ranges WHERE chat_id = ? ORDER BY range_start DESC
+        ''', (chat_id,))
+
+        results = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return results
+
+    def update_loading_range(self, chat_id, range_start, offset_id, loaded, added=0, done=False) -> bool:
+        """
+        Контрольная точка диапазона; при завершении последнего диапазона
+        чат отмечается fully_loaded
+
+        Args:
+            added: Новых сообщений за страницу (прибавляется к total_loaded чата)
+
+        Returns:
+            True, если все диапазоны чата завершены
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        now = datetime.now().isoformat()
+        cursor.execute('''
+            UPDATE chat_loading_ranges SET offset_id = ?, loaded = ?, done = ?, updated_at = ?
+            WHERE chat_id = ? AND range_start = ?
+        ''', (offset_id, loaded, 1 if done else 0, now, chat_id, range_start))
+
+        all_done = False
+        if done:
+            cursor.execute('''
+                SELECT COUNT(*), SUM(done), MIN(offset_id) FROM chat_loading_ranges WHERE chat_id = ?
+            ''', (chat_id,))
+            total, finished, min_offset = cursor.fetchone()
+            all_done = bool(total) and finished == total
+
+        # Диапазоны пишут статус чата одновременно — только приращения, без перезаписи строки
+        cursor.execute('''
+            INSERT INTO chat_loading_status (chat_id, last_loaded_id, total_loaded, fully_loaded, last_loading_date)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                total_loaded = chat_loading_status.total_loaded + excluded.total_loaded,
+                fully_loaded = MAX(chat_loading_status.fully_loaded, excluded.fully_loaded),
+                last_loaded_id = CASE WHEN excluded.fully_loaded = 1
+                                      THEN excluded.last_loaded_id ELSE chat_loading_status.last_loaded_id END,
+                last_loading_date = excluded.last_loading_date
+        ''', (chat_id, min_offset if all_done else 0, added, 1 if all_done else 0, now))
+
+        conn.commit()
+        conn.close()
+        return all_done
+
+    def get_last_message_date_in_chat(self, chat_id):
+        """Получить дату последнего сообщения в чате (совместимость)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT MAX(message_date) FROM message_meta
+            WHERE chat_id = ? AND is_deleted = 0
+        ''', (chat_id,))
+        result = cursor.fetchone()[0]
+        conn.close()
+
+        if result:
+            try:
+                date_str = str(result).replace('Z', '+00:00')
+                if '.' in date_str:
+                    date_str = date_str.split('.')[0] + date_str[-6:] if '+' in date_str else date_str.split('.')[0]
+                return datetime.fromisoformat(date_str)
+            except Exception:
+                return None
+        return None
+
+    def get_chats_with_messages(self):
+        """Получить список чатов с сообщениями (совместимость)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT DISTINCT m.chat_id, c.title as chat_title, MAX(m.message_date) as last_message_date
+            FROM message_meta m
+            LEFT JOIN chats c ON m.chat_id = c.chat_id
+            WHERE m.is_deleted = 0
+            GROUP BY m.chat_id
+            ORDER BY last_message_date DESC
+        ''')
+
+        results = []
+        for row in cursor.fetchall():
+            data = dict(row)
+            results.append({
+                'chat_id': data['chat_id'],
                 'chat_title': data.get('chat_title') or data.get('title') or f"chat_{data['chat_id']}",
                 'last_message_date': data['last_message_date']
             })
@@ -872,9 +1631,14 @@ class DatabaseV6:
                    COALESCE(s.fully_loaded, 0) as fully_loaded,
                    COALESCE(s.last_loaded_id, 0) as last_loaded_id,
                    s.last_message_date,
-                   s.last_loading_date
+                   s.last_loading_date,
+                   sch.interval_seconds as sync_interval,
+                   sch.next_run_at as next_sync_at,
+                   a.account
             FROM tracked_chats t
             LEFT JOIN chat_loading_status s ON t.chat_id = s.chat_id
+            LEFT JOIN sync_schedule sch ON t.chat_id = sch.chat_id
+            LEFT JOIN chat_accounts a ON a.chat_key = CAST(t.chat_id AS TEXT)
             ORDER BY t.added_at DESC
         ''')
 
@@ -906,6 +1670,7 @@ class DatabaseV6:
         cursor = conn.cursor()
 
         cursor.execute('DELETE FROM tracked_chats WHERE chat_id = ?', (chat_id,))
+        cursor.execute('DELETE FROM sync_schedule WHERE chat_id = ?', (chat_id,))
 
         conn.commit()
         conn.close()
@@ -944,6 +1709,9 @@ class DatabaseV6:
             SET last_loaded_id = 0, total_loaded = 0, fully_loaded = 0, last_loading_date = NULL
             WHERE chat_id = ?
         ''', (chat_id,))
+        cursor.execute('DELETE FROM chat_sync_state WHERE chat_id = ?', (chat_id,))
+        cursor.execute('DELETE FROM chat_loading_ranges WHERE chat_id = ?', (chat_id,))
+        self._log_changes(cursor, 'clear', [(chat_id, None)])
 
         conn.commit()
         conn.close()
@@ -957,11 +1725,18 @@ class DatabaseV6:
         cursor.execute('DELETE FROM message_meta')
         cursor.execute('DELETE FROM messages_raw')
         cursor.execute('DELETE FROM chat_loading_status')
+        cursor.execute('DELETE FROM chat_sync_state')
+        cursor.execute('DELETE FROM chat_loading_ranges')
         cursor.execute('DELETE FROM message_files')
         cursor.execute('DELETE FROM message_edits')
         cursor.execute('DELETE FROM message_events')
         cursor.execute('DELETE FROM chats')
         cursor.execute('DELETE FROM tracked_chats')
+        cursor.execute('DELETE FROM sync_schedule')
+        cursor.execute('DELETE FROM chat_accounts')
+        # Прежний журнал не нужен: клиенты получают одну запись clear без чата
+        cursor.execute('DELETE FROM changes')
+        self._log_changes(cursor, 'clear', [(None, None)])
 
         conn.commit()
         conn.close()
@@ -1236,6 +2011,722 @@ class DatabaseV6:
         conn.close()
         return results
 
+    # ============================================================
+    # МЕТОДЫ ДЛЯ RATE LIMITER
+    # ============================================================
+
+    def get_rate_limits(self) -> Dict[str, Dict]:
+        """Получить сохранённые скорости классов методов"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT * FROM rate_limits')
+        results = {row['method']: dict(row) for row in cursor.fetchall()}
+        conn.close()
+        return results
+
+    def save_rate_limit(self, method: str, state: Dict):
+        """Сохранить выученную скорость класса методов"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO rate_limits
+            (method, rate, flood_count, last_flood_at, last_flood_seconds, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            method,
+            state.get('rate'),
+            state.get('flood_count', 0),
+            state.get('last_flood_at'),
+            state.get('last_flood_seconds'),
+            datetime.now().isoformat()
+        ))
+
+        conn.commit()
+        conn.close()
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ ОЧЕРЕДИ ЗАДАЧ
+    # ============================================================
+
+    @staticmethod
+    def _task_from_row(row) -> Dict:
+        """Преобразовать строку таблицы tasks в словарь задачи"""
+        data = dict(row)
+        task = {
+            'id': data['task_id'],
+            'type': data['task_type'],
+            'data': json.loads(data['data']) if data.get('data') else {},
+            'status': data['status'],
+            'priority': data['priority'],
+            'created_at': data['created_at']
+        }
+        for key in ('started_at', 'completed_at', 'error'):
+            if data.get(key):
+                task[key] = data[key]
+        if data.get('attached'):
+            task['attached'] = data['attached']
+        if data.get('result'):
+            try:
+                task['result'] = json.loads(data['result'])
+            except:
+                pass
+        if data.get('checkpoint'):
+            try:
+                task['progress'] = json.loads(data['checkpoint'])
+            except:
+                pass
+        return task
+
+    def save_task(self, task: Dict, chat_key: str = None, checkpoint: Dict = None):
+        """Сохранить задачу и её состояние"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO tasks
+            (task_id, task_type, chat_key, status, priority, data, checkpoint, result, error,
+             attached, created_at, started_at, completed_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            task['id'],
+            task['type'],
+            chat_key,
+            task['status'],
+            task.get('priority'),
+            json.dumps(task.get('data') or {}, ensure_ascii=False, default=str),
+            json.dumps(checkpoint, ensure_ascii=False, default=str) if checkpoint else None,
+            json.dumps(task['result'], ensure_ascii=False, default=str) if task.get('result') is not None else None,
+            task.get('error'),
+            task.get('attached', 0),
+            task.get('created_at'),
+            task.get('started_at'),
+            task.get('completed_at'),
+            datetime.now().isoformat()
+        ))
+
+        conn.commit()
+        conn.close()
+
+    def save_task_checkpoint(self, task_id: str, checkpoint: Dict):
+        """Сохранить контрольную точку задачи (после каждой страницы)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE tasks SET checkpoint = ?, updated_at = ?
+            WHERE task_id = ?
+        ''', (json.dumps(checkpoint, ensure_ascii=False, default=str), datetime.now().isoformat(), task_id))
+
+        conn.commit()
+        conn.close()
+
+    def get_active_tasks(self) -> List[Dict]:
+        """Незавершённые задачи (для восстановления после перезапуска)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT * FROM tasks
+            WHERE status IN ('pending', 'processing')
+            ORDER BY created_at
+        ''')
+        results = []
+        for row in cursor.fetchall():
+            task = self._task_from_row(row)
+            task['chat_key'] = row['chat_key']
+            task['checkpoint'] = json.loads(row['checkpoint']) if row['checkpoint'] else {}
+            task.pop('progress', None)
+            results.append(task)
+
+        conn.close()
+        return results
+
+    def get_task(self, task_id: str) -> Optional[Dict]:
+        """Получить задачу по ID"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,))
+        row = cursor.fetchone()
+        conn.close()
+
+        return self._task_from_row(row) if row else None
+
+    def get_finished_tasks(self, limit: int = 100) -> List[Dict]:
+        """Последние завершённые задачи"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT * FROM tasks
+            WHERE status IN ('completed', 'failed')
+            ORDER BY completed_at DESC
+            LIMIT ?
+        ''', (limit,))
+        results = [self._task_from_row(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return results
+
+    def count_tasks_by_status(self) -> Dict[str, int]:
+        """Количество задач по статусам"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status')
+        results = {row[0]: row[1] for row in cursor.fetchall()}
+
+        conn.close()
+        return results
+
+    def evict_tasks(self, keep: int = 1000, max_age_days: int = 7) -> int:
+        """Удалить старые завершённые задачи (сверх keep или старше max_age_days)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+        cursor.execute('''
+            DELETE FROM tasks
+            WHERE status IN ('completed', 'failed')
+              AND (completed_at < ? OR task_id IN (
+                  SELECT task_id FROM tasks
+                  WHERE status IN ('completed', 'failed')
+                  ORDER BY completed_at DESC
+                  LIMIT -1 OFFSET ?
+              ))
+        ''', (cutoff, keep))
+        deleted = cursor.rowcount
+
+        conn.commit()
+        conn.close()
+        return deleted
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ КЭША СУЩНОСТЕЙ
+    # ============================================================
+
+    def save_entities(self, rows: List[Dict]):
+        """Сохранить сущности одной транзакцией (известные поля не затираются пустыми)"""
+        if not rows:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        now = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT INTO entities (peer_id, kind, name, username, access_hash, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(peer_id) DO UPDATE SET
+                kind = excluded.kind,
+                name = COALESCE(excluded.name, entities.name),
+                username = COALESCE(excluded.username, entities.username),
+                access_hash = COALESCE(excluded.access_hash, entities.access_hash),
+                updated_at = excluded.updated_at
+        ''', [(r['peer_id'], r.get('kind'), r.get('name'), r.get('username'), r.get('access_hash'), now)
+              for r in rows])
+
+        conn.commit()
+        conn.close()
+
+    def get_entities(self, peer_ids: List[int]) -> Dict[int, Dict]:
+        """Получить сущности по списку peer_id"""
+        if not peer_ids:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        results = {}
+        peer_ids = list(peer_ids)
+        # Ограничение SQLite на число параметров запроса
+        for i in range(0, len(peer_ids), 500):
+            chunk = peer_ids[i:i + 500]
+            cursor.execute(f'''
+                SELECT peer_id, kind, name, username, access_hash FROM entities
+                WHERE peer_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for row in cursor.fetchall():
+                results[row['peer_id']] = dict(row)
+
+        conn.close()
+        return results
+
+    def get_resolved_peer(self, identifier: str) -> Optional[int]:
+        """peer_id по нормализованному идентификатору"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT peer_id FROM chat_resolver WHERE identifier = ?', (identifier,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def save_resolved_peers(self, pairs: List[tuple]):
+        """Сохранить привязки (identifier, peer_id)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        now = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT OR REPLACE INTO chat_resolver (identifier, peer_id, resolved_at)
+            VALUES (?, ?, ?)
+        ''', [(identifier, peer_id, now) for identifier, peer_id in pairs])
+
+        conn.commit()
+        conn.close()
+
+    def delete_resolved_peer(self, identifier: str):
+        """Удалить привязку идентификатора"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('DELETE FROM chat_resolver WHERE identifier = ?', (identifier,))
+
+        conn.commit()
+        conn.close()
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ СОСТОЯНИЯ ОБНОВЛЕНИЙ
+    # ============================================================
+
+    def get_updates_state(self) -> Optional[Dict]:
+        """Сохранённое состояние обновлений (pts, qts, date, seq)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT pts, qts, date, seq, updated_at FROM updates_state WHERE id = 1')
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def save_updates_state(self, state: Dict):
+        """Сохранить состояние обновлений"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO updates_state (id, pts, qts, date, seq, updated_at)
+            VALUES (1, ?, ?, ?, ?, ?)
+        ''', (state['pts'], state['qts'], state['date'], state.get('seq', 0), datetime.now().isoformat()))
+
+        conn.commit()
+        conn.close()
+
+    def get_channel_pts(self) -> Dict[int, int]:
+        """pts каналов {channel_id: pts}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT channel_id, pts FROM channel_pts')
+        results = {row[0]: row[1] for row in cursor.fetchall()}
+
+        conn.close()
+        return results
+
+    def save_channel_pts(self, channels: Dict[int, int]):
+        """Сохранить pts каналов (только увеличение)"""
+        if not channels:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        now = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT INTO channel_pts (channel_id, pts, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(channel_id) DO UPDATE SET
+                pts = MAX(channel_pts.pts, excluded.pts),
+                updated_at = excluded.updated_at
+        ''', [(channel_id, pts, now) for channel_id, pts in channels.items()])
+
+        conn.commit()
+        conn.close()
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ ПЛАНИРОВЩИКА СИНХРОНИЗАЦИИ
+    # ============================================================
+
+    def get_sync_baseline(self) -> Dict[int, Dict]:
+        """
+        Сохранённое состояние чатов для сравнения с top_message диалогов
+
+        Returns:
+            {chat_id: {'max_id', 'synced_top_id', 'fully_loaded'}}
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        baseline = {}
+
+        def entry(chat_id):
+            return baseline.setdefault(chat_id, {'max_id': 0, 'synced_top_id': 0, 'fully_loaded': 0})
+
+        # Покрывается индексом idx_meta_message (chat_id, message_id)
+        cursor.execute('SELECT chat_id, MAX(message_id) FROM message_meta GROUP BY chat_id')
+        for chat_id, max_id in cursor.fetchall():
+            entry(chat_id)['max_id'] = max_id or 0
+
+        cursor.execute('SELECT chat_id, synced_top_id FROM chat_sync_state')
+        for chat_id, top_id in cursor.fetchall():
+            entry(chat_id)['synced_top_id'] = top_id or 0
+
+        cursor.execute('SELECT chat_id, fully_loaded FROM chat_loading_status')
+        for chat_id, fully_loaded in cursor.fetchall():
+            entry(chat_id)['fully_loaded'] = fully_loaded or 0
+
+        conn.close()
+        return baseline
+
+    def save_synced_top(self, chat_id: int, top_id: int):
+        """Запомнить, что чат догружен до top_message (только увеличение)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT INTO chat_sync_state (chat_id, synced_top_id, synced_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                synced_top_id = MAX(chat_sync_state.synced_top_id, excluded.synced_top_id),
+                synced_at = excluded.synced_at
+        ''', (chat_id, top_id, datetime.now().isoformat()))
+
+        conn.commit()
+        conn.close()
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ АККАУНТОВ
+    # ============================================================
+
+    def get_chat_accounts(self) -> Dict[str, str]:
+        """Закрепления чатов за аккаунтами {chat_key: account}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT chat_key, account FROM chat_accounts')
+        results = dict(cursor.fetchall())
+
+        conn.close()
+        return results
+
+    def save_chat_account(self, chat_key: str, account: str):
+        """Закрепить чат за аккаунтом"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO chat_accounts (chat_key, account, assigned_at)
+            VALUES (?, ?, ?)
+        ''', (chat_key, account, datetime.now().isoformat()))
+
+        conn.commit()
+        conn.close()
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ РАСПИСАНИЯ СИНХРОНИЗАЦИИ
+    # ============================================================
+
+    def get_sync_schedule(self) -> List[Dict]:
+        """Включённые отслеживаемые чаты с их расписанием (без расписания — поля NULL)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT t.chat_id, t.chat_title, s.interval_seconds, s.rate_per_hour,
+                   s.observed_rate, s.next_run_at, s.last_run_at, s.last_new_messages
+            FROM tracked_chats t
+            LEFT JOIN sync_schedule s ON t.chat_id = s.chat_id
+            WHERE t.enabled = 1
+        ''')
+
+        results = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return results
+
+    def save_sync_schedule(self, rows: List[Dict]):
+        """Сохранить расписание чатов одной транзакцией"""
+        if not rows:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.executemany('''
+            INSERT OR REPLACE INTO sync_schedule
+            (chat_id, interval_seconds, rate_per_hour, observed_rate, next_run_at, last_run_at, last_new_messages)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(row['chat_id'], row['interval_seconds'], row.get('rate_per_hour') or 0,
+               row.get('observed_rate') or 0, row['next_run_at'], row.get('last_run_at'), row.get('last_new_messages') or 0)
+              for row in rows])
+
+        conn.commit()
+        conn.close()
+
+    def count_recent_messages(self, since: str) -> Dict[int, int]:
+        """Число сообщений отслеживаемых чатов с даты since (ISO) {chat_id: count}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT m.chat_id, COUNT(*) FROM message_meta m
+            JOIN tracked_chats t ON t.chat_id = m.chat_id
+            WHERE m.message_date >= ?
+            GROUP BY m.chat_id
+        ''', (since,))
+        results = {row[0]: row[1] for row in cursor.fetchall()}
+
+        conn.close()
+        return results
+
+    # ============================================================
+    # МЕТОДЫ ДЛЯ ЖУРНАЛА ИЗМЕНЕНИЙ
+    # ============================================================
+
+    def get_changes(self, since: int = 0, limit: int = 500, full: bool = False) -> Dict:
+        """
+        Изменения сообщений после курсора since
+
+        Несколько изменений одного сообщения на странице сворачиваются в
+        последнее; для upsert/edit добавляются актуальные метаданные, а при
+        full — полная запись сообщения (raw_data, meta, files) для реплики.
+
+        Returns:
+            {'changes': [...], 'next': курсор, 'has_more': bool,
+             'reset': True — записи после since уже удалены, нужна полная перезагрузка}
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT MIN(seq) FROM changes')
+        first = cursor.fetchone()[0]
+        cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', ('changes',))
+        row = cursor.fetchone()
+        head = row[0] if row else 0
+        # Курсор из будущего (БД пересоздана) или записи после него уже удалены
+        oldest = first if first is not None else head + 1
+        reset = since > head or since < oldest - 1
+
+        cursor.execute('''
+            SELECT c.seq, c.op, c.chat_id, c.message_id,
+                   meta.sender_name, meta.message_date, meta.text_preview,
+                   meta.has_media, meta.media_type, meta.is_deleted
+            FROM changes c
+            LEFT JOIN message_meta meta
+                ON c.op IN ('upsert', 'edit') AND meta.chat_id = c.chat_id AND meta.message_id = c.message_id
+            WHERE c.seq > ?
+            ORDER BY c.seq
+            LIMIT ?
+        ''', (0 if reset else since, limit + 1))
+        rows = cursor.fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        records = {}
+        if full:
+            # Удалённые тоже: свёрнутое в delete сообщение реплика могла ещё не получить
+            records = self._read_full_messages(cursor, [(row['chat_id'], row['message_id']) for row in rows
+                                                        if row['message_id'] is not None])
+        conn.close()
+
+        latest = {}
+        for row in rows:
+            change = {'seq': row['seq'], 'op': row['op'], 'chat_id': row['chat_id'],
+                      'message_id': row['message_id']}
+            if row['op'] in ('upsert', 'edit') and row['message_date'] is not None:
+                change['message'] = {
+                    'sender_name': row['sender_name'],
+                    'message_date': row['message_date'],
+                    'text': row['text_preview'],
+                    'has_media': bool(row['has_media']),
+                    'media_type': row['media_type'],
+                    'is_deleted': bool(row['is_deleted'])
+                }
+            if (row['chat_id'], row['message_id']) in records:
+                change['record'] = records[(row['chat_id'], row['message_id'])]
+            # Повторное изменение сообщения заменяет прежнее (порядок — по последнему)
+            key = (row['chat_id'], row['message_id']) if row['message_id'] is not None else ('seq', row['seq'])
+            latest.pop(key, None)
+            latest[key] = change
+
+        return {
+            'changes': list(latest.values()),
+            'next': rows[-1]['seq'] if rows else (head if reset else since),
+            'has_more': has_more,
+            'reset': reset,
+            'head': head
+        }
+
+    @staticmethod
+    def _read_full_messages(cursor, pairs: List[tuple]) -> Dict[tuple, Dict]:
+        """Полные записи сообщений {(chat_id, message_id): {raw_data, meta, files}}"""
+        results = {}
+        for i in range(0, len(pairs), 400):
+            chunk = pairs[i:i + 400]
+            condition = ' OR '.join(['(r.chat_id = ? AND r.message_id = ?)'] * len(chunk))
+            params = [value for pair in chunk for value in pair]
+            cursor.execute(f'''
+                SELECT r.chat_id, r.message_id, r.raw_data,
+                       m.sender_id, m.sender_name, m.message_date, m.has_media, m.media_type,
+                       m.text_preview, m.has_forward, m.has_reply, m.edit_date, m.views,
+                       m.is_deleted, m.deleted_at
+                FROM messages_raw r
+                LEFT JOIN message_meta m ON m.chat_id = r.chat_id AND m.message_id = r.message_id
+                WHERE {condition}
+            ''', params)
+            for row in cursor.fetchall():
+                results[(row[0], row[1])] = DatabaseV6._full_record(row)
+
+            cursor.execute(f'''
+                SELECT r.chat_id, r.message_id, f.file_id, f.file_type, f.file_size, f.file_name,
+                       f.mime_type, f.thumb_file_id, f.width, f.height, f.duration
+                FROM message_files r
+                JOIN files f ON f.file_id = r.file_id
+                WHERE {condition}
+                ORDER BY r.file_order
+            ''', params)
+            for row in cursor.fetchall():
+                record = results.get((row[0], row[1]))
+                if record is not None:
+                    record['files'].append(dict(zip(
+                        ('file_id', 'file_type', 'file_size', 'file_name', 'mime_type',
+                         'thumb_file_id', 'width', 'height', 'duration'), row[2:])))
+        return results
+
+    @staticmethod
+    def _full_record(row) -> Dict:
+        """Строка messages_raw + message_meta в формате реплики"""
+        meta = None
+        if row[5] is not None:
+            meta = dict(zip(('sender_id', 'sender_name', 'message_date', 'has_media', 'media_type',
+                             'text_preview', 'has_forward', 'has_reply', 'edit_date', 'views',
+                             'is_deleted', 'deleted_at'), row[3:15]))
+        return {'chat_id': row[0], 'message_id': row[1], 'raw_data': json.loads(row[2]),
+                'meta': meta, 'files': []}
+
+    def get_snapshot(self, after: int = 0, limit: int = 500) -> Dict:
+        """
+        Страница полного снимка сообщений для реплики (по возрастанию messages_raw.id)
+
+        Returns:
+            {'messages': [...], 'next': позиция следующей страницы или None}
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT id, chat_id, message_id FROM messages_raw
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after, limit))
+        rows = cursor.fetchall()
+        records = self._read_full_messages(cursor, [(row[1], row[2]) for row in rows])
+
+        conn.close()
+        messages = [records[(row[1], row[2])] for row in rows if (row[1], row[2]) in records]
+        return {'messages': messages, 'next': rows[-1][0] if len(rows) == limit else None}
+
+    def apply_replica_changes(self, records: List[Dict], deleted: List[tuple] = ()) -> int:
+        """
+        Применить пачку изменений источника одной транзакцией
+
+        Args:
+            records: Полные записи сообщений (get_changes(full=True) / get_snapshot)
+            deleted: Пары (chat_id, message_id) удалённых сообщений
+
+        Returns:
+            Количество применённых изменений
+        """
+        if not records and not deleted:
+            return 0
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+
+        try:
+            chats = {}
+            for record in records:
+                title = record['raw_data'].get('chat_title')
+                if title or record['chat_id'] not in chats:
+                    chats[record['chat_id']] = title
+            cursor.executemany('''
+                INSERT INTO chats (chat_id, title, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, chats.title),
+                    updated_at = excluded.updated_at
+            ''', [(chat_id, title, now) for chat_id, title in chats.items()])
+
+            for record in records:
+                meta = record.get('meta')
+                self._write_message(cursor, record['chat_id'], record['message_id'],
+                                    record['raw_data'], meta, record.get('files'))
+                if meta and meta.get('is_deleted'):
+                    cursor.execute('''
+                        UPDATE message_meta SET is_deleted = 1, deleted_at = ?
+                        WHERE chat_id = ? AND message_id = ?
+                    ''', (meta.get('deleted_at'), record['chat_id'], record['message_id']))
+
+            if deleted:
+                cursor.executemany('''
+                    UPDATE message_meta
+                    SET is_deleted = 1, deleted_at = ?
+                    WHERE chat_id = ? AND message_id = ?
+                ''', [(now, c, m) for c, m in deleted])
+                self._log_changes(cursor, 'delete', list(deleted))
+
+            conn.commit()
+            return len(records) + len(deleted)
+
+        except Exception as e:
+            logger.error(f"Ошибка применения изменений реплики: {e}")
+            conn.rollback()
+            raise
+
+        finally:
+            conn.close()
+
+    def get_replication_state(self, source: str) -> Optional[Dict]:
+        """Состояние реплики для источника (None — репликация не начиналась)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT * FROM replication_state WHERE source = ?', (source,))
+        row = cursor.fetchone()
+
+        conn.close()
+        return dict(row) if row else None
+
+    def save_replication_state(self, source: str, cursor_seq: int, snapshot_after: Optional[int]):
+        """Сохранить курсор журнала источника и позицию снимка"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO replication_state (source, cursor, snapshot_after, updated_at)
+            VALUES (?, ?, ?, ?)
+        ''', (source, cursor_seq, snapshot_after, datetime.now().isoformat()))
+
+        conn.commit()
+        conn.close()
+
+    def prune_changes(self, max_age_days: int = 7) -> int:
+        """Удалить записи журнала изменений старше max_age_days"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('DELETE FROM changes WHERE changed_at < ?',
+                       ((datetime.now() - timedelta(days=max_age_days)).isoformat(),))
+        deleted = cursor.rowcount
+
+        conn.commit()
+        conn.close()
+        return deleted
+
 
 # Глобальный экземпляр
 db_v6 = DatabaseV6()
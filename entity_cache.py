@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Telegrab Entity Cache
+Локальный LRU кэш отправителей и чатов с хранением в БД
+и резолвер идентификаторов чатов (ID, @username, t.me ссылки)
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from telethon import utils
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+logger = logging.getLogger('telegrab')
+
+
+def entity_kind(entity) -> str:
+    """Тип сущности: user, chat или channel"""
+    name = type(entity).__name__.lower()
+    if 'user' in name:
+        return 'user'
+    if 'channel' in name:
+        return 'channel'
+    return 'chat'
+
+
+def entity_row(entity) -> Optional[Dict]:
+    """Компактная запись сущности Telethon (User / Chat / Channel)"""
+    if entity is None or getattr(entity, 'id', None) is None:
+        return None
+    try:
+        peer_id = utils.get_peer_id(entity)
+    except Exception:
+        peer_id = entity.id
+    return {
+        'peer_id': peer_id,
+        'kind': entity_kind(entity),
+        'name': getattr(entity, 'first_name', None) or getattr(entity, 'title', None),
+        'username': getattr(entity, 'username', None),
+        'access_hash': getattr(entity, 'access_hash', None)
+    }
+
+
+def normalize_identifier(identifier) -> str:
+    """Ключ резолвера: число, username в нижнем регистре или invite:<hash>"""
+    value = str(identifier).strip()
+    if 't.me/' in value:
+        path = value.split('t.me/')[-1].strip('/')
+        if path.startswith('+'):
+            return f"invite:{path[1:]}"
+        if path.startswith('joinchat/'):
+            return f"invite:{path.split('/', 1)[1]}"
+        value = path.split('/')[0]
+    if value.lstrip('-').isdigit():
+        return str(int(value))
+    return value.lstrip('@').lower()
+
+
+def peer_bare_id(entity) -> int:
+    """ID без маркера (-100...) для сущности или InputPeer"""
+    if getattr(entity, 'id', None) is not None:
+        return entity.id
+    return utils.resolve_id(utils.get_peer_id(entity))[0]
+
+
+class EntityCache:
+    """
+    Кэш имён отправителей и чатов
+
+    Telegram возвращает пользователей и чаты вместе с каждой страницей
+    истории и с каждым обновлением, а Telethon прикрепляет их к сообщениям
+    (message.sender / message.chat). Кэш запоминает их через remember_many()
+    и отдаёт имена по peer_id без сетевых запросов, в отличие от
+    message.get_sender(), который запрашивает полную сущность при промахе
+    или «минимальной» сущности.
+
+    В памяти держится не больше capacity записей (LRU), промахи
+    дочитываются из таблицы entities.
+    """
+
+    def __init__(self, store=None, capacity: int = 10000):
+        """
+        Args:
+            store: База данных с методами get_entities / save_entities
+            capacity: Максимум записей в памяти
+        """
+        self.store = store
+        self.capacity = max(int(capacity), 1)
+        self.entries: OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'db_hits': 0, 'misses': 0, 'saved': 0, 'resolved': 0}
+
+    def _put(self, row: Dict):
+        """Положить запись в LRU"""
+        self.entries[row['peer_id']] = row
+        self.entries.move_to_end(row['peer_id'])
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def remember_many(self, entities: Iterable, foreign: bool = False) -> int:
+        """Запомнить сущности; новые и изменившиеся сохраняются одной транзакцией
+
+        foreign — сущности получены другим аккаунтом: их access_hash
+        недействителен для основного и не сохраняется.
+        """
+        changed = {}
+        for entity in entities:
+            row = entity_row(entity)
+            if not row:
+                continue
+            if foreign:
+                row['access_hash'] = None
+            cached = self.entries.get(row['peer_id'])
+            if cached:
+                # «Минимальные» сущности не содержат username и access_hash —
+                # не затираем ими полные данные
+                row = {k: v if v is not None else cached.get(k) for k, v in row.items()}
+                if row == cached:
+                    self.entries.move_to_end(row['peer_id'])
+                    continue
+            self._put(row)
+            changed[row['peer_id']] = row
+
+        if changed and self.store:
+            try:
+                self.store.save_entities(list(changed.values()))
+                self.stats['saved'] += len(changed)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения сущностей: {e}")
+        return len(changed)
+
+    def remember(self, entity, foreign: bool = False) -> int:
+        """Запомнить одну сущность"""
+        return self.remember_many([entity], foreign=foreign)
+
+    def get(self, peer_id) -> Optional[Dict]:
+        """Запись сущности по peer_id (память → БД), None если неизвестна"""
+        if peer_id is None:
+            return None
+        row = self.entries.get(peer_id)
+        if row:
+            self.entries.move_to_end(peer_id)
+            self.stats['hits'] += 1
+            return row
+
+        if self.store:
+            try:
+                row = self.store.get_entities([peer_id]).get(peer_id)
+            except Exception as e:
+                logger.error(f"Ошибка чтения сущности {peer_id}: {e}")
+                row = None
+            if row:
+                self._put(row)
+                self.stats['db_hits'] += 1
+                return row
+
+        self.stats['misses'] += 1
+        return None
+
+    def preload(self, peer_ids: Iterable):
+        """Дочитать из БД одним запросом записи, которых нет в памяти"""
+        missing = [p for p in set(peer_ids) if p is not None and p not in self.entries]
+        if not missing or not self.store:
+            return
+        try:
+            for row in self.store.get_entities(missing).values():
+                self._put(row)
+        except Exception as e:
+            logger.error(f"Ошибка чтения сущностей: {e}")
+
+    def display_name(self, peer_id, default: str = 'Unknown') -> str:
+        """Имя для отображения: имя / название, затем username"""
+        row = self.get(peer_id)
+        if not row:
+            return default
+        return row.get('name') or row.get('username') or default
+
+    # ============================================================
+    # РЕЗОЛВЕР ИДЕНТИФИКАТОРОВ
+    # ============================================================
+
+    @staticmethod
+    def input_peer(row: Dict):
+        """InputPeer из сохранённой записи (None если не хватает access_hash)"""
+        real_id, _ = utils.resolve_id(row['peer_id'])
+        if row.get('kind') == 'chat':
+            return InputPeerChat(real_id)
+        if row.get('access_hash') is None:
+            return None
+        if row.get('kind') == 'channel':
+            return InputPeerChannel(real_id, row['access_hash'])
+        return InputPeerUser(real_id, row['access_hash'])
+
+    def resolve_offline(self, identifier):
+        """InputPeer по ID / @username / t.me ссылке без запросов к Telegram"""
+        if not self.store:
+            return None
+        try:
+            peer_id = self.store.get_resolved_peer(normalize_identifier(identifier))
+        except Exception as e:
+            logger.error(f"Ошибка чтения резолвера {identifier}: {e}")
+            return None
+        row = self.get(peer_id) if peer_id is not None else None
+        peer = self.input_peer(row) if row else None
+        if peer is not None:
+            self.stats['resolved'] += 1
+        return peer
+
+    def bind(self, identifier, entity):
+        """Запомнить, что identifier указывает на entity (а также её ID и username)"""
+        row = entity_row(entity)
+        if not row or not self.store:
+            return
+        self.remember(entity)
+        keys = {normalize_identifier(identifier), str(row['peer_id']), str(entity.id)}
+        if row.get('username'):
+            keys.add(row['username'].lower())
+        try:
+            self.store.save_resolved_peers([(key, row['peer_id']) for key in keys])
+        except Exception as e:
+            logger.error(f"Ошибка сохранения резолвера {identifier}: {e}")
+
+    def forget(self, identifier):
+        """Удалить привязку (например, если access_hash больше недействителен)"""
+        if not self.store:
+            return
+        try:
+            self.store.delete_resolved_peer(normalize_identifier(identifier))
+        except Exception as e:
+            logger.error(f"Ошибка удаления из резолвера {identifier}: {e}")
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'size': len(self.entries), 'capacity': self.capacity}
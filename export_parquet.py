@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Telegrab Parquet Export
+Колоночный экспорт метаданных сообщений для аналитики: набор Parquet
+файлов, разбитый по чату и месяцу (chat_id=<id>/month=<YYYY-MM>/part-<N>.parquet)
+
+Нужен pyarrow (pip install pyarrow). Запуск без сервера:
+    python export_parquet.py data/exports/parquet --chat-id -1001234567890 --date-from 2024-01-01
+"""
+
+import os
+import sys
+import time
+import shutil
+import zipfile
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Формат экспорта (только фоновый: файл, а не поток)
+PARQUET_FORMAT = 'parquet'
+
+# Доступен ли экспорт (установлен ли pyarrow)
+PARQUET_AVAILABLE = pa is not None
+
+# Строк в row group: столько строк раздела держится в памяти до записи
+ROW_GROUP_SIZE = 20000
+
+# Разделов, открытых одновременно: при смене месяца давний раздел
+# дописывается и закрывается, в памяти не больше MAX_OPEN_PARTITIONS буферов
+MAX_OPEN_PARTITIONS = 2
+
+# Сжатие столбцов
+COMPRESSION = 'zstd'
+
+# Интервал отчётов о прогрессе (секунды)
+PROGRESS_INTERVAL = 1.0
+
+
+def parquet_schema():
+    """Схема файла раздела (chat_id и месяц — в пути раздела, как в Hive)"""
+    return pa.schema([
+        ('message_id', pa.int64()),
+        ('chat_title', pa.string()),
+        ('sender_id', pa.int64()),
+        ('sender_name', pa.string()),
+        ('date', pa.timestamp('us', tz='UTC')),
+        ('edit_date', pa.timestamp('us', tz='UTC')),
+        ('has_media', pa.bool_()),
+        ('media_type', pa.string()),
+        ('has_forward', pa.bool_()),
+        ('has_reply', pa.bool_()),
+        ('views', pa.int64()),
+        ('text', pa.string()),
+        ('file_name', pa.string()),
+        ('file_size', pa.int64()),
+    ])
+
+
+def parquet_filename(chat_id: int = None) -> str:
+    """Имя архива экспорта (zip с набором Parquet файлов)"""
+    scope = f"chat_{chat_id}" if chat_id else 'all'
+    return f"telegrab_{scope}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.parquet.zip"
+
+
+def _parse_date(value) -> Optional[datetime]:
+    """ISO дата из БД → datetime в UTC без tzinfo (None — пусто или не разобрать)"""
+    if not value:
+        return None
+    try:
+        date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class PartitionedWriter:
+    """
+    Запись строк в разделы chat_id=<id>/month=<YYYY-MM>
+
+    Строки раздела копятся в буфере и пишутся row group'ой по
+    row_group_size. Выборка упорядочена по чату и message_id, поэтому месяцы
+    идут почти подряд: открыты не больше max_open разделов, при появлении
+    нового месяца давно не использованный раздел закрывается, а при смене
+    чата — все. Память ограничена max_open * row_group_size строк. Если
+    закрытый раздел встречается снова (дата не по порядку ID), строки
+    пишутся в следующий файл раздела part-<N>.parquet.
+    """
+
+    def __init__(self, directory: str, row_group_size: int = ROW_GROUP_SIZE,
+                 compression: str = COMPRESSION, max_open: int = MAX_OPEN_PARTITIONS):
+        self.directory = directory
+        self.row_group_size = max(int(row_group_size), 1)
+        self.compression = compression
+        self.max_open = max(int(max_open), 1)
+        self.schema = parquet_schema()
+        self.writers: Dict[tuple, tuple] = {}
+        # Открытые разделы в порядке использования (последний — текущий)
+        self.buffers: Dict[tuple, List[tuple]] = OrderedDict()
+        # Файлов, уже записанных в раздел (номер следующего part)
+        self.parts: Dict[tuple, int] = {}
+        self.chat_id = None
+        self.rows = 0
+        self.files = 0
+        self.size = 0
+
+    def add(self, row: tuple):
+        """Строка iter_export_rows(columns='analytics')"""
+        chat_id = row[0]
+        if chat_id != self.chat_id:
+            self.close_partitions()
+            self.chat_id = chat_id
+        date = _parse_date(row[5])
+        key = (chat_id, date.strftime('%Y-%m') if date else 'unknown')
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = []
+            while len(self.buffers) > self.max_open:
+                self._close(next(iter(self.buffers)))
+        else:
+            self.buffers.move_to_end(key)
+        buffer.append((row[1], row[2], row[3], row[4], date, _parse_date(row[6]),
+                       bool(row[7]), row[8], bool(row[9]), bool(row[10]), row[11],
+                       row[12], row[13], row[14]))
+        self.rows += 1
+        if len(buffer) >= self.row_group_size:
+            self._flush(key)
+
+    def _flush(self, key: tuple):
+        """Записать буфер раздела одной row group"""
+        buffer = self.buffers.get(key)
+        if not buffer:
+            return
+        writer, _ = self.writers.get(key, (None, None))
+        if writer is None:
+            chat_id, month = key
+            path = os.path.join(self.directory, f"chat_id={chat_id}", f"month={month}")
+            os.makedirs(path, exist_ok=True)
+            part = self.parts.get(key, 0)
+            path = os.path.join(path, f'part-{part}.parquet')
+            writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            self.writers[key] = (writer, path)
+            self.parts[key] = part + 1
+            self.files += 1
+        columns = [pa.array(column, type=field.type) for column, field in zip(zip(*buffer), self.schema)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        buffer.clear()
+
+    def _close(self, key: tuple):
+        """Дописать и закрыть файл раздела"""
+        self._flush(key)
+        self.buffers.pop(key, None)
+        writer, path = self.writers.pop(key, (None, None))
+        if writer is not None:
+            writer.close()
+            self.size += os.path.getsize(path)
+
+    def close_partitions(self):
+        """Дописать и закрыть файлы текущего чата"""
+        for key in list(self.buffers):
+            self._close(key)
+        self.parts.clear()
+
+    def close(self):
+        """Закрыть все файлы"""
+        self.close_partitions()
+        self.chat_id = None
+
+
+def write_parquet(store, directory: str, row_group_size: int = ROW_GROUP_SIZE,
+                  progress: Callable[[int, int], None] = None, **filters) -> Dict:
+    """
+    Экспорт в каталог набора Parquet (выполняется в потоке)
+
+    Набор пишется во временный каталог .part и переименовывается по
+    завершении; существующий каталог directory заменяется.
+
+    Args:
+        store: База данных (DatabaseV6.iter_export_rows)
+        directory: Итоговый каталог набора
+        progress: Вызывается не чаще PROGRESS_INTERVAL с (сообщений, байт в закрытых файлах)
+        filters: chat_id, date_from, date_to, limit — фильтры iter_export_rows
+
+    Returns:
+        {'rows', 'files', 'size'}
+    """
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError("Экспорт Parquet недоступен: установите pyarrow (pip install pyarrow)")
+
+    part = directory.rstrip('/') + '.part'
+    shutil.rmtree(part, ignore_errors=True)
+    os.makedirs(part)
+    writer = PartitionedWriter(part, row_group_size)
+    reported = time.monotonic()
+    try:
+        for row in store.iter_export_rows(columns='analytics', **filters):
+            writer.add(row)
+            if progress and time.monotonic() - reported >= PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                progress(writer.rows, writer.size)
+        writer.close()
+    except BaseException:
+        shutil.rmtree(part, ignore_errors=True)
+        raise
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(part, directory)
+    return {'rows': writer.rows, 'files': writer.files, 'size': writer.size}
+
+
+def write_parquet_archive(store, path: str, row_group_size: int = ROW_GROUP_SIZE,
+                          progress: Callable[[int, int], None] = None, **filters) -> Dict:
+    """
+    Набор Parquet одним zip файлом (фоновый экспорт API)
+
+    Файлы Parquet уже сжаты, поэтому кладутся в архив без сжатия.
+
+    Returns:
+        {'rows', 'files', 'size'} — size архива
+    """
+    dataset = path + '.dataset'
+    try:
+        result = write_parquet(store, dataset, row_group_size=row_group_size,
+                               progress=progress, **filters)
+        with zipfile.ZipFile(path + '.part', 'w', zipfile.ZIP_STORED) as archive:
+            for root, _, files in os.walk(dataset):
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    archive.write(file_path, os.path.relpath(file_path, dataset))
+        os.replace(path + '.part', path)
+    finally:
+        shutil.rmtree(dataset, ignore_errors=True)
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+    return {**result, 'size': os.path.getsize(path)}
+
+
+def main():
+    """Экспорт из командной строки (без запущенного сервера)"""
+    parser = argparse.ArgumentParser(description='Экспорт архива Telegrab в Parquet (разделы по чату и месяцу)')
+    parser.add_argument('output', help='Каталог набора (заменяется)')
+    parser.add_argument('--db', default='data/telegrab_v6.db', help='Путь к БД')
+    parser.add_argument('--chat-id', type=int, help='Только один чат')
+    parser.add_argument('--date-from', help='С даты (ISO)')
+    parser.add_argument('--date-to', help='По дату включительно (ISO)')
+    parser.add_argument('--limit', type=int, default=0, help='Максимум сообщений (0 — все)')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE, help='Строк в row group')
+    args = parser.parse_args()
+
+    if not PARQUET_AVAILABLE:
+        print("❌ Библиотека pyarrow не установлена!")
+        print("Установите: pip install pyarrow")
+        sys.exit(1)
+    if not os.path.exists(args.db):
+        print(f"❌ БД не найдена: {args.db}")
+        sys.exit(1)
+
+    from database_v6 import DatabaseV6
+
+    date_to = args.date_to
+    if date_to and len(date_to) == 10:
+        # Дата без времени — включительно: граница — начало следующего дня
+        date_to = (datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat()
+
+    print(f"💾 Экспорт {args.db} → {args.output}")
+    result = write_parquet(
+        DatabaseV6(args.db), args.output, row_group_size=args.row_group_size,
+        progress=lambda rows, size: print(f"   {rows} сообщений..."),
+        chat_id=args.chat_id, date_from=args.date_from, date_to=date_to, limit=args.limit
+    )
+    print(f"✅ Готово: {result['rows']} сообщений, {result['files']} файлов, {result['size']} байт")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Telegrab Export Stream
+Потоковый экспорт сообщений (NDJSON, CSV, JSON Lines RAW, JSON, HTML)
+из курсора БД с постоянным расходом памяти и необязательным gzip
+"""
+
+import io
+import os
+import csv
+import json
+import html
+import time
+import zlib
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Форматы: расширение файла и Content-Type
+EXPORT_FORMATS = {
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'jsonl': ('jsonl', 'application/x-ndjson'),
+    'csv': ('csv', 'text/csv; charset=utf-8'),
+    'json': ('json', 'application/json'),
+    'html': ('html', 'text/html; charset=utf-8'),
+}
+
+# Старые названия форматов
+FORMAT_ALIASES = {'raw': 'jsonl'}
+
+# Поля записи сообщения (NDJSON, JSON, CSV, HTML) в порядке столбцов iter_export_rows
+EXPORT_FIELDS = ('chat_id', 'message_id', 'chat_title', 'sender_id', 'sender',
+                 'date', 'text', 'has_media', 'media_type', 'views', 'edit_date')
+
+# Размер отдаваемого блока (байты до сжатия)
+CHUNK_SIZE = 64 * 1024
+
+# Каталог файлов фоновых экспортов
+EXPORTS_DIR = 'data/exports'
+
+# Интервал отчётов о прогрессе фонового экспорта (секунды)
+PROGRESS_INTERVAL = 1.0
+
+
+def normalize_format(format: str) -> Optional[str]:
+    """Формат экспорта по названию (None — неизвестный)"""
+    format = FORMAT_ALIASES.get((format or '').lower(), (format or '').lower())
+    return format if format in EXPORT_FORMATS else None
+
+
+def export_filename(format: str, chat_id: int = None, compress: bool = False) -> str:
+    """Имя файла экспорта"""
+    scope = f"chat_{chat_id}" if chat_id else 'all'
+    name = f"telegrab_{scope}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{EXPORT_FORMATS[format][0]}"
+    return name + '.gz' if compress else name
+
+
+def _record(row) -> Dict:
+    """Кортеж iter_export_rows → запись экспорта"""
+    record = dict(zip(EXPORT_FIELDS, row))
+    record['has_media'] = bool(record['has_media'])
+    return record
+
+
+def _raw_line(row) -> str:
+    """RAW строка: raw_data уже JSON, переносится без разбора"""
+    chat_id, message_id, saved_at, raw_data = row
+    return (f'{{"chat_id": {chat_id}, "message_id": {message_id}, '
+            f'"saved_at": {json.dumps(saved_at)}, "raw_data": {raw_data}}}\n')
+
+
+def _html_row(record: Dict) -> str:
+    """Строка HTML таблицы"""
+    cells = ''.join(f"<td>{html.escape(str(record[field]) if record[field] is not None else '')}</td>"
+                    for field in EXPORT_FIELDS)
+    return f"<tr>{cells}</tr>\n"
+
+
+def iter_text(rows: Iterable, format: str) -> Iterator[str]:
+    """Текст экспорта по частям (строки выборки iter_export_rows)"""
+    exported_at = datetime.now().isoformat()
+
+    if format == 'jsonl':
+        for row in rows:
+            yield _raw_line(row)
+
+    elif format == 'ndjson':
+        for row in rows:
+            yield json.dumps(_record(row), ensure_ascii=False) + '\n'
+
+    elif format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() >= CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    elif format == 'json':
+        # Документ прежнего формата; count известен только в конце
+        yield f'{{"exported_at": "{exported_at}", "format": "json", "messages": ['
+        count = 0
+        for row in rows:
+            yield (',\n' if count else '\n') + json.dumps(_record(row), ensure_ascii=False)
+            count += 1
+        yield f'\n], "count": {count}}}\n'
+
+    elif format == 'html':
+        header = ''.join(f"<th>{field}</th>" for field in EXPORT_FIELDS)
+        yield ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+               f'<title>Telegrab export {exported_at}</title></head><body>\n'
+               f'<table border="1">\n<tr>{header}</tr>\n')
+        for row in rows:
+            yield _html_row(_record(row))
+        yield '</table>\n</body></html>\n'
+
+
+def iter_bytes(pieces: Iterable[str], compress: bool = False) -> Iterator[bytes]:
+    """Склеить части в блоки по CHUNK_SIZE и при необходимости сжать gzip"""
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size < CHUNK_SIZE:
+            continue
+        data = ''.join(buffer).encode('utf-8')
+        buffer, size = [], 0
+        data = gzip.compress(data) if gzip else data
+        if data:
+            yield data
+    data = ''.join(buffer).encode('utf-8')
+    if gzip:
+        data = gzip.compress(data) + gzip.flush()
+    if data:
+        yield data
+
+
+def _counted(rows: Iterable, counter: List[int]) -> Iterator:
+    """Строки выборки со счётчиком counter[0]"""
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def stream_export(store, format: str, compress: bool = False, chat_id: int = None,
+                  date_from: str = None, date_to: str = None, limit: int = 0,
+                  counter: List[int] = None) -> Iterator[bytes]:
+    """
+    Экспорт как поток байтов
+
+    Args:
+        store: База данных (DatabaseV6.iter_export_rows)
+        format: ndjson, jsonl (RAW), csv, json или html
+        compress: gzip
+        chat_id, date_from, date_to, limit: фильтры iter_export_rows
+        counter: [0] — сюда считаются выгруженные сообщения
+    """
+    rows = store.iter_export_rows(chat_id=chat_id, date_from=date_from, date_to=date_to,
+                                  limit=limit, columns='raw' if format == 'jsonl' else 'meta')
+    if counter is not None:
+        rows = _counted(rows, counter)
+    return iter_bytes(iter_text(rows, format), compress)
+
+
+def write_export(store, path: str, format: str, compress: bool = False,
+                 progress: Callable[[int, int], None] = None, **filters) -> Dict:
+    """
+    Фоновый экспорт в файл (выполняется в потоке)
+
+    Пишется во временный .part и переименовывается по завершении, поэтому
+    в каталоге экспортов видны только готовые файлы.
+
+    Args:
+        path: Итоговый путь файла
+        progress: Вызывается не чаще PROGRESS_INTERVAL с (сообщений, байт)
+
+    Returns:
+        {'rows', 'size'}
+    """
+    counter = [0]
+    size = 0
+    reported = time.monotonic()
+    part = path + '.part'
+    try:
+        with open(part, 'wb') as f:
+            for chunk in stream_export(store, format, compress=compress, counter=counter, **filters):
+                f.write(chunk)
+                size += len(chunk)
+                if progress and time.monotonic() - reported >= PROGRESS_INTERVAL:
+                    reported = time.monotonic()
+                    progress(counter[0], size)
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return {'rows': counter[0], 'size': size}
+
+
+def list_exports(directory: str = EXPORTS_DIR) -> List[Dict]:
+    """Готовые файлы экспорта (новые первыми)"""
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.part') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        files.append({'file': name, 'size': stat.st_size,
+                      'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat()})
+    return sorted(files, key=lambda item: item['created_at'], reverse=True)
+
+
+def cleanup_exports(max_age_hours: float, directory: str = EXPORTS_DIR) -> int:
+    """
+    Удалить файлы экспорта старше max_age_hours
+
+    Файл, который сейчас пишется (.part), обновляется при каждой записи и
+    не устаревает; брошенные .part после сбоя удаляются вместе со старыми.
+
+    Returns:
+        Количество удалённых файлов
+    """
+    if not os.path.isdir(directory):
+        return 0
+    deadline = time.time() - max_age_hours * 3600
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isfile(path) and os.stat(path).st_mtime < deadline:
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Не удалось удалить экспорт {name}: {e}")
+    return removed
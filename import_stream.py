@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Telegrab Import Stream
+Потоковый импорт сообщений: тело запроса разбирается по частям
+(NDJSON, JSON Lines RAW, JSON документ экспорта, gzip) и пишется в БД
+пачками через промежуточную таблицу
+"""
+
+import re
+import json
+import time
+import zlib
+import codecs
+from typing import Dict, List, Optional
+
+# Сообщений в одной транзакции импорта
+IMPORT_BATCH = 10000
+
+# Длина строки, в пределах которой объект верхнего уровня пробуется как строка NDJSON
+LINE_PROBE = 1024 * 1024
+
+# Максимальный размер одной записи (защита от бесконечной буферизации)
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+# Пробелы и запятые между элементами / пробелы перед ':'
+_SEPARATORS = re.compile(r'[\s,]*')
+_SPACES = re.compile(r'\s*')
+
+# Ответ «данных пока недостаточно»
+_WAIT = object()
+
+
+class JsonRecordParser:
+    """
+    Инкрементальный разбор потока JSON на записи сообщений
+
+    Поддерживаются:
+    - NDJSON / JSON Lines: объект на строку (каждая строка — json.loads);
+    - массив записей [{...}, {...}];
+    - документ экспорта {"exported_at": ..., "messages": [...]} и прежний
+      формат /import {"data": {"messages": [...]}}: массив messages
+      разбирается по элементу через raw_decode, документ целиком в память
+      не загружается.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        # Кадры вложенности: ['array'] или ['object', ключи, messages_разобраны]
+        self.stack = []
+        self.started = False
+
+    def feed(self, data: bytes, final: bool = False) -> List:
+        """
+        Добавить байты потока
+
+        Returns:
+            Записи, разобранные полностью
+        """
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(data, final)
+        self.pos = 0
+        if not self.started and self.buffer:
+            self.started = True
+            if self.buffer.startswith('\ufeff'):
+                self.pos = 1
+
+        records = []
+        self._parse(records, final)
+        if final and (self.stack or self.buffer[self.pos:].strip()):
+            raise ValueError("Неожиданный конец JSON")
+        return records
+
+    def close(self) -> List:
+        """Конец потока: оставшиеся записи"""
+        return self.feed(b'', final=True)
+
+    def _decode(self, pos: int, final: bool):
+        """JSON значение с позиции pos: (value, end) или None — ждать данных"""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except json.JSONDecodeError as e:
+            if final or len(self.buffer) - pos > MAX_RECORD_SIZE:
+                raise ValueError(f"Ошибка JSON: {e}")
+            return None
+        # Число или литерал мог оборваться на границе блока
+        if end >= len(self.buffer) and not final:
+            return None
+        return value, end
+
+    def _line(self, pos: int, final: bool):
+        """Объект верхнего уровня как строка NDJSON: (value, end), None — разбирать по ключам"""
+        newline = self.buffer.find('\n', pos, pos + LINE_PROBE)
+        if newline == -1:
+            if len(self.buffer) - pos >= LINE_PROBE:
+                return None
+            if not final:
+                return _WAIT
+            newline = len(self.buffer)
+        try:
+            return json.loads(self.buffer[pos:newline]), newline
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _emit(value, records: List):
+        """Объект верхнего уровня: документ с messages или одна запись"""
+        if isinstance(value, dict):
+            data = value.get('data')
+            messages = data.get('messages') if isinstance(data, dict) else value.get('messages')
+            if isinstance(messages, list):
+                records.extend(messages)
+                return
+        records.append(value)
+
+    def _parse(self, records: List, final: bool):
+        """Разобрать буфер насколько возможно"""
+        buffer = self.buffer
+        while True:
+            pos = _SEPARATORS.match(buffer, self.pos).end()
+            self.pos = pos
+            if pos >= len(buffer):
+                return
+            char = buffer[pos]
+            frame = self.stack[-1] if self.stack else None
+
+            if frame is None:
+                if char == '[':
+                    self.stack.append(['array'])
+                    self.pos = pos + 1
+                    continue
+                if char != '{':
+                    raise ValueError(f"Ожидался объект или массив JSON (символ {pos})")
+                line = self._line(pos, final)
+                if line is _WAIT:
+                    return
+                if line is not None:
+                    value, self.pos = line
+                    self._emit(value, records)
+                    continue
+                self.stack.append(['object', {}, False])
+                self.pos = pos + 1
+                continue
+
+            if frame[0] == 'array':
+                if char == ']':
+                    self.stack.pop()
+                    self.pos = pos + 1
+                    continue
+                decoded = self._decode(pos, final)
+                if decoded is None:
+                    return
+                value, self.pos = decoded
+                records.append(value)
+                continue
+
+            # Объект документа: ключи по одному, messages / data — вглубь
+            if char == '}':
+                self.stack.pop()
+                self.pos = pos + 1
+                if frame[2]:
+                    if self.stack and self.stack[-1][0] == 'object':
+                        self.stack[-1][2] = True
+                elif not self.stack:
+                    self._emit(frame[1], records)
+                continue
+            decoded = self._decode(pos, final)
+            if decoded is None:
+                return
+            key, end = decoded
+            if not isinstance(key, str):
+                raise ValueError(f"Ожидался ключ объекта (символ {pos})")
+            colon = _SPACES.match(buffer, end).end()
+            value_pos = _SPACES.match(buffer, colon + 1).end()
+            if value_pos >= len(buffer):
+                if final:
+                    raise ValueError("Неожиданный конец JSON")
+                return
+            if buffer[colon] != ':':
+                raise ValueError(f"Ожидалось ':' (символ {colon})")
+            if key == 'messages' and buffer[value_pos] == '[':
+                frame[2] = True
+                self.stack.append(['array'])
+                self.pos = value_pos + 1
+                continue
+            if key == 'data' and buffer[value_pos] == '{':
+                self.stack.append(['object', {}, False])
+                self.pos = value_pos + 1
+                continue
+            decoded = self._decode(value_pos, final)
+            if decoded is None:
+                return
+            frame[1][key], self.pos = decoded
+
+
+def import_row(record) -> Optional[tuple]:
+    """
+    Запись импорта → строка промежуточной таблицы (DatabaseV6.import_messages)
+
+    Принимаются записи NDJSON / JSON экспорта (chat_id, message_id, text,
+    sender, date, ...) и RAW строки JSON Lines (chat_id, message_id, raw_data).
+
+    Returns:
+        Кортеж или None — запись без chat_id / message_id
+    """
+    if not isinstance(record, dict):
+        return None
+    try:
+        chat_id = int(record.get('chat_id') or 0)
+        message_id = int(record.get('message_id') or 0)
+    except (TypeError, ValueError):
+        return None
+    if not chat_id or not message_id:
+        return None
+
+    raw_data = record.get('raw_data')
+    if isinstance(raw_data, dict):
+        # RAW дамп переносится как есть, метаданные — из него
+        source = raw_data
+        sender_name = raw_data.get('sender_name')
+        has_media = raw_data.get('media_type') is not None
+    else:
+        source = record
+        sender_name = record.get('sender', record.get('sender_name')) or ''
+        has_media = record.get('has_media', record.get('media_type') is not None)
+        raw_data = {
+            'id': message_id,
+            'chat_id': chat_id,
+            'chat_title': record.get('chat_title'),
+            'text': record.get('text') or '',
+            'sender_name': sender_name,
+            'sender_id': record.get('sender_id'),
+            'date': record.get('date'),
+            'media_type': record.get('media_type'),
+            'files': []
+        }
+    text = source.get('text') or ''
+    return (
+        chat_id,
+        message_id,
+        json.dumps(raw_data, ensure_ascii=False),
+        source.get('chat_title'),
+        source.get('sender_id'),
+        sender_name,
+        source.get('date'),
+        1 if has_media else 0,
+        source.get('media_type'),
+        text[:500],
+        source.get('views', 0),
+        source.get('edit_date'),
+        text
+    )
+
+
+class StreamImporter:
+    """
+    Импорт из потока байтов
+
+    Тело разбирается по мере поступления (gzip распознаётся по сигнатуре),
+    записи копятся до batch и пишутся одной транзакцией
+    DatabaseV6.import_messages: память не зависит от размера файла.
+    """
+
+    def __init__(self, store, skip_duplicates: bool = True, update_edits: bool = False,
+                 batch: int = IMPORT_BATCH):
+        """
+        Args:
+            store: База данных (DatabaseV6.import_messages)
+            skip_duplicates: Уже сохранённые сообщения пропускаются (иначе перезаписываются)
+            update_edits: Для пропущенных дубликатов с другим текстом — записать редактирование
+            batch: Сообщений в транзакции
+        """
+        self.store = store
+        self.skip_duplicates = skip_duplicates
+        self.update_edits = update_edits
+        self.batch = max(int(batch), 1)
+        self.parser = JsonRecordParser()
+        self.gzip = None
+        self.started = False
+        self.rows = []
+        self.started_at = time.monotonic()
+        self.stats = {'received': 0, 'imported': 0, 'skipped': 0, 'updated': 0, 'invalid': 0, 'bytes': 0}
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Очередной блок тела запроса
+
+        Returns:
+            True — записана пачка (время сообщить о прогрессе)
+        """
+        if not data:
+            return False
+        if not self.started:
+            self.started = True
+            if data[:2] == b'\x1f\x8b':
+                self.gzip = zlib.decompressobj(31)
+        self.stats['bytes'] += len(data)
+        if self.gzip:
+            data = self.gzip.decompress(data)
+        return self._add(self.parser.feed(data))
+
+    def finish(self) -> Dict:
+        """Конец потока: последняя пачка и итог"""
+        tail = self.gzip.flush() if self.gzip else b''
+        self._add(self.parser.feed(tail, final=True))
+        self._flush()
+        return self.progress()
+
+    def _add(self, records: List) -> bool:
+        """Записи разбора → пачки"""
+        written = False
+        for record in records:
+            self.stats['received'] += 1
+            row = import_row(record)
+            if row is None:
+                self.stats['invalid'] += 1
+                continue
+            self.rows.append(row)
+            if len(self.rows) >= self.batch:
+                self._flush()
+                written = True
+        return written
+
+    def _flush(self):
+        """Записать накопленную пачку"""
+        if not self.rows:
+            return
+        result = self.store.import_messages(self.rows, skip_duplicates=self.skip_duplicates,
+                                            update_edits=self.update_edits)
+        for key in ('imported', 'skipped', 'updated'):
+            self.stats[key] += result[key]
+        self.rows = []
+
+    def progress(self) -> Dict:
+        """Счётчики и скорость (сообщений в секунду)"""
+        elapsed = time.monotonic() - self.started_at
+        return {
+            **self.stats,
+            'seconds': round(elapsed, 1),
+            'per_second': round(self.stats['received'] / elapsed) if elapsed else 0
+        }
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Telegrab Ingest Pipeline
+Пакетная запись живых сообщений: разбор → буфер → одна транзакция
+и одно объединённое WebSocket уведомление на пачку
+"""
+
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List
+
+logger = logging.getLogger('telegrab')
+
+# Пауза перед повтором пачки после ошибки записи (удваивается до MAX_RETRY_DELAY)
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+# Сколько неудачных попыток подряд drain() ждёт, прежде чем сдаться
+DRAIN_ATTEMPTS = 5
+
+
+class IngestPipeline:
+    """
+    Микро-пакетная запись новых сообщений
+
+    Обработчик события только разбирает сообщение в компактную запись
+    (build_message_record) и кладёт её в буфер через submit(). Буфер
+    сбрасывается, когда набралось max_batch записей или прошло max_delay
+    секунд с первой записи пачки: все записи сохраняются одной транзакцией
+    (save_messages_batch), затем уходит одно уведомление WebSocket.
+
+    Сбросом занимается единственная фоновая задача, а записи хранятся в
+    порядке поступления, поэтому порядок сообщений внутри чата сохраняется.
+
+    Если запись не удалась, пачка возвращается в начало буфера и
+    повторяется с нарастающей паузой; уведомления уходят только для
+    сохранённых пачек. Каждая запись получает номер (seq), committed —
+    номер последней сохранённой записи.
+    """
+
+    def __init__(self, store, broadcast: Callable[[Dict], Awaitable[None]],
+                 max_batch: int = 100, max_delay: float = 0.02):
+        """
+        Args:
+            store: База данных с методом save_messages_batch(records)
+            broadcast: Корутина отправки уведомления WebSocket
+            max_batch: Максимум записей в пачке
+            max_delay: Максимальная задержка пачки (секунды)
+        """
+        self.store = store
+        self.broadcast = broadcast
+        self.max_batch = max(int(max_batch), 1)
+        self.max_delay = max(float(max_delay), 0.0)
+        self.buffer: List[Dict] = []
+        self.submitted = 0
+        self.committed = 0
+        self._failures = 0
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.stats = {'events': 0, 'batches': 0, 'saved': 0, 'failed_batches': 0,
+                      'max_batch_seen': 0, 'last_flush_ms': 0.0}
+
+    def submit(self, record: Dict, notification: Dict = None):
+        """Добавить разобранное сообщение в буфер (без ожидания)"""
+        self.submitted += 1
+        self.buffer.append({'record': record, 'notification': notification, 'seq': self.submitted})
+        self.stats['events'] += 1
+        self._has_data.set()
+        if len(self.buffer) >= self.max_batch:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        """Фоновая задача сброса буфера"""
+        while True:
+            await self._has_data.wait()
+            if len(self.buffer) < self.max_batch and self.max_delay > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Сохранить накопленные записи одной транзакцией и уведомить клиентов
+
+        Returns:
+            False — запись не удалась (пачка осталась в буфере)
+        """
+        # Пачки пишутся строго по очереди — порядок записи совпадает с порядком поступления
+        async with self._flush_lock:
+            batch = self.buffer[:self.max_batch]
+            del self.buffer[:len(batch)]
+            if len(self.buffer) < self.max_batch:
+                self._full.clear()
+            if not self.buffer:
+                self._has_data.clear()
+            if not batch:
+                return True
+
+            started = time.monotonic()
+            try:
+                saved = await asyncio.to_thread(self.store.save_messages_batch, [item['record'] for item in batch])
+            except Exception as e:
+                # Пачка возвращается в начало буфера — порядок не нарушается
+                self.buffer[:0] = batch
+                self._has_data.set()
+                if len(self.buffer) >= self.max_batch:
+                    self._full.set()
+                self._failures += 1
+                self.stats['failed_batches'] += 1
+                delay = min(RETRY_DELAY * 2 ** (self._failures - 1), MAX_RETRY_DELAY)
+                logger.error(f"Ошибка записи пачки сообщений ({len(batch)}), повтор через {delay} сек: {e}")
+                await asyncio.sleep(delay)
+                return False
+
+            self._failures = 0
+            self.committed = batch[-1]['seq']
+
+        self.stats['batches'] += 1
+        self.stats['saved'] += saved
+        self.stats['max_batch_seen'] = max(self.stats['max_batch_seen'], len(batch))
+        self.stats['last_flush_ms'] = round((time.monotonic() - started) * 1000, 1)
+        logger.info(f"💾 Пачка живых сообщений: {saved}/{len(batch)} за {self.stats['last_flush_ms']} мс")
+
+        notifications = [item['notification'] for item in batch if item['notification']]
+        if notifications:
+            try:
+                await self.broadcast({'type': 'new_messages', 'messages': notifications})
+            except Exception as e:
+                logger.error(f"Ошибка уведомления WebSocket: {e}")
+        return True
+
+    async def drain(self) -> bool:
+        """
+        Дождаться записи всего буфера (например, перед применением редактирования)
+
+        Returns:
+            False — БД недоступна DRAIN_ATTEMPTS попыток подряд, в буфере остались записи
+        """
+        failures = 0
+        while self.buffer:
+            if await self.flush():
+                failures = 0
+                continue
+            failures += 1
+            if failures >= DRAIN_ATTEMPTS:
+                logger.error(f"Буфер живых сообщений не записан: {len(self.buffer)} записей")
+                return False
+        # Пачка, которую уже пишет фоновая задача
+        async with self._flush_lock:
+            pass
+        return True
+
+    async def stop(self):
+        """Сбросить остаток буфера и остановить фоновую задачу"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.drain()
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'buffered': len(self.buffer), 'committed_seq': self.committed,
+                'max_batch': self.max_batch, 'max_delay_ms': round(self.max_delay * 1000, 1)}
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Telegrab IPC
+Локальный канал между ingest-процессом и HTTP воркерами (Unix socket):
+события для WebSocket и пересылка запросов, которым нужен Telegram клиент
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Путь к сокету по умолчанию (рядом с БД)
+DEFAULT_SOCKET = 'data/telegrab.sock'
+
+# Максимальная длина строки протокола
+LINE_LIMIT = 64 * 1024 * 1024
+
+# Тело ответа больше этого размера не идёт через сокет: ingest-процесс пишет
+# его в файл SPOOL_DIR, HTTP воркер отдаёт файл (FileResponse) и удаляет
+INLINE_BODY_LIMIT = 1024 * 1024
+
+# Каталог файлов ответов (рядом с БД, общий для процессов)
+SPOOL_DIR = 'data/ipc_spool'
+
+# Файлы ответов, которые никто не забрал (воркер не дождался), удаляются через час
+SPOOL_MAX_AGE = 3600
+
+# Начало строки, по которому определяется вызов при слишком длинной строке
+LINE_HEAD = 256
+_LINE_ID = re.compile(rb'^\{"(?:id|reply)": (\d+)')
+
+# Пауза перед переподключением воркера к ingest-процессу (секунды)
+RECONNECT_DELAY = 1.0
+
+
+class IngestUnavailableError(Exception):
+    """Ingest-процесс недоступен (не запущен или соединение разорвано)"""
+
+
+class IngestPayloadTooLargeError(Exception):
+    """Запрос к ingest-процессу длиннее LINE_LIMIT"""
+
+
+class IngestReplyTooLargeError(Exception):
+    """Ответ ingest-процесса длиннее LINE_LIMIT"""
+
+
+class LineTooLongError(Exception):
+    """Строка протокола длиннее LINE_LIMIT (остаток строки уже пропущен)"""
+
+    def __init__(self, head: bytes):
+        super().__init__(f"Строка IPC длиннее {LINE_LIMIT} байт")
+        match = _LINE_ID.match(head)
+        # ID вызова (id запроса или reply ответа), если он попал в начало строки
+        self.call_id = int(match.group(1)) if match else None
+
+
+def encode(message: Dict) -> bytes:
+    """Строка протокола: JSON и перевод строки"""
+    return json.dumps(message, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+
+
+async def read_line(reader) -> bytes:
+    """
+    Строка протокола (b'' — соединение закрыто)
+
+    Raises:
+        LineTooLongError: Строка длиннее LINE_LIMIT; она пропущена целиком,
+            соединение можно читать дальше
+    """
+    try:
+        return await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError:
+        pass
+    head = await reader.read(LINE_HEAD)
+    # Пропускаем остаток строки, не накапливая его
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            break
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(max(e.consumed, 1))
+        except asyncio.IncompleteReadError:
+            break
+    raise LineTooLongError(head)
+
+
+def clean_spool(spool_dir: str = SPOOL_DIR, max_age: float = 0):
+    """Удалить файлы ответов старше max_age секунд (0 — все)"""
+    if not os.path.isdir(spool_dir):
+        return
+    now = time.time()
+    for name in os.listdir(spool_dir):
+        path = os.path.join(spool_dir, name)
+        try:
+            if now - os.path.getmtime(path) >= max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+async def asgi_request(app, method: str, path: str, query_string: str = '',
+                       headers: List = None, body: str = '', spool_dir: str = SPOOL_DIR) -> Dict:
+    """
+    Выполнить HTTP запрос к ASGI приложению внутри процесса (без сети)
+
+    Args:
+        body: Тело запроса в base64
+        spool_dir: Каталог для тел ответов больше INLINE_BODY_LIMIT
+
+    Returns:
+        {'status', 'headers': [[name, value], ...], 'body': base64} или
+        вместо 'body' — 'file': путь к файлу с телом (удаляет получатель)
+    """
+    body = base64.b64decode(body) if body else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'root_path': '',
+        'query_string': query_string.encode('latin-1'),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers or []],
+        'client': ('127.0.0.1', 0),
+        'server': ('127.0.0.1', 0),
+    }
+    sent = False
+    response = {'status': 500, 'headers': [], 'chunks': [], 'size': 0, 'file': None, 'path': None}
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # Клиент «не отключается», пока приложение не ответит
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = [[name.decode('latin-1'), value.decode('latin-1')]
+                                   for name, value in message.get('headers', [])]
+        elif message['type'] == 'http.response.body':
+            chunk = message.get('body', b'')
+            response['size'] += len(chunk)
+            if response['file'] is None and response['size'] > INLINE_BODY_LIMIT:
+                # Большое тело — в файл, по мере поступления
+                os.makedirs(spool_dir, exist_ok=True)
+                clean_spool(spool_dir, SPOOL_MAX_AGE)
+                response['path'] = os.path.abspath(os.path.join(spool_dir, uuid.uuid4().hex))
+                response['file'] = open(response['path'], 'wb')
+                response['file'].writelines(response['chunks'])
+                response['chunks'] = []
+            if response['file'] is not None:
+                response['file'].write(chunk)
+            else:
+                response['chunks'].append(chunk)
+
+    try:
+        await app(scope, receive, send)
+    except BaseException:
+        if response['file'] is not None:
+            response['file'].close()
+            os.remove(response['path'])
+        raise
+    result = {'status': response['status'], 'headers': response['headers']}
+    if response['file'] is not None:
+        response['file'].close()
+        result['file'] = response['path']
+    else:
+        result['body'] = base64.b64encode(b''.join(response['chunks'])).decode('ascii')
+    return result
+
+
+class EventHub:
+    """
+    Сервер IPC в ingest-процессе
+
+    HTTP воркеры подключаются к Unix socket и получают все события
+    publish() (для рассылки своим WebSocket клиентам). По тому же
+    соединению воркер присылает вызовы {'id', 'call', 'args'}; ответ
+    {'reply': id, 'result' | 'error'} уходит только ему.
+    """
+
+    def __init__(self, path: str = DEFAULT_SOCKET):
+        """
+        Args:
+            path: Путь к Unix socket
+        """
+        self.path = path
+        self.handlers: Dict[str, Callable[[Dict], Awaitable]] = {}
+        self.writers = set()
+        self._connections = set()
+        self._server = None
+        self.stats = {'events': 0, 'calls': 0, 'errors': 0, 'connections': 0}
+
+    def register(self, name: str, handler: Callable[[Dict], Awaitable]):
+        """Обработчик вызова name(args)"""
+        self.handlers[name] = handler
+
+    async def start(self):
+        """Запустить сервер (старый сокет и файлы ответов прошлого запуска удаляются)"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        clean_spool()
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path, limit=LINE_LIMIT)
+        print(f"🔌 IPC канал: {self.path}")
+
+    async def stop(self):
+        """Остановить сервер и закрыть соединения"""
+        if self._server:
+            self._server.close()
+            self._server = None
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+        # Дождаться завершения соединений (EOF после закрытия)
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=RECONNECT_DELAY)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def publish(self, message: Dict):
+        """Разослать событие всем воркерам (без ожидания)"""
+        if not self.writers:
+            return
+        self.stats['events'] += 1
+        line = encode({'event': message})
+        for writer in list(self.writers):
+            try:
+                writer.write(line)
+            except Exception:
+                self.writers.discard(writer)
+
+    async def _serve(self, reader, writer):
+        """Соединение воркера"""
+        self.writers.add(writer)
+        self._connections.add(asyncio.current_task())
+        self.stats['connections'] += 1
+        try:
+            while True:
+                try:
+                    line = await read_line(reader)
+                except LineTooLongError as e:
+                    # Отказ только этому вызову, соединение остаётся
+                    self.stats['errors'] += 1
+                    logger.error(f"IPC: запрос воркера длиннее {LINE_LIMIT} байт отклонён")
+                    if e.call_id is not None:
+                        await self._reply(writer, {'reply': e.call_id, 'error': str(e), 'too_large': 'request'})
+                    continue
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                asyncio.create_task(self._answer(request, writer))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка соединения IPC воркера: {e}")
+        finally:
+            self.writers.discard(writer)
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _answer(self, request: Dict, writer):
+        """Выполнить вызов воркера и отправить ответ"""
+        self.stats['calls'] += 1
+        handler = self.handlers.get(request.get('call'))
+        try:
+            if handler is None:
+                raise ValueError(f"Неизвестный вызов: {request.get('call')}")
+            reply = {'reply': request.get('id'), 'result': await handler(request.get('args') or {})}
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Ошибка IPC вызова {request.get('call')}: {e}")
+            reply = {'reply': request.get('id'), 'error': str(e)}
+        await self._reply(writer, reply)
+
+    async def _reply(self, writer, reply: Dict):
+        """Отправить ответ воркеру (слишком длинный — заменяется ошибкой)"""
+        line = encode(reply)
+        if len(line) > LINE_LIMIT:
+            self.stats['errors'] += 1
+            logger.error(f"IPC: ответ на вызов {reply.get('reply')} длиннее {LINE_LIMIT} байт")
+            line = encode({'reply': reply.get('reply'), 'error': f"Ответ длиннее {LINE_LIMIT} байт",
+                           'too_large': 'reply'})
+        try:
+            writer.write(line)
+            await writer.drain()
+        except Exception:
+            self.writers.discard(writer)
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'workers': len(self.writers), 'path': self.path}
+
+
+class IngestLink:
+    """
+    Клиент IPC в HTTP воркере
+
+    Держит соединение с ingest-процессом (переподключается при разрыве),
+    передаёт события в on_event и выполняет вызовы call().
+    """
+
+    def __init__(self, path: str = DEFAULT_SOCKET,
+                 on_event: Optional[Callable[[Dict], Awaitable]] = None):
+        """
+        Args:
+            path: Путь к Unix socket ingest-процесса
+            on_event: Корутина для каждого события (рассылка WebSocket клиентам)
+        """
+        self.path = path
+        self.on_event = on_event
+        self.writer = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._seq = 0
+        self._task = None
+
+    @property
+    def connected(self) -> bool:
+        """Есть ли соединение с ingest-процессом"""
+        return self.writer is not None
+
+    def start(self):
+        """Запустить фоновое соединение"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить соединение"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    async def _run(self):
+        """Соединение с переподключением"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+            except (OSError, ConnectionError):
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            self.writer = writer
+            logger.info(f"Подключено к ingest-процессу: {self.path}")
+            try:
+                while True:
+                    try:
+                        line = await read_line(reader)
+                    except LineTooLongError as e:
+                        # Ошибка только ожидающему вызову, соединение остаётся
+                        logger.error(f"IPC: ответ ingest-процесса длиннее {LINE_LIMIT} байт отброшен")
+                        future = self._pending.pop(e.call_id, None)
+                        if future and not future.done():
+                            future.set_exception(IngestReplyTooLargeError(str(e)))
+                        continue
+                    if not line:
+                        break
+                    try:
+                        message = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'reply' in message:
+                        future = self._pending.pop(message['reply'], None)
+                        if future and not future.done():
+                            future.set_result(message)
+                    elif 'event' in message and self.on_event:
+                        try:
+                            await self.on_event(message['event'])
+                        except Exception as e:
+                            logger.error(f"Ошибка рассылки события: {e}")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except Exception as e:
+                # Любой сбой чтения — переподключение, а не остановка канала
+                logger.error(f"Ошибка соединения с ingest-процессом: {e}")
+            finally:
+                writer.close()
+                self.writer = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(IngestUnavailableError("Соединение с ingest-процессом разорвано"))
+                self._pending.clear()
+            logger.warning("Соединение с ingest-процессом потеряно, переподключение...")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def call(self, name: str, args: Dict = None, timeout: float = 300):
+        """
+        Вызов обработчика ingest-процесса
+
+        Raises:
+            IngestUnavailableError: Нет соединения или нет ответа за timeout
+            IngestPayloadTooLargeError: Запрос длиннее LINE_LIMIT
+            IngestReplyTooLargeError: Ответ длиннее LINE_LIMIT
+        """
+        if self.writer is None:
+            raise IngestUnavailableError("Ingest-процесс недоступен")
+        self._seq += 1
+        call_id = self._seq
+        line = encode({'id': call_id, 'call': name, 'args': args or {}})
+        if len(line) > LINE_LIMIT:
+            raise IngestPayloadTooLargeError(f"Запрос длиннее {LINE_LIMIT} байт")
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = future
+        self.writer.write(line)
+        try:
+            await self.writer.drain()
+            reply = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise IngestUnavailableError(f"Ingest-процесс не ответил за {timeout} сек")
+        finally:
+            self._pending.pop(call_id, None)
+        if reply.get('too_large') == 'reply':
+            raise IngestReplyTooLargeError(reply['error'])
+        if reply.get('too_large'):
+            raise IngestPayloadTooLargeError(reply['error'])
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['result']
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Telegrab Page Size
+Адаптивный размер страницы запросов истории по чатам
+"""
+
+import time
+import logging
+from typing import Dict
+
+logger = logging.getLogger('telegrab')
+
+# Границы размера страницы (messages.getHistory отдаёт не больше 100)
+MIN_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Ответ быстрее FAST_MS — можно увеличить страницу, медленнее SLOW_MS — уменьшить
+FAST_MS = 800
+SLOW_MS = 3000
+
+# Доля сохраняемых сообщений (не служебных) в «плотной» и «пустой» странице
+DENSE_SHARE = 0.9
+SPARSE_SHARE = 0.5
+
+GROW_STEP = 20          # Аддитивное увеличение страницы
+SHRINK_FACTOR = 0.5     # Уменьшение при ошибке
+SLOW_FACTOR = 0.75      # Уменьшение при медленной / пустой странице
+LATENCY_WEIGHT = 0.3    # Вес новой задержки в скользящем среднем
+PERSIST_EVERY = 10      # Страниц между сохранениями задержки
+
+
+class PageSizer:
+    """
+    Размер страницы истории для каждого чата
+
+    Загрузчики спрашивают размер через get() и после каждой страницы
+    сообщают результат через record(): сколько запрошено, сколько пришло,
+    сколько сохранено (не служебных) и задержку ответа. Страница растёт
+    аддитивно до ceiling, когда ответы быстрые и плотные (полная страница,
+    почти все сообщения сохраняются), и уменьшается, когда ответы медленные,
+    когда страница состоит в основном из служебных сообщений или при ошибке.
+
+    Размер и средняя задержка хранятся в chat_loading_status
+    (page_size, avg_latency_ms) и переживают перезапуск.
+    """
+
+    def __init__(self, store=None, ceiling: int = MAX_PAGE_SIZE):
+        """
+        Args:
+            store: База данных с методами get_page_tuning / save_page_tuning
+            ceiling: Максимальный размер страницы (MESSAGES_PER_REQUEST)
+        """
+        self.store = store
+        self.ceiling = min(max(int(ceiling), MIN_PAGE_SIZE), MAX_PAGE_SIZE)
+        self.chats: Dict = {}
+        self._loaded = False
+        self.stats = {'pages': 0, 'grown': 0, 'shrunk': 0, 'errors': 0}
+
+    def _state(self, chat_id) -> Dict:
+        """Состояние чата (при первом обращении — из БД)"""
+        if not self._loaded:
+            self._loaded = True
+            if self.store:
+                try:
+                    for saved_id, saved in self.store.get_page_tuning().items():
+                        self.chats[saved_id] = {
+                            'page_size': min(max(saved['page_size'], MIN_PAGE_SIZE), self.ceiling),
+                            'latency_ms': saved.get('avg_latency_ms'),
+                            'pages': 0
+                        }
+                except Exception as e:
+                    logger.error(f"Ошибка чтения размеров страниц: {e}")
+
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = {'page_size': self.ceiling, 'latency_ms': None, 'pages': 0}
+            self.chats[chat_id] = state
+        return state
+
+    def set_ceiling(self, ceiling: int):
+        """Новый максимум страницы (MESSAGES_PER_REQUEST изменён через /config)"""
+        self.ceiling = min(max(int(ceiling), MIN_PAGE_SIZE), MAX_PAGE_SIZE)
+        for state in self.chats.values():
+            state['page_size'] = min(state['page_size'], self.ceiling)
+
+    def get(self, chat_id) -> int:
+        """Размер следующей страницы чата"""
+        return self._state(chat_id)['page_size']
+
+    @staticmethod
+    def timed(func, probe: Dict):
+        """Обёртка запроса, замеряющая только сам вызов (без ожидания rate limiter)"""
+        async def call(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                probe['latency_ms'] = (time.monotonic() - started) * 1000
+        return call
+
+    def record(self, chat_id, requested: int, received: int, kept: int, latency_ms: float):
+        """Результат страницы: запрошено, пришло, сохранено (не служебных), задержка"""
+        state = self._state(chat_id)
+        state['pages'] += 1
+        self.stats['pages'] += 1
+        if state['latency_ms'] is None:
+            state['latency_ms'] = latency_ms
+        else:
+            state['latency_ms'] += LATENCY_WEIGHT * (latency_ms - state['latency_ms'])
+
+        size = state['page_size']
+        share = kept / received if received else 1.0
+        if latency_ms > SLOW_MS or (received >= MIN_PAGE_SIZE and share < SPARSE_SHARE):
+            size = int(size * SLOW_FACTOR)
+        elif latency_ms < FAST_MS and received >= requested and share >= DENSE_SHARE:
+            size += GROW_STEP
+        self._update(chat_id, state, size)
+
+    def record_error(self, chat_id):
+        """Ошибка запроса (таймаут, сбой соединения) — страница уменьшается вдвое"""
+        state = self._state(chat_id)
+        self.stats['errors'] += 1
+        self._update(chat_id, state, int(state['page_size'] * SHRINK_FACTOR))
+
+    def _update(self, chat_id, state: Dict, size: int):
+        """Применить новый размер и сохранить при изменении"""
+        size = min(max(size, MIN_PAGE_SIZE), self.ceiling)
+        changed = size != state['page_size']
+        if changed:
+            self.stats['grown' if size > state['page_size'] else 'shrunk'] += 1
+            logger.debug(f"Чат {chat_id}: размер страницы {state['page_size']} → {size}")
+            state['page_size'] = size
+        if self.store and (changed or state['pages'] % PERSIST_EVERY == 0):
+            try:
+                self.store.save_page_tuning(chat_id, size, round(state['latency_ms'] or 0, 1))
+            except Exception as e:
+                logger.error(f"Ошибка сохранения размера страницы {chat_id}: {e}")
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        sizes = [state['page_size'] for state in self.chats.values()]
+        return {**self.stats, 'chats': len(sizes), 'ceiling': self.ceiling,
+                'avg_page_size': round(sum(sizes) / len(sizes), 1) if sizes else self.ceiling}
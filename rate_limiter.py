@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Telegrab Rate Limiter
+Единый token bucket для всех запросов к Telegram API одного аккаунта
+с адаптивной (AIMD) скоростью по классам методов
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Стоимость запроса (в токенах) по классам методов Telegram API
+METHOD_COSTS = {
+    'history': 1.0,     # messages.getHistory
+    'resolve': 1.0,     # get_entity / contacts.resolveUsername / getParticipants
+    'dialogs': 1.0,     # messages.getDialogs (одна страница до 100 диалогов)
+    'join': 5.0,        # channels.joinChannel / messages.importChatInvite
+    'download': 2.0,    # upload.getFile
+    'updates': 1.0,     # updates.getState / getDifference / getChannelDifference
+    'takeout': 0.25,    # messages.getHistory внутри takeout-сессии (мягче лимиты)
+}
+
+# Параметры AIMD
+MIN_RATE = 0.05             # Минимальная скорость класса (токенов/сек)
+INCREASE_EVERY = 20         # Успешных запросов до очередного увеличения
+INCREASE_STEP = 0.1         # Аддитивное увеличение (токенов/сек)
+DECREASE_FACTOR = 0.5       # Мультипликативное уменьшение при FloodWait
+FLOOD_EVENTS_KEPT = 50      # Сколько последних FloodWait хранить для /queue
+
+
+class RateLimiter:
+    """
+    Асинхронный token bucket с адаптивной скоростью
+
+    Все вызовы Telethon проходят через acquire() с указанием класса метода.
+    Общий bucket ограничивает суммарную скорость аккаунта (rate), а каждый
+    класс методов дополнительно темпируется своей скоростью, которая растёт
+    аддитивно при успешных запросах и уменьшается вдвое при FloodWaitError.
+
+    Ожидающие обслуживаются в порядке очереди (FIFO).
+    """
+
+    def __init__(self, rate: float, capacity: float = None, class_rate: float = None,
+                 adaptive: bool = True, state: Dict[str, Dict] = None,
+                 persist: Optional[Callable[[str, Dict], None]] = None):
+        """
+        Args:
+            rate: Потолок общей скорости аккаунта (токенов/сек)
+            capacity: Ёмкость bucket (burst), по умолчанию rate
+            class_rate: Начальная скорость класса методов (по умолчанию rate)
+            adaptive: Включить AIMD подстройку скорости классов
+            state: Сохранённые скорости классов {method: {'rate': ...}}
+            persist: Функция сохранения состояния класса (method, state)
+        """
+        self.rate = max(float(rate), 0.01)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.requests: Dict[str, int] = {}
+        self.total_wait = 0.0
+
+        self.adaptive = adaptive
+        self.default_class_rate = min(float(class_rate or self.rate), self.rate)
+        self.persist = persist
+        self.classes: Dict[str, Dict] = {}
+        self.flood_events = deque(maxlen=FLOOD_EVENTS_KEPT)
+        self._class_locks: Dict[str, asyncio.Lock] = {}
+
+        for method, saved in (state or {}).items():
+            cls = self._get_class(method)
+            if self.adaptive and saved.get('rate'):
+                cls['rate'] = min(max(float(saved['rate']), MIN_RATE), self.rate)
+            cls['floods'] = saved.get('flood_count') or 0
+
+    def _get_class(self, method: str) -> Dict:
+        """Состояние класса методов"""
+        cls = self.classes.get(method)
+        if cls is None:
+            cls = {
+                'rate': self.default_class_rate,
+                'next_at': 0.0,
+                'blocked_until': 0.0,
+                'successes': 0,
+                'floods': 0
+            }
+            self.classes[method] = cls
+            self._class_locks[method] = asyncio.Lock()
+        return cls
+
+    def _refill(self):
+        """Начисление токенов за прошедшее время"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, method: str = 'history'):
+        """Получить разрешение на запрос класса method"""
+        cost = METHOD_COSTS.get(method, 1.0)
+        cls = self._get_class(method)
+
+        # 1. Темп класса методов (и блокировка после FloodWait)
+        async with self._class_locks[method]:
+            now = time.monotonic()
+            start_at = max(now, cls['next_at'], cls['blocked_until'])
+            cls['next_at'] = start_at + cost / cls['rate']
+            if start_at > now:
+                self.total_wait += start_at - now
+                await asyncio.sleep(start_at - now)
+
+        # 2. Общий bucket аккаунта
+        async with self._lock:
+            self._refill()
+            self.tokens -= cost
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                logger.debug(f"Rate limit ({method}): ожидание {wait:.2f}с")
+                self.total_wait += wait
+                await asyncio.sleep(wait)
+                self._refill()
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def on_success(self, method: str):
+        """Успешный запрос: аддитивное увеличение скорости класса"""
+        if not self.adaptive:
+            return
+        cls = self._get_class(method)
+        cls['successes'] += 1
+        if cls['successes'] % INCREASE_EVERY == 0 and cls['rate'] < self.rate:
+            cls['rate'] = min(self.rate, cls['rate'] + INCREASE_STEP)
+            self._persist(method)
+
+    def on_flood(self, method: str, seconds: int):
+        """FloodWait: мультипликативное уменьшение и пауза класса"""
+        cls = self._get_class(method)
+        cls['floods'] += 1
+        cls['blocked_until'] = max(cls['blocked_until'], time.monotonic() + seconds)
+        if self.adaptive:
+            cls['rate'] = max(MIN_RATE, cls['rate'] * DECREASE_FACTOR)
+        cls['last_flood_at'] = datetime.now().isoformat()
+        cls['last_flood_seconds'] = seconds
+
+        self.flood_events.append({
+            'method': method,
+            'seconds': seconds,
+            'new_rate': round(cls['rate'], 3),
+            'at': cls['last_flood_at']
+        })
+        logger.warning(f"FloodWait ({method}): {seconds}с, скорость класса снижена до {cls['rate']:.3f}")
+        self._persist(method)
+
+    def _persist(self, method: str):
+        """Сохранить выученную скорость класса"""
+        if not self.persist:
+            return
+        cls = self.classes[method]
+        try:
+            self.persist(method, {
+                'rate': cls['rate'],
+                'flood_count': cls['floods'],
+                'last_flood_at': cls.get('last_flood_at'),
+                'last_flood_seconds': cls.get('last_flood_seconds')
+            })
+        except Exception as e:
+            logger.error(f"Ошибка сохранения скорости {method}: {e}")
+
+    def set_rate(self, rate: float, capacity: float = None):
+        """Изменить потолок скорости (например, после обновления конфигурации)"""
+        self._refill()
+        self.rate = max(float(rate), 0.01)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+        self.tokens = min(self.tokens, self.capacity)
+        for cls in self.classes.values():
+            cls['rate'] = min(cls['rate'], self.rate)
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        self._refill()
+        now = time.monotonic()
+        return {
+            'rate': self.rate,
+            'capacity': self.capacity,
+            'tokens': round(self.tokens, 2),
+            'adaptive': self.adaptive,
+            'requests': dict(self.requests),
+            'total_wait_seconds': round(self.total_wait, 2),
+            'classes': {
+                method: {
+                    'rate': round(cls['rate'], 3),
+                    'successes': cls['successes'],
+                    'floods': cls['floods'],
+                    'blocked_for': round(max(0.0, cls['blocked_until'] - now), 1)
+                }
+                for method, cls in self.classes.items()
+            },
+            'flood_events': list(self.flood_events)
+        }
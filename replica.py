@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Telegrab Replica
+Реплика для чтения: узел без Telegram сессии, который повторяет архив
+другого экземпляра Telegrab через его журнал изменений (GET /changes)
+"""
+
+import json
+import time
+import asyncio
+import logging
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Таймаут HTTP запроса к источнику (секунды)
+REQUEST_TIMEOUT = 30
+
+# Максимальная пауза между попытками при ошибках источника (секунды)
+MAX_BACKOFF = 60
+
+
+class Replicator:
+    """
+    Репликация архива с основного экземпляра
+
+    При первом запуске запоминается текущая позиция журнала источника
+    (head) и загружается полный снимок сообщений (/replica/snapshot)
+    страницами. Затем реплика читает /changes?full=true от этой позиции
+    и применяет каждую страницу одной транзакцией. Курсор и позиция снимка
+    хранятся в replication_state, поэтому после перезапуска репликация
+    продолжается с того же места.
+
+    Если источник ответил reset (журнал после курсора уже очищен),
+    локальные данные очищаются и снимок загружается заново.
+    """
+
+    def __init__(self, store, source: str, api_key: str = '',
+                 interval: float = 5, batch: int = 500):
+        """
+        Args:
+            store: База данных реплики (DatabaseV6)
+            source: Базовый URL источника (http://host:3000)
+            api_key: API ключ источника
+            interval: Пауза между опросами, когда реплика догнала источник (секунды)
+            batch: Изменений / сообщений снимка за один запрос
+        """
+        self.store = store
+        self.source = source.rstrip('/')
+        self.api_key = api_key
+        self.interval = max(float(interval), 0.1)
+        self.batch = max(int(batch), 1)
+        self.cursor = 0
+        self.snapshot_after: Optional[int] = None
+        self.head = 0
+        self.caught_up_at: Optional[float] = None
+        self.last_pull_at: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self._task = None
+        self.stats = {'pulls': 0, 'applied': 0, 'snapshot_messages': 0, 'resets': 0, 'errors': 0}
+
+    def start(self):
+        """Запустить фоновую репликацию"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+            print(f"🔁 Реплика: источник {self.source}")
+
+    def stop(self):
+        """Остановить репликацию"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _get(self, path: str, **params) -> Dict:
+        """GET запрос к источнику (выполняется в потоке)"""
+        url = f"{self.source}{path}?{urllib.parse.urlencode(params)}"
+        request = urllib.request.Request(url, headers={'X-API-Key': self.api_key})
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    async def fetch(self, path: str, **params) -> Dict:
+        """Запрос к источнику без блокировки event loop"""
+        return await asyncio.to_thread(self._get, path, **params)
+
+    def _load_state(self):
+        """Курсор и позиция снимка из БД"""
+        state = self.store.get_replication_state(self.source)
+        if state:
+            self.cursor = state['cursor']
+            self.snapshot_after = state['snapshot_after']
+        return state
+
+    def _save_state(self):
+        """Сохранить курсор и позицию снимка"""
+        self.store.save_replication_state(self.source, self.cursor, self.snapshot_after)
+
+    async def begin_snapshot(self):
+        """Новый снимок: позиция журнала источника до начала копирования"""
+        head = await self.fetch('/changes', since=0, limit=1)
+        self.cursor = head['head']
+        self.snapshot_after = 0
+        self._save_state()
+        logger.info(f"Реплика: снимок источника с позиции журнала {self.cursor}")
+
+    async def step(self) -> bool:
+        """
+        Один запрос к источнику
+
+        Returns:
+            True — есть ещё данные (следующий запрос сразу), False — реплика догнала источник
+        """
+        if self.snapshot_after is not None:
+            page = await self.fetch('/replica/snapshot', after=self.snapshot_after, limit=self.batch)
+            await asyncio.to_thread(self.store.apply_replica_changes, page['messages'])
+            self.stats['snapshot_messages'] += len(page['messages'])
+            self.snapshot_after = page['next']
+            self._save_state()
+            if self.snapshot_after is None:
+                print(f"✅ Реплика: снимок загружен ({self.stats['snapshot_messages']} сообщений)")
+            return True
+
+        page = await self.fetch('/changes', since=self.cursor, limit=self.batch, full='true')
+        self.stats['pulls'] += 1
+        self.head = page['head']
+        if page['reset']:
+            self.stats['resets'] += 1
+            logger.warning(f"Реплика: журнал источника после {self.cursor} очищен, новый снимок")
+            # Удаления и очистки за пропущенный период неизвестны — снимок с нуля
+            await asyncio.to_thread(self.store.clear_database)
+            await self.begin_snapshot()
+            return True
+
+        await self.apply(page['changes'])
+        self.cursor = page['next']
+        self._save_state()
+        return page['has_more']
+
+    async def apply(self, changes):
+        """Применить страницу изменений (очистки — отдельно, в порядке журнала)"""
+        records, deleted = [], []
+
+        async def flush():
+            if records or deleted:
+                self.stats['applied'] += await asyncio.to_thread(
+                    self.store.apply_replica_changes, list(records), list(deleted))
+                records.clear()
+                deleted.clear()
+
+        for change in changes:
+            if change['op'] == 'clear':
+                await flush()
+                if change['chat_id'] is None:
+                    await asyncio.to_thread(self.store.clear_database)
+                else:
+                    await asyncio.to_thread(self.store.clear_chat_messages, change['chat_id'])
+                self.stats['applied'] += 1
+            elif change.get('record'):
+                # Полная запись уже содержит признак удаления (meta.is_deleted)
+                records.append(change['record'])
+            elif change['op'] == 'delete':
+                deleted.append((change['chat_id'], change['message_id']))
+        await flush()
+
+    async def run(self):
+        """Цикл репликации"""
+        backoff = self.interval
+        starting = True
+        while True:
+            try:
+                if starting:
+                    # Нет сохранённого состояния — репликация с нуля
+                    if self._load_state() is None:
+                        await self.begin_snapshot()
+                    starting = False
+                more = await self.step()
+                self.last_pull_at = datetime.now().isoformat()
+                self.last_error = None
+                backoff = self.interval
+                if more:
+                    continue
+                self.caught_up_at = time.monotonic()
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats['errors'] += 1
+                self.last_error = str(e)
+                logger.warning(f"Реплика: ошибка запроса к {self.source}: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def lag(self) -> Dict:
+        """Отставание реплики для /health"""
+        # Время с момента, когда реплика последний раз догнала источник
+        # (без обычной паузы между опросами); None — ещё не догоняла
+        lag_seconds = None
+        if self.caught_up_at is not None:
+            lag_seconds = round(time.monotonic() - self.caught_up_at - self.interval, 1)
+            lag_seconds = max(lag_seconds, 0)
+        return {
+            'source': self.source,
+            'cursor': self.cursor,
+            'source_head': self.head,
+            'behind_changes': max(self.head - self.cursor, 0),
+            'lag_seconds': lag_seconds,
+            'snapshot_in_progress': self.snapshot_after is not None,
+            'last_pull_at': self.last_pull_at,
+            'last_error': self.last_error
+        }
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, **self.lag()}
@@ -6,6 +6,9 @@ let ws = null;
 let messagePage = 0;
 const MESSAGES_PER_PAGE = 50;
 let qrCheckInterval = null;
+const CHANGES_POLL_MS = 10000;
+let changesCursor = null;
+let exportJobId = null;
 
 // Инициализация
 document.addEventListener('DOMContentLoaded', () => {
@@ -28,7 +31,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     checkAuthStatus();
     initWebSocket();
-    setInterval(refreshAll, 30000); // Автообновление каждые 30 сек
+    setInterval(pollChanges, CHANGES_POLL_MS); // Delta-синхронизация через /changes
 });
 
 // Обновление статуса загрузки
@@ -189,6 +192,30 @@ function handleWebSocketMessage(data) {
             }
             break;
             
+        case 'new_messages':
+            // Пачка живых сообщений: одно обновление на всю пачку
+            console.log('📩 Новые сообщения:', data.messages.length);
+            addLog(data.messages.length === 1
+                ? `Новое сообщение в ${data.messages[0].chat_title}`
+                : `Новых сообщений: ${data.messages.length}`, 'info');
+            loadStats();
+            if (document.getElementById('messages')?.classList.contains('active')) {
+                loadMessages();
+            }
+            if (allChatsData) {
+                let changed = false;
+                data.messages.forEach(msg => {
+                    const chat = allChatsData.find(c => c.id == msg.chat_id);
+                    if (chat) {
+                        chat.message_count = (chat.message_count || 0) + 1;
+                        chat.last_message_date = msg.message_date;
+                        changed = true;
+                    }
+                });
+                if (changed) applyChatFilters();
+            }
+            break;
+
         case 'chat_loaded':
             console.log('📚 Чат загружен:', data);
             addLog(`Чат "${data.chat_title}": загружено ${data.new_messages} сообщений`, 'success');
@@ -207,6 +234,14 @@ function handleWebSocketMessage(data) {
             console.log('📊 Прогресс загрузки:', data);
             break;
             
+        case 'export_progress':
+            showExportProgress(data);
+            break;
+            
+        case 'import_progress':
+            showImportProgress(data);
+            break;
+            
         case 'pong':
             break;
     }
@@ -868,7 +903,7 @@ async function loadMissedAll() {
     
     try {
         const result = await apiRequest('/load_missed_all', { method: 'POST' });
-        addLog(`Создано задач: ${result.task_ids?.length || 0}`, 'info');
+        addLog(`Создано задач: ${result.task_ids?.length || 0}, актуальных чатов: ${result.plan?.up_to_date ?? 0}`, 'info');
         refreshQueue();
     } catch (e) {
         alert('Ошибка: ' + e.message);
@@ -944,23 +979,37 @@ async function loadMissed(chatId) {
 
 async function exportData() {
     try {
-        const result = await apiRequest('/export', {
-            method: 'POST',
-            body: JSON.stringify({ limit: 10000 })
-        });
-        const blob = new Blob([JSON.stringify(result.messages, null, 2)], { type: 'application/json' });
-        const url = URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = url;
-        a.download = `telegrab_export_${new Date().toISOString().split('T')[0]}.json`;
-        a.click();
-        URL.revokeObjectURL(url);
-        addLog(`Экспортировано ${result.count} сообщений`, 'success');
+        const size = await downloadExport('/export?format=json');
+        addLog(`Экспорт сохранён (${formatFileSize(size)})`, 'success');
     } catch (e) {
         alert('Ошибка экспорта: ' + e.message);
     }
 }
 
+// Скачивание потокового экспорта (имя файла — из Content-Disposition)
+async function downloadExport(url) {
+    const response = await fetch(`${API_BASE}${url}`, {
+        headers: apiKey ? { 'X-API-Key': apiKey } : {}
+    });
+    if (!response.ok) {
+        const errorData = await response.json().catch(() => ({ detail: response.statusText }));
+        throw new Error(errorData.detail || `HTTP ${response.status}`);
+    }
+    const disposition = response.headers.get('Content-Disposition') || '';
+    const match = disposition.match(/filename="([^"]+)"/);
+    const blob = await response.blob();
+
+    const urlDownload = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = urlDownload;
+    a.download = match ? match[1] : `telegrab_export_${new Date().toISOString().split('T')[0]}`;
+    document.body.appendChild(a);
+    a.click();
+    document.body.removeChild(a);
+    window.URL.revokeObjectURL(urlDownload);
+    return blob.size;
+}
+
 async function clearDatabase() {
     if (!confirm('Вы уверены? Все сохранённые сообщения будут удалены!')) return;
     
@@ -1004,7 +1053,8 @@ async function refreshQueue() {
                             <div>
                                 <strong>${task.type}</strong>
                                 <span class="badge badge-chat ms-2">${task.id}</span>
-                                <br><small class="text-muted">Чат: ${task.data?.chat_id || '-'}</small>
+                                ${task.priority ? `<span class="badge bg-info ms-1">${task.priority}</span>` : ''}
+                                <br><small class="text-muted">Чат: ${task.data?.chat_id || '-'}${task.queue_position ? ` · №${task.queue_position} в очереди` : ''}</small>
                             </div>
                             <span class="badge ${task.status === 'processing' ? 'bg-warning' : 'bg-secondary'}">
                                 ${task.status}
@@ -1030,6 +1080,66 @@ async function refreshAll() {
     addLog('Данные обновлены', 'info');
 }
 
+// Delta-синхронизация: запрашиваем только изменения после курсора,
+// тяжёлые списки перезагружаются, только если затронуты
+async function pollChanges() {
+    try {
+        if (changesCursor === null) {
+            // Первый опрос: данные уже загружены, начинаем с текущей позиции журнала
+            const head = await apiRequest('/changes?limit=1');
+            changesCursor = head.head;
+            return;
+        }
+
+        const changes = [];
+        let data;
+        do {
+            data = await apiRequest(`/changes?since=${changesCursor}&limit=1000`);
+            if (data.reset) {
+                changesCursor = data.head;
+                refreshAll();
+                return;
+            }
+            changes.push(...data.changes);
+            changesCursor = data.next;
+        } while (data.has_more);
+
+        if (changes.length > 0) applyChanges(changes);
+    } catch (e) {
+        console.error('Failed to poll changes:', e);
+    }
+}
+
+function applyChanges(changes) {
+    console.log('🔄 Изменений:', changes.length);
+    const chatIds = new Set(changes.map(c => c.chat_id));
+    loadStats();
+    refreshQueue();
+
+    // Очистка или незнакомый чат — полная перезагрузка списка чатов
+    const unknownChat = [...chatIds].some(id => id === null || !allChatsData.find(c => c.id == id));
+    if (changes.some(c => c.op === 'clear') || unknownChat) {
+        loadChats();
+        loadChatFilter();
+    } else {
+        changes.forEach(change => {
+            const chat = allChatsData.find(c => c.id == change.chat_id);
+            const date = change.message?.message_date;
+            if (chat && date && (!chat.last_message_date || date > chat.last_message_date)) {
+                chat.last_message_date = date;
+            }
+        });
+        applyChatFilters();
+    }
+
+    // Страница сообщений — только если изменился показываемый чат
+    const filterChat = document.getElementById('messageChatFilter').value;
+    if (document.getElementById('messages')?.classList.contains('active')
+            && (!filterChat || [...chatIds].some(id => id === null || id == filterChat))) {
+        loadMessages();
+    }
+}
+
 function selectChat(chatId) {
     document.getElementById('messageChatFilter').value = chatId;
     document.querySelector('[data-bs-target="#messages"]').click();
@@ -2117,39 +2227,43 @@ async function loadChatFilterForExport() {
     }
 }
 
+// Параметры экспорта из формы
+function exportQuery() {
+    const format = document.getElementById('exportFormat').value;
+    const chatId = document.getElementById('exportChatId').value;
+    const limit = parseInt(document.getElementById('exportLimit').value) || 0;
+    const dateFrom = document.getElementById('exportDateFrom').value;
+    const dateTo = document.getElementById('exportDateTo').value;
+    const gzip = document.getElementById('exportGzip').checked;
+    
+    let query = `format=${format}&limit=${limit}`;
+    if (chatId) query += `&chat_id=${chatId}`;
+    if (dateFrom) query += `&date_from=${dateFrom}`;
+    if (dateTo) query += `&date_to=${dateTo}`;
+    if (gzip) query += '&gzip=true';
+    return query;
+}
+
 // Экспорт базы данных
 async function exportDatabase() {
     const format = document.getElementById('exportFormat').value;
-    const chatId = document.getElementById('exportChatId').value;
-    const limit = parseInt(document.getElementById('exportLimit').value) || 10000;
     const statusEl = document.getElementById('exportStatus');
     
+    // Parquet собирается только на сервере
+    if (format === 'parquet') return exportInBackground();
+    
     statusEl.innerHTML = '<div class="alert alert-info"><i class="bi bi-hourglass-split"></i> Подготовка экспорта...</div>';
     
     try {
-        let url = `/export?format=${format}&limit=${limit}`;
-        if (chatId) url += `&chat_id=${chatId}`;
-        
-        const data = await apiRequest(url);
-        
-        // Создаём файл для скачивания
-        const blob = new Blob([JSON.stringify(data, null, 2)], { type: 'application/json' });
-        const urlDownload = window.URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = urlDownload;
-        a.download = `telegrab_export_${new Date().toISOString().split('T')[0]}.json`;
-        document.body.appendChild(a);
-        a.click();
-        document.body.removeChild(a);
-        window.URL.revokeObjectURL(urlDownload);
+        const size = await downloadExport(`/export?${exportQuery()}`);
         
         statusEl.innerHTML = `
             <div class="alert alert-success">
-                <i class="bi bi-check-circle"></i> Экспорт завершён: ${data.count || 0} сообщений
+                <i class="bi bi-check-circle"></i> Экспорт завершён: ${formatFileSize(size)}
             </div>
         `;
         
-        addLog(`Экспорт БД: ${data.count || 0} сообщений в формате ${format}`, 'success');
+        addLog(`Экспорт БД в формате ${format}: ${formatFileSize(size)}`, 'success');
     } catch (e) {
         console.error('Ошибка экспорта:', e);
         statusEl.innerHTML = `
@@ -2160,6 +2274,56 @@ async function exportDatabase() {
     }
 }
 
+// Фоновый экспорт: файл на сервере, прогресс по WebSocket
+async function exportInBackground() {
+    const statusEl = document.getElementById('exportStatus');
+    
+    try {
+        const result = await apiRequest(`/export/jobs?${exportQuery()}`, { method: 'POST' });
+        exportJobId = result.task_id;
+        statusEl.innerHTML = `
+            <div class="alert alert-info">
+                <i class="bi bi-hourglass-split"></i> Экспорт ${result.task_id} в очереди...
+            </div>
+        `;
+        addLog(`Фоновый экспорт ${result.task_id} поставлен в очередь`, 'info');
+    } catch (e) {
+        console.error('Ошибка фонового экспорта:', e);
+        statusEl.innerHTML = `
+            <div class="alert alert-danger">
+                <i class="bi bi-exclamation-triangle"></i> Ошибка экспорта: ${escapeHtml(e.message)}
+            </div>
+        `;
+    }
+}
+
+// Прогресс фонового экспорта (событие export_progress)
+function showExportProgress(data) {
+    if (data.task_id !== exportJobId) return;
+    const statusEl = document.getElementById('exportStatus');
+    
+    if (!data.file) {
+        statusEl.innerHTML = `
+            <div class="alert alert-info">
+                <i class="bi bi-hourglass-split"></i> Экспорт: ${data.rows} из ${data.total} (${data.percent}%), ${formatFileSize(data.bytes)}
+                <div class="progress mt-2"><div class="progress-bar" style="width: ${data.percent}%"></div></div>
+            </div>
+        `;
+        return;
+    }
+    
+    statusEl.innerHTML = `
+        <div class="alert alert-success">
+            <i class="bi bi-check-circle"></i> Экспорт готов: ${data.rows} сообщений, ${formatFileSize(data.bytes)}
+            <button type="button" class="btn btn-sm btn-success ms-2"
+                    onclick="downloadExport('/exports/${encodeURIComponent(data.file)}')">
+                <i class="bi bi-download"></i> Скачать
+            </button>
+        </div>
+    `;
+    addLog(`Фоновый экспорт ${data.task_id}: ${data.rows} сообщений`, 'success');
+}
+
 // Экспорт всех чатов
 async function exportAllChats() {
     const statusEl = document.getElementById('exportStatus');
@@ -2167,25 +2331,15 @@ async function exportAllChats() {
     statusEl.innerHTML = '<div class="alert alert-info"><i class="bi bi-hourglass-split"></i> Подготовка экспорта всех чатов...</div>';
     
     try {
-        const data = await apiRequest('/export?limit=100000');
-        
-        const blob = new Blob([JSON.stringify(data, null, 2)], { type: 'application/json' });
-        const urlDownload = window.URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = urlDownload;
-        a.download = `telegrab_all_chats_${new Date().toISOString().split('T')[0]}.json`;
-        document.body.appendChild(a);
-        a.click();
-        document.body.removeChild(a);
-        window.URL.revokeObjectURL(urlDownload);
+        const size = await downloadExport('/export?format=ndjson&gzip=true');
         
         statusEl.innerHTML = `
             <div class="alert alert-success">
-                <i class="bi bi-check-circle"></i> Экспорт завершён: ${data.count || 0} сообщений
+                <i class="bi bi-check-circle"></i> Экспорт завершён: ${formatFileSize(size)}
             </div>
         `;
         
-        addLog(`Экспорт всех чатов: ${data.count || 0} сообщений`, 'success');
+        addLog(`Экспорт всех чатов: ${formatFileSize(size)}`, 'success');
     } catch (e) {
         console.error('Ошибка экспорта всех чатов:', e);
         statusEl.innerHTML = `
@@ -2213,58 +2367,32 @@ async function importDatabase() {
     }
     
     const file = fileInput.files[0];
-    statusEl.innerHTML = '<div class="alert alert-info"><i class="bi bi-hourglass-split"></i> Загрузка файла...</div>';
+    statusEl.innerHTML = '<div class="alert alert-info"><i class="bi bi-hourglass-split"></i> Импорт данных...</div>';
     
     try {
-        // Читаем файл
-        const reader = new FileReader();
+        // Файл отправляется как есть: сервер разбирает его потоком
+        const response = await fetch(
+            `${API_BASE}/import?skip_duplicates=${skipDuplicates}&update_edits=${updateEdits}`, {
+                method: 'POST',
+                headers: apiKey ? { 'X-API-Key': apiKey } : {},
+                body: file
+            });
+        const result = await response.json().catch(() => ({ detail: response.statusText }));
+        if (!response.ok) {
+            throw new Error(result.detail || `HTTP ${response.status}`);
+        }
         
-        reader.onload = async function(e) {
-            try {
-                const data = JSON.parse(e.target.result);
-                
-                statusEl.innerHTML = '<div class="alert alert-info"><i class="bi bi-hourglass-split"></i> Импорт данных...</div>';
-                
-                // Отправляем на сервер
-                const result = await apiRequest('/import', {
-                    method: 'POST',
-                    body: JSON.stringify({
-                        data: data,
-                        skip_duplicates: skipDuplicates,
-                        update_edits: updateEdits
-                    })
-                });
-                
-                statusEl.innerHTML = `
-                    <div class="alert alert-success">
-                        <i class="bi bi-check-circle"></i> Импорт завершён: ${result.imported || 0} сообщений
-                    </div>
-                `;
-                
-                addLog(`Импорт БД: ${result.imported || 0} сообщений`, 'success');
-                
-                // Обновляем статистику
-                setTimeout(() => loadDatabaseStats(), 1000);
-                
-            } catch (parseError) {
-                console.error('Ошибка парсинга JSON:', parseError);
-                statusEl.innerHTML = `
-                    <div class="alert alert-danger">
-                        <i class="bi bi-exclamation-triangle"></i> Ошибка парсинга JSON: ${escapeHtml(parseError.message)}
-                    </div>
-                `;
-            }
-        };
+        statusEl.innerHTML = `
+            <div class="alert alert-success">
+                <i class="bi bi-check-circle"></i> Импорт завершён: ${result.imported || 0} сообщений,
+                пропущено ${result.skipped || 0} (${result.per_second || 0} сообщ./сек)
+            </div>
+        `;
         
-        reader.onerror = function() {
-            statusEl.innerHTML = `
-                <div class="alert alert-danger">
-                    <i class="bi bi-exclamation-triangle"></i> Ошибка чтения файла
-                </div>
-            `;
-        };
+        addLog(`Импорт БД: ${result.imported || 0} сообщений`, 'success');
         
-        reader.readAsText(file);
+        // Обновляем статистику
+        setTimeout(() => loadDatabaseStats(), 1000);
         
     } catch (e) {
         console.error('Ошибка импорта:', e);
@@ -2276,6 +2404,17 @@ async function importDatabase() {
     }
 }
 
+// Прогресс импорта (событие import_progress)
+function showImportProgress(data) {
+    if (data.done) return;
+    document.getElementById('importStatus').innerHTML = `
+        <div class="alert alert-info">
+            <i class="bi bi-hourglass-split"></i> Импорт: получено ${data.received}, сохранено ${data.imported},
+            пропущено ${data.skipped} (${data.per_second} сообщ./сек)
+        </div>
+    `;
+}
+
 // Оптимизация БД
 async function optimizeDatabase() {
     const statusEl = document.getElementById('dbOperationStatus');
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Telegrab Sync Planner
+Дешёвая проверка «есть ли новое?» по top_message диалогов
+перед постановкой задач загрузки
+"""
+
+import logging
+from datetime import datetime
+from itertools import chain
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telethon import utils
+from telethon.tl.functions.messages import GetPeerDialogsRequest
+from telethon.tl.types import Channel, Chat, InputDialogPeer
+
+logger = logging.getLogger('telegrab')
+
+# Диалогов в одном ответе messages.getDialogs (размер страницы iter_dialogs)
+DIALOGS_PAGE_SIZE = 100
+
+# Пиров в одном запросе messages.getPeerDialogs
+PEER_DIALOGS_BATCH = 100
+
+
+def plan_entry(chat_id: int, title: str, kind: str, top_id: int, stored: Dict,
+               continue_history: bool = True) -> Dict:
+    """Сравнить top_message диалога с сохранённым состоянием чата"""
+    max_id = stored.get('max_id', 0)
+    known_id = max(max_id, stored.get('synced_top_id', 0))
+
+    actions = []
+    if max_id == 0:
+        if not stored.get('fully_loaded') and top_id:
+            actions.append('history')
+    else:
+        if top_id > known_id:
+            actions.append('missed')
+        if continue_history and not stored.get('fully_loaded'):
+            actions.append('history')
+
+    return {
+        'chat_id': chat_id,
+        'title': title,
+        'kind': kind,
+        'top_message': top_id,
+        'stored_max_id': max_id,
+        'known_id': known_id,
+        'new_messages_estimate': max(top_id - known_id, 0) if max_id else None,
+        'fully_loaded': bool(stored.get('fully_loaded')),
+        'actions': actions
+    }
+
+
+class SyncPlanner:
+    """
+    План синхронизации чатов за один проход iter_dialogs
+
+    Каждый диалог приходит вместе с ID своего последнего сообщения
+    (dialog.top_message). Планировщик сравнивает его с сохранённым
+    MAX(message_id) чата и с top_message, до которого чат уже догружался
+    (служебные сообщения в архив не попадают). Задачи ставятся только
+    для чатов, в которых действительно появились сообщения:
+
+    - 'missed'  — есть новые сообщения, догрузить load_missed
+    - 'history' — чат ещё не загружался (или загружен не полностью)
+    - пустой список действий — чат актуален, запросов не нужно
+
+    Заодно сущности диалогов попадают в кэш сущностей, а pts каналов
+    без сохранённого состояния — в UpdatesTracker.
+    """
+
+    def __init__(self, store, entity_cache=None, updates_tracker=None):
+        """
+        Args:
+            store: База данных с методами get_sync_baseline / save_synced_top
+            entity_cache: Кэш сущностей (необязательно)
+            updates_tracker: Состояние обновлений для pts каналов (необязательно)
+        """
+        self.store = store
+        self.entity_cache = entity_cache
+        self.updates_tracker = updates_tracker
+        self.last_plan_at = None
+        self.stats = {'plans': 0, 'dialogs': 0, 'dialog_requests': 0, 'planned': 0, 'skipped': 0}
+
+    async def plan(self, client, acquire: Callable[[str], Awaitable], limit: Optional[int] = None,
+                   continue_history: bool = True) -> Dict:
+        """
+        Построить план синхронизации (без постановки задач)
+
+        Args:
+            client: Telethon клиент
+            acquire: Ожидание rate limiter (method) перед запросом диалогов
+            limit: Максимум диалогов (None — все)
+            continue_history: Планировать 'history' для не полностью загруженных чатов
+
+        Returns:
+            План: список чатов с действиями, сводка и чаты из БД,
+            которых нет среди диалогов ('unseen')
+        """
+        baseline = self.store.get_sync_baseline()
+        chats = []
+        entities = []
+        channel_pts = {}
+        seen = set()
+        requests = 0
+
+        await acquire('dialogs')
+        requests += 1
+        async for dialog in client.iter_dialogs(limit=limit):
+            # Следующая страница диалогов — ещё один запрос через rate limiter
+            if len(seen) and len(seen) % DIALOGS_PAGE_SIZE == 0:
+                await acquire('dialogs')
+                requests += 1
+
+            chat_id = dialog.id
+            seen.add(chat_id)
+            entities.append(dialog.entity)
+
+            chats.append(plan_entry(
+                chat_id, dialog.name,
+                'channel' if dialog.is_channel else 'group' if dialog.is_group else 'user',
+                getattr(dialog.dialog, 'top_message', 0) or 0,
+                baseline.get(chat_id, {}), continue_history
+            ))
+
+            pts = getattr(dialog.dialog, 'pts', None)
+            if pts and isinstance(dialog.entity, Channel):
+                channel_pts[dialog.entity.id] = pts
+
+        if self.entity_cache is not None:
+            self.entity_cache.remember_many(entities)
+        if self.updates_tracker is not None:
+            self.updates_tracker.seed_channels(channel_pts)
+
+        unseen = sorted(chat_id for chat_id, stored in baseline.items()
+                        if chat_id not in seen and stored.get('max_id'))
+        summary = {
+            'dialogs': len(chats),
+            'missed': sum(1 for c in chats if 'missed' in c['actions']),
+            'history': sum(1 for c in chats if 'history' in c['actions']),
+            'up_to_date': sum(1 for c in chats if not c['actions']),
+            'unseen': len(unseen),
+            'dialog_requests': requests
+        }
+
+        self.stats['plans'] += 1
+        self.stats['dialogs'] += len(chats)
+        self.stats['dialog_requests'] += requests
+        self.stats['planned'] += sum(1 for c in chats if c['actions'])
+        self.stats['skipped'] += summary['up_to_date']
+        self.last_plan_at = datetime.now().isoformat()
+
+        logger.info(f"План синхронизации: диалогов {summary['dialogs']}, новые сообщения в {summary['missed']}, "
+                    f"история для {summary['history']}, актуальны {summary['up_to_date']}")
+        return {'generated_at': self.last_plan_at, 'summary': summary, 'chats': chats, 'unseen': unseen}
+
+    async def check_peers(self, call: Callable[..., Awaitable], peers: List) -> Dict[int, Dict]:
+        """
+        Проверить выбранные чаты через messages.getPeerDialogs
+        (до PEER_DIALOGS_BATCH чатов за запрос, без прохода по всем диалогам)
+
+        Args:
+            call: Обёртка запроса (request, method=...) с rate limiter
+            peers: InputPeer чатов
+
+        Returns:
+            {chat_id: запись плана}, только для чатов из ответа
+        """
+        baseline = self.store.get_sync_baseline()
+        result = {}
+        for start in range(0, len(peers), PEER_DIALOGS_BATCH):
+            batch = peers[start:start + PEER_DIALOGS_BATCH]
+            response = await call(GetPeerDialogsRequest(
+                peers=[InputDialogPeer(peer) for peer in batch]
+            ), method='dialogs')
+            self.stats['dialog_requests'] += 1
+
+            entities = {utils.get_peer_id(x): x for x in chain(response.users, response.chats)}
+            if self.entity_cache is not None:
+                self.entity_cache.remember_many(entities.values())
+
+            channel_pts = {}
+            for dialog in response.dialogs:
+                chat_id = utils.get_peer_id(dialog.peer)
+                entity = entities.get(chat_id)
+                kind = 'channel' if isinstance(entity, Channel) else 'group' if isinstance(entity, Chat) else 'user'
+                result[chat_id] = plan_entry(
+                    chat_id, utils.get_display_name(entity) if entity else str(chat_id), kind,
+                    getattr(dialog, 'top_message', 0) or 0,
+                    baseline.get(chat_id, {}), continue_history=False
+                )
+                if getattr(dialog, 'pts', None) and isinstance(entity, Channel):
+                    channel_pts[entity.id] = dialog.pts
+
+            if self.updates_tracker is not None:
+                self.updates_tracker.seed_channels(channel_pts)
+
+        self.stats['dialogs'] += len(result)
+        return result
+
+    def mark_synced(self, chat_id: int, top_id: Optional[int]):
+        """Запомнить, что чат догружен до top_id (после успешной load_missed)"""
+        if not top_id:
+            return
+        try:
+            self.store.save_synced_top(chat_id, top_id)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния синхронизации {chat_id}: {e}")
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'last_plan_at': self.last_plan_at}
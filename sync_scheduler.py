@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Telegrab Sync Scheduler
+Периодическая синхронизация отслеживаемых чатов с интервалом
+по активности чата и в пределах доли общего лимита запросов
+"""
+
+import math
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger('telegrab')
+
+# Сколько новых сообщений в среднем должно набираться к проверке
+TARGET_MESSAGES_PER_SYNC = 50
+
+# Окно, по которому считается активность чата (часы)
+ACTIVITY_WINDOW_HOURS = 24
+
+# Период проверки расписания (секунды)
+TICK_SECONDS = 60
+
+# Сообщений на страницу истории (оценка стоимости догрузки)
+MESSAGES_PER_PAGE = 100
+
+
+def sync_interval(rate_per_hour: float, min_interval: int, max_interval: int) -> int:
+    """Интервал синхронизации: к проверке набирается ~TARGET_MESSAGES_PER_SYNC сообщений"""
+    if rate_per_hour <= 0:
+        return max_interval
+    seconds = TARGET_MESSAGES_PER_SYNC / rate_per_hour * 3600
+    return int(min(max(seconds, min_interval), max_interval))
+
+
+class SyncScheduler:
+    """
+    Расписание синхронизации tracked_chats
+
+    Каждому отслеживаемому чату назначается интервал по его активности:
+    число сообщений за последние ACTIVITY_WINDOW_HOURS часов в архиве
+    (живые и догруженные) и число новых сообщений, найденных последней
+    проверкой. Активные чаты проверяются раз в несколько минут,
+    молчащие — раз в сутки. Время следующей проверки хранится в БД
+    (sync_schedule) и переживает перезапуск.
+
+    Раз в TICK_SECONDS наступившие чаты проверяются одним запросом
+    messages.getPeerDialogs на 100 чатов (сравнение top_message через
+    SyncPlanner). Задачи load_missed ставятся сначала для самых активных
+    чатов, пока не исчерпана доля budget_share общего лимита запросов
+    за период; остальные остаются в очереди расписания до следующего
+    периода.
+    """
+
+    def __init__(self, store, planner, min_interval: int = 300, max_interval: int = 86400,
+                 budget_share: float = 0.2, rate: float = 1.0):
+        """
+        Args:
+            store: База данных с методами get/save_sync_schedule и count_recent_messages
+            planner: SyncPlanner (check_peers / mark_synced)
+            min_interval: Минимальный интервал синхронизации чата (секунды)
+            max_interval: Максимальный интервал (секунды)
+            budget_share: Доля общего лимита запросов для планировщика (0..1)
+            rate: Общий лимит запросов аккаунта (запросов/сек)
+        """
+        self.store = store
+        self.planner = planner
+        self.min_interval = max(int(min_interval), 1)
+        self.max_interval = max(int(max_interval), self.min_interval)
+        self.budget_share = min(max(float(budget_share), 0.01), 1.0)
+        self.rate = float(rate)
+        self._task = None
+        self.last_tick_at = None
+        self.stats = {'ticks': 0, 'checked': 0, 'enqueued': 0, 'deferred': 0, 'requests': 0}
+
+    @property
+    def budget(self) -> int:
+        """Запросов на один период проверки"""
+        return max(1, int(self.rate * TICK_SECONDS * self.budget_share))
+
+    def schedule(self, now: Optional[datetime] = None) -> List[Dict]:
+        """Расписание чатов с пересчитанной активностью"""
+        now = now or datetime.now()
+        since = (datetime.now(timezone.utc) - timedelta(hours=ACTIVITY_WINDOW_HOURS)).isoformat()
+        recent = self.store.count_recent_messages(since)
+
+        rows = []
+        for row in self.store.get_sync_schedule():
+            archived_rate = recent.get(row['chat_id'], 0) / ACTIVITY_WINDOW_HOURS
+            # Всплеск активности виден по последней проверке раньше, чем по архиву
+            row['rate_per_hour'] = round(max(archived_rate, row.get('observed_rate') or 0), 2)
+            row['interval_seconds'] = sync_interval(row['rate_per_hour'], self.min_interval, self.max_interval)
+            if not row.get('next_run_at'):
+                # Новый чат в расписании — проверяем сразу
+                row['next_run_at'] = now.isoformat()
+            rows.append(row)
+        return rows
+
+    def due(self, rows: List[Dict], now: datetime) -> List[Dict]:
+        """Наступившие чаты: сначала самые активные, затем самые просроченные"""
+        ready = [row for row in rows if row['next_run_at'] <= now.isoformat()]
+        return sorted(ready, key=lambda row: (-row['rate_per_hour'], row['next_run_at']))
+
+    async def tick(self, call: Callable[..., Awaitable], input_peer: Callable[[int], Optional[object]],
+                   enqueue: Callable[[int, Optional[int]], Awaitable]) -> Dict:
+        """
+        Один период расписания
+
+        Args:
+            call: Обёртка запроса (request, method=...) с rate limiter
+            input_peer: InputPeer чата из кэша (None если неизвестен)
+            enqueue: Постановка load_missed (chat_id, top_message)
+
+        Returns:
+            Статистика периода
+        """
+        now = datetime.now()
+        rows = self.schedule(now)
+        due = self.due(rows, now)
+        result = {'due': len(due), 'checked': 0, 'enqueued': 0, 'deferred': 0, 'requests': 0}
+        if not due:
+            self.store.save_sync_schedule(rows)
+            return result
+
+        budget = self.budget
+        peers = {}
+        for row in due:
+            peer = input_peer(row['chat_id'])
+            if peer is not None:
+                peers[row['chat_id']] = peer
+
+        checks = {}
+        if peers:
+            checks = await self.planner.check_peers(call, list(peers.values()))
+            result['requests'] += math.ceil(len(peers) / 100)
+            budget -= result['requests']
+            result['checked'] = len(checks)
+
+        for row in due:
+            entry = checks.get(row['chat_id'])
+            if entry is None and row['chat_id'] in peers:
+                # Диалога больше нет (вышли из чата) — следующая проверка по интервалу
+                self._reschedule(row, now, 0)
+                continue
+            if entry is not None and 'missed' not in entry['actions'] \
+                    and (entry['stored_max_id'] or not entry['top_message']):
+                # Новых сообщений нет — следующая проверка по интервалу
+                self._reschedule(row, now, 0)
+                continue
+
+            # Есть новые сообщения, либо чат без сохранённой сущности (проверит сама задача)
+            new_messages = (entry or {}).get('new_messages_estimate') or 0
+            cost = max(1, math.ceil(new_messages / MESSAGES_PER_PAGE))
+            if budget < cost and result['enqueued']:
+                result['deferred'] += 1
+                continue
+            await enqueue(row['chat_id'], entry['top_message'] if entry else None)
+            budget -= cost
+            result['enqueued'] += 1
+            self._reschedule(row, now, new_messages)
+
+        self.store.save_sync_schedule(rows)
+
+        self.stats['ticks'] += 1
+        for key in ('checked', 'enqueued', 'deferred', 'requests'):
+            self.stats[key] += result[key]
+        self.last_tick_at = now.isoformat()
+        logger.info(f"Расписание синхронизации: наступило {result['due']}, проверено {result['checked']}, "
+                    f"задач {result['enqueued']}, отложено {result['deferred']}")
+        return result
+
+    def _reschedule(self, row: Dict, now: datetime, new_messages: int):
+        """Следующая проверка чата с учётом найденных сообщений"""
+        row['last_new_messages'] = new_messages
+        row['observed_rate'] = 0
+        if new_messages and row.get('last_run_at'):
+            elapsed = (now - datetime.fromisoformat(row['last_run_at'])).total_seconds()
+            row['observed_rate'] = round(new_messages / max(elapsed / 3600, self.min_interval / 3600), 2)
+            row['rate_per_hour'] = max(row['rate_per_hour'], row['observed_rate'])
+            row['interval_seconds'] = sync_interval(row['rate_per_hour'], self.min_interval, self.max_interval)
+        row['last_run_at'] = now.isoformat()
+        row['next_run_at'] = (now + timedelta(seconds=row['interval_seconds'])).isoformat()
+
+    async def run(self, call, input_peer, enqueue):
+        """Периодическая проверка расписания"""
+        while True:
+            try:
+                await self.tick(call, input_peer, enqueue)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка расписания синхронизации: {e}")
+            await asyncio.sleep(TICK_SECONDS)
+
+    def start(self, call, input_peer, enqueue):
+        """Запустить фоновую задачу (повторный запуск заменяет предыдущую)"""
+        self.stop()
+        self._task = asyncio.create_task(self.run(call, input_peer, enqueue))
+
+    def stop(self):
+        """Остановить фоновую задачу"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        return {**self.stats, 'running': bool(self._task and not self._task.done()),
+                'budget_per_tick': self.budget, 'last_tick_at': self.last_tick_at}
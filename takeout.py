@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Telegrab Takeout
+Takeout-сессия Telegram для первичной выгрузки больших архивов
+"""
+
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict
+
+from telethon.errors import TakeoutInitDelayError, TakeoutInvalidError
+
+logger = logging.getLogger('telegrab')
+
+# Сколько секунд держать неиспользуемую сессию открытой перед завершением
+TAKEOUT_IDLE_SECONDS = 120
+
+
+class TakeoutManager:
+    """
+    Общая takeout-сессия аккаунта
+
+    Запросы через takeout-клиент оборачиваются в InvokeWithTakeoutRequest и
+    получают более мягкие лимиты Telegram. Сессия у аккаунта одна, поэтому
+    задачи загрузки берут её через open() и возвращают через release().
+    Сессия открывается с finalize=False и переживает уступку воркера между
+    страницами; когда её никто не использует TAKEOUT_IDLE_SECONDS секунд,
+    она завершается через end_takeout().
+
+    Если Telegram отказывает (TakeoutInitDelayError — нужно подтверждение
+    в приложении или ожидание), open() возвращает None до истечения
+    задержки, и загрузка идёт обычным путём.
+    """
+
+    def __init__(self, idle_seconds: float = TAKEOUT_IDLE_SECONDS):
+        """
+        Args:
+            idle_seconds: Время простоя до завершения сессии (секунды)
+        """
+        self.idle_seconds = idle_seconds
+        self.takeout = None
+        self.users = 0
+        self.refused_until = 0.0
+        self.opened_at = None
+        self._client = None
+        self._close_task = None
+        self._lock = asyncio.Lock()
+        self.stats = {'opened': 0, 'finished': 0, 'refused': 0, 'invalidated': 0, 'fallbacks': 0}
+
+    async def open(self, client):
+        """
+        Takeout-клиент для загрузки (None — takeout недоступен, нужен обычный путь)
+        """
+        async with self._lock:
+            if self.takeout is not None and self._client is client:
+                self.users += 1
+                self._cancel_close()
+                return self.takeout
+
+            if time.monotonic() < self.refused_until:
+                self.stats['fallbacks'] += 1
+                return None
+
+            try:
+                session = getattr(client, 'session', None)
+                if getattr(session, 'takeout_id', None) is None:
+                    context = client.takeout(finalize=False, users=True, chats=True,
+                                             megagroups=True, channels=True)
+                else:
+                    # Незавершённая сессия прошлого запуска — продолжаем её
+                    context = client.takeout(finalize=False)
+                self.takeout = await context.__aenter__()
+            except TakeoutInitDelayError as e:
+                self.refused_until = time.monotonic() + e.seconds
+                self.stats['refused'] += 1
+                self.stats['fallbacks'] += 1
+                logger.warning(f"Takeout отклонён, повтор через {e.seconds} сек — загрузка обычным путём")
+                return None
+            except Exception as e:
+                self.refused_until = time.monotonic() + self.idle_seconds
+                self.stats['fallbacks'] += 1
+                logger.error(f"Ошибка открытия takeout-сессии, загрузка обычным путём: {e}")
+                return None
+
+            self._client = client
+            self.users = 1
+            self.opened_at = datetime.now().isoformat()
+            self.stats['opened'] += 1
+            print("📦 Takeout-сессия открыта")
+            return self.takeout
+
+    def release(self, takeout):
+        """Вернуть сессию, полученную из open(); без пользователей она завершится после простоя"""
+        if takeout is None or takeout is not self.takeout:
+            return
+        self.users = max(self.users - 1, 0)
+        if self.users == 0:
+            self._cancel_close()
+            self._close_task = asyncio.create_task(self._close_later())
+
+    def invalidate(self):
+        """Сессия отозвана Telegram (TakeoutInvalidError) — больше её не выдаём"""
+        if self.takeout is None:
+            return
+        self.stats['invalidated'] += 1
+        session = getattr(self._client, 'session', None)
+        if session is not None and hasattr(session, 'takeout_id'):
+            session.takeout_id = None
+        self._reset()
+
+    async def _close_later(self):
+        """Завершить сессию после простоя"""
+        await asyncio.sleep(self.idle_seconds)
+        self._close_task = None
+        async with self._lock:
+            if self.users == 0:
+                await self.finish(success=True)
+
+    async def finish(self, success: bool = True):
+        """Завершить сессию (account.finishTakeoutSession)"""
+        if self.takeout is None:
+            return
+        client = self._client
+        self._reset()
+        try:
+            await client.end_takeout(success)
+            self.stats['finished'] += 1
+            print("📦 Takeout-сессия завершена")
+        except TakeoutInvalidError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка завершения takeout-сессии: {e}")
+
+    def _cancel_close(self):
+        """Отменить отложенное завершение"""
+        if self._close_task and not self._close_task.done():
+            self._close_task.cancel()
+        self._close_task = None
+
+    def _reset(self):
+        """Забыть текущую сессию"""
+        self._cancel_close()
+        self.takeout = None
+        self._client = None
+        self.users = 0
+        self.opened_at = None
+
+    def get_stats(self) -> Dict:
+        """Статистика для /queue"""
+        refused_for = max(self.refused_until - time.monotonic(), 0)
+        return {**self.stats, 'active': self.takeout is not None, 'users': self.users,
+                'opened_at': self.opened_at, 'refused_for_seconds': round(refused_for)}
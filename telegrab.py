@@ -54,6 +54,96 @@ MISSED_DAYS_LIMIT=7
 REQUESTS_PER_SECOND=1
 MESSAGES_PER_REQUEST=100
 JOIN_CHAT_TIMEOUT=10
+
+# Адаптивная скорость: растёт при успешных запросах до MAX_REQUESTS_PER_SECOND,
+# уменьшается вдвое при FloodWait (выученные значения хранятся в БД)
+ADAPTIVE_RATE=true
+MAX_REQUESTS_PER_SECOND=5
+
+# ============================================================
+# Task Queue
+# Число параллельных воркеров (делят общий лимит запросов)
+# ============================================================
+TASK_WORKERS=3
+# Каждые N секунд ожидания повышают приоритет задачи на один класс
+TASK_AGING_SECONDS=300
+# Сколько завершённых задач хранить в БД и не дольше скольких дней
+TASK_HISTORY_LIMIT=1000
+TASK_HISTORY_DAYS=7
+
+# ============================================================
+# ЗАПИСЬ ЖИВЫХ СООБЩЕНИЙ
+# ============================================================
+# Сообщения сохраняются пачкой: до N штук или через N мс после первого
+LIVE_BATCH_SIZE=100
+LIVE_BATCH_DELAY_MS=20
+# Размер кэша имён отправителей и чатов (записей в памяти)
+ENTITY_CACHE_SIZE=10000
+
+# ============================================================
+# ДОГРУЗКА ПОСЛЕ ПРОСТОЯ
+# ============================================================
+# Догружать через getDifference (иначе — поиск по дате)
+UPDATES_CATCH_UP=true
+# Как часто сохранять состояние обновлений (секунды)
+UPDATES_STATE_INTERVAL=60
+
+# ============================================================
+# РАСПИСАНИЕ СИНХРОНИЗАЦИИ
+# ============================================================
+# Периодически проверять отслеживаемые чаты
+SYNC_SCHEDULER=true
+# Интервал проверки чата по его активности: от (сек) до (сек)
+SYNC_MIN_INTERVAL=300
+SYNC_MAX_INTERVAL=86400
+# Доля общего лимита запросов для расписания (%)
+SYNC_BUDGET_PERCENT=20
+
+# ============================================================
+# TAKEOUT
+# ============================================================
+# Первичная загрузка истории через takeout-сессию (мягче лимиты,
+# Telegram может потребовать подтверждение в приложении)
+TAKEOUT_BACKFILL=false
+
+# ============================================================
+# НЕСКОЛЬКО АККАУНТОВ
+# ============================================================
+# Дополнительные аккаунты через запятую (номера телефонов) — у каждого
+# свой лимит запросов; сессии data/telegrab_<API_ID>_<номер> должны быть авторизованы
+EXTRA_ACCOUNTS=
+# FloodWait (сек), после которого задача переходит к другому аккаунту
+ACCOUNT_FAILOVER_SECONDS=60
+
+# ============================================================
+# ПРОЦЕССЫ
+# ============================================================
+# HTTP воркеров; больше 1 — отдельный ingest-процесс (Telethon, очередь задач)
+# и N процессов API, читающих БД в режиме WAL
+API_WORKERS=1
+
+# ============================================================
+# ЖУРНАЛ ИЗМЕНЕНИЙ
+# ============================================================
+# Сколько дней хранить журнал изменений для GET /changes
+CHANGES_RETENTION_DAYS=7
+
+# ============================================================
+# РЕПЛИКА ДЛЯ ЧТЕНИЯ
+# ============================================================
+# URL основного экземпляра (http://host:3000): узел без Telegram сессии
+# повторяет его архив через GET /changes
+REPLICA_OF=
+# API ключ основного экземпляра
+REPLICA_API_KEY=
+# Пауза между опросами источника (секунды)
+REPLICA_POLL_SECONDS=5
+
+# ============================================================
+# ФОНОВЫЙ ЭКСПОРТ
+# ============================================================
+# Сколько часов хранить готовые файлы в data/exports
+EXPORT_RETENTION_HOURS=24
 """
 
 # Параметры которые должны быть в .env
@@ -80,7 +170,31 @@ ENV_DEFAULTS = {
     'MISSED_DAYS_LIMIT': '7',
     'REQUESTS_PER_SECOND': '1',
     'MESSAGES_PER_REQUEST': '100',
-    'JOIN_CHAT_TIMEOUT': '10'
+    'JOIN_CHAT_TIMEOUT': '10',
+    'ADAPTIVE_RATE': 'true',
+    'MAX_REQUESTS_PER_SECOND': '5',
+    'TASK_WORKERS': '3',
+    'TASK_AGING_SECONDS': '300',
+    'TASK_HISTORY_LIMIT': '1000',
+    'TASK_HISTORY_DAYS': '7',
+    'LIVE_BATCH_SIZE': '100',
+    'LIVE_BATCH_DELAY_MS': '20',
+    'ENTITY_CACHE_SIZE': '10000',
+    'UPDATES_CATCH_UP': 'true',
+    'UPDATES_STATE_INTERVAL': '60',
+    'SYNC_SCHEDULER': 'true',
+    'SYNC_MIN_INTERVAL': '300',
+    'SYNC_MAX_INTERVAL': '86400',
+    'SYNC_BUDGET_PERCENT': '20',
+    'TAKEOUT_BACKFILL': 'false',
+    'EXTRA_ACCOUNTS': '',
+    'ACCOUNT_FAILOVER_SECONDS': '60',
+    'API_WORKERS': '1',
+    'CHANGES_RETENTION_DAYS': '7',
+    'REPLICA_OF': '',
+    'REPLICA_API_KEY': '',
+    'REPLICA_POLL_SECONDS': '5',
+    'EXPORT_RETENTION_HOURS': '24'
 }
 
 
@@ -183,9 +297,33 @@ def load_config():
         'HISTORY_LIMIT_PER_CHAT': 200,
         'MAX_CHATS_TO_LOAD': 20,
         'REQUESTS_PER_SECOND': 1,
+        'MAX_REQUESTS_PER_SECOND': 5,
+        'ADAPTIVE_RATE': True,
         'MESSAGES_PER_REQUEST': 100,
         'JOIN_CHAT_TIMEOUT': 10,
         'MISSED_DAYS_LIMIT': 7,
+        'TASK_WORKERS': 3,
+        'TASK_AGING_SECONDS': 300,
+        'TASK_HISTORY_LIMIT': 1000,
+        'TASK_HISTORY_DAYS': 7,
+        'LIVE_BATCH_SIZE': 100,
+        'LIVE_BATCH_DELAY_MS': 20,
+        'ENTITY_CACHE_SIZE': 10000,
+        'UPDATES_CATCH_UP': True,
+        'UPDATES_STATE_INTERVAL': 60,
+        'SYNC_SCHEDULER': True,
+        'SYNC_MIN_INTERVAL': 300,
+        'SYNC_MAX_INTERVAL': 86400,
+        'SYNC_BUDGET_PERCENT': 20,
+        'TAKEOUT_BACKFILL': False,
+        'EXTRA_ACCOUNTS': '',
+        'ACCOUNT_FAILOVER_SECONDS': 60,
+        'API_WORKERS': 1,
+        'CHANGES_RETENTION_DAYS': 7,
+        'REPLICA_OF': '',
+        'REPLICA_API_KEY': '',
+        'REPLICA_POLL_SECONDS': 5,
+        'EXPORT_RETENTION_HOURS': 24,
     }
 
     try:
@@ -199,11 +337,23 @@ def load_config():
 
                     if key in config:
                         if key in ['API_ID', 'API_PORT', 'HISTORY_LIMIT_PER_CHAT',
-                                  'MAX_CHATS_TO_LOAD', 'REQUESTS_PER_SECOND',
+                                  'MAX_CHATS_TO_LOAD',
                                   'MESSAGES_PER_REQUEST', 'JOIN_CHAT_TIMEOUT',
-                                  'MISSED_LIMIT_PER_CHAT', 'MISSED_DAYS_LIMIT']:
+                                  'MISSED_LIMIT_PER_CHAT', 'MISSED_DAYS_LIMIT', 'TASK_WORKERS',
+                                  'TASK_AGING_SECONDS', 'TASK_HISTORY_LIMIT', 'TASK_HISTORY_DAYS',
+                                  'LIVE_BATCH_SIZE', 'LIVE_BATCH_DELAY_MS', 'ENTITY_CACHE_SIZE',
+                                  'UPDATES_STATE_INTERVAL', 'SYNC_MIN_INTERVAL', 'SYNC_MAX_INTERVAL',
+                                  'SYNC_BUDGET_PERCENT', 'ACCOUNT_FAILOVER_SECONDS',
+                                  'API_WORKERS', 'CHANGES_RETENTION_DAYS',
+                                  'REPLICA_POLL_SECONDS', 'EXPORT_RETENTION_HOURS']:
                             config[key] = int(value) if value.isdigit() else config[key]
-                        elif key in ['AUTO_LOAD_HISTORY', 'AUTO_LOAD_MISSED']:
+                        elif key in ['REQUESTS_PER_SECOND', 'MAX_REQUESTS_PER_SECOND']:
+                            try:
+                                config[key] = max(float(value), 0.01)
+                            except ValueError:
+                                pass
+                        elif key in ['AUTO_LOAD_HISTORY', 'AUTO_LOAD_MISSED', 'ADAPTIVE_RATE', 'UPDATES_CATCH_UP',
+                                     'SYNC_SCHEDULER', 'TAKEOUT_BACKFILL']:
                             config[key] = value.lower() in ['true', 'yes', '1', 'on']
                         else:
                             config[key] = value
@@ -229,6 +379,13 @@ def main():
 
     os.makedirs("data", exist_ok=True)
 
+    # Раздельный режим: этот процесс — ingest (Telethon и очередь задач),
+    # HTTP обслуживают API_WORKERS процессов uvicorn
+    replica = bool(CONFIG['REPLICA_OF'])
+    split = CONFIG['API_WORKERS'] > 1 and not replica
+    if split:
+        os.environ['TELEGRAB_ROLE'] = 'ingest'
+
     from api import run_api_server, tg_client, set_config_from_ui
 
     print(f"\n🌐 API порт: {CONFIG['API_PORT']}")
@@ -238,7 +395,9 @@ def main():
     print(f"🔌 WebSocket: ws://127.0.0.1:{CONFIG['API_PORT']}/ws")
     
     # Проверка конфигурации Telegram
-    if not CONFIG['API_ID'] or not CONFIG['API_HASH'] or not CONFIG['PHONE']:
+    if replica:
+        print(f"\n🔁 Реплика для чтения: источник {CONFIG['REPLICA_OF']} (Telegram не используется)")
+    elif not CONFIG['API_ID'] or not CONFIG['API_HASH'] or not CONFIG['PHONE']:
         print("\n⚠️  Telegram не настроен. Настройте через веб-интерфейс:")
         print(f"   http://127.0.0.1:{CONFIG['API_PORT']}/ui")
         print("\n   Или отредактируйте файл .env вручную")
@@ -254,16 +413,24 @@ def main():
         
         print("🚀 Запуск Telegrab 5.0...")
         
-        # 1. Инициализация Telegram клиента
-        print("\n📱 Инициализация Telegram клиента...")
-        if not CONFIG['API_ID'] or not CONFIG['API_HASH'] or not CONFIG['PHONE']:
-            print("❌ Ошибка: не заданы API_ID, API_HASH или PHONE в .env")
-            print("   Получите ключи на https://my.telegram.org")
-            sys.exit(1)
-        
-        # 2. Подключение к Telegram и регистрация обработчиков
-        print("🔌 Подключение к Telegram...")
-        await tg_client.connect_to_telegram()
+        if replica:
+            # Реплика: Telegram не используется, архив приходит от источника
+            print("\n🔁 Режим реплики: подключение к Telegram пропущено")
+        else:
+            # 1. Инициализация Telegram клиента
+            print("\n📱 Инициализация Telegram клиента...")
+            if not CONFIG['API_ID'] or not CONFIG['API_HASH'] or not CONFIG['PHONE']:
+                print("❌ Ошибка: не заданы API_ID, API_HASH или PHONE в .env")
+                print("   Получите ключи на https://my.telegram.org")
+                sys.exit(1)
+
+            # 2. Подключение к Telegram и регистрация обработчиков
+            print("🔌 Подключение к Telegram...")
+            await tg_client.connect_to_telegram()
+
+        if split:
+            await run_api_workers()
+            return
         
         # 3. Запуск API сервера
         print("\n🌐 Запуск API сервера...")
@@ -289,6 +456,41 @@ def main():
         
         await server.serve()
 
+    async def run_api_workers():
+        """Раздельный режим: IPC канал и процессы HTTP воркеров"""
+        import subprocess
+        from api import start_event_hub, event_hub, shutdown_ingest
+
+        await start_event_hub()
+
+        print(f"\n🌐 Запуск {CONFIG['API_WORKERS']} HTTP воркеров на порту {CONFIG['API_PORT']}...")
+        workers = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'api:app',
+             '--host', '0.0.0.0', '--port', str(CONFIG['API_PORT']),
+             '--workers', str(CONFIG['API_WORKERS']), '--log-level', 'warning'],
+            env={**os.environ, 'TELEGRAB_ROLE': 'api'}
+        )
+
+        print("\n" + "="*60)
+        print("✅ Telegrab запущен: ingest-процесс и HTTP воркеры")
+        print("   Нажмите Ctrl+C для остановки")
+        print("="*60 + "\n")
+
+        try:
+            while workers.poll() is None:
+                await asyncio.sleep(1)
+            print(f"❌ HTTP воркеры завершились (код {workers.returncode})")
+        finally:
+            if workers.poll() is None:
+                workers.terminate()
+                try:
+                    workers.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    workers.kill()
+            # Как lifespan обычного режима: остановить задачи и дописать буфер сообщений
+            await shutdown_ingest()
+            await event_hub.stop()
+
     try:
         asyncio.run(run_all())
     except KeyboardInterrupt: